@@ -0,0 +1,170 @@
+# admission.py
+#
+# Admission control for requests that push file bytes through this process
+# (POST /v1/file and resumable-session chunks). Each process admits at most
+# UPLOAD_MAX_CONCURRENCY of them and at most UPLOAD_MAX_INFLIGHT_MB of
+# declared body bytes at once. Requests over either limit wait in a bounded
+# FIFO queue; when the queue is full, or a request has waited
+# UPLOAD_QUEUE_TIMEOUT seconds, it gets a fast 503 with Retry-After so the
+# client backs off and the load balancer can route elsewhere.
+#
+# Reads and health checks never pass through here. They also get priority
+# for database connections: an upload is only admitted while at least
+# UPLOAD_DB_POOL_RESERVE pooled connections are free, so a burst of uploads
+# cannot take the connections metadata reads need.
+import asyncio
+import collections
+import os
+from starlette import status
+from starlette.responses import Response
+from database import pool_headroom
+from s3_service import S3_PART_SIZE
+from metrics import record_admission_metric, record_upload_admission_state
+
+# 0 disables the corresponding limit
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "16"))
+UPLOAD_MAX_INFLIGHT_BYTES = int(float(os.getenv("UPLOAD_MAX_INFLIGHT_MB", "1024")) * 1024 * 1024)
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", "64"))
+UPLOAD_QUEUE_TIMEOUT = float(os.getenv("UPLOAD_QUEUE_TIMEOUT", "10"))
+UPLOAD_DB_POOL_RESERVE = int(os.getenv("UPLOAD_DB_POOL_RESERVE", "2"))
+# Seconds sent in Retry-After with a 503
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+# How often a queued upload waiting only on DB pool headroom looks again;
+# pool check-ins do not wake the queue
+_POOL_RECHECK_INTERVAL = 0.05
+
+
+class AdmissionRejected(Exception):
+    """Raised when an upload cannot be admitted; `reason` is queue_full or queue_timeout"""
+
+    def __init__(self, reason):
+        super().__init__(f"Upload rejected: {reason}")
+        self.reason = reason
+
+
+class UploadAdmission:
+    """Concurrency and byte budget for uploads, with a bounded FIFO wait queue.
+
+    Waiters are admitted strictly in arrival order, so a large upload at the
+    head of the queue is not starved by smaller ones behind it. An upload
+    larger than the whole byte budget is admitted once nothing else is in
+    flight.
+    """
+
+    def __init__(self, max_concurrency=None, max_bytes=None, queue_size=None, queue_timeout=None,
+                 pool_reserve=None):
+        self.max_concurrency = UPLOAD_MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        self.max_bytes = UPLOAD_MAX_INFLIGHT_BYTES if max_bytes is None else max_bytes
+        self.queue_size = UPLOAD_QUEUE_SIZE if queue_size is None else queue_size
+        self.queue_timeout = UPLOAD_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+        self.pool_reserve = UPLOAD_DB_POOL_RESERVE if pool_reserve is None else pool_reserve
+        self.active = 0
+        self.active_bytes = 0
+        self._waiters = collections.deque()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def _charge(self, content_length):
+        # Chunked bodies have no declared size; charge one streamed part
+        charge = content_length if content_length is not None else S3_PART_SIZE
+        return min(charge, self.max_bytes) if self.max_bytes else charge
+
+    def _fits(self, charge):
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return False
+        if self.max_bytes and self.active and self.active_bytes + charge > self.max_bytes:
+            return False
+        headroom = pool_headroom()
+        return headroom is None or headroom > self.pool_reserve
+
+    def _admit(self, charge):
+        self.active += 1
+        self.active_bytes += charge
+
+    def _report(self):
+        record_upload_admission_state(self.active, self.active_bytes, len(self._waiters))
+
+    def _wake(self):
+        while self._waiters:
+            charge, waiter = self._waiters[0]
+            if not self._fits(charge):
+                break
+            self._waiters.popleft()
+            self._admit(charge)
+            waiter.set_result(None)
+        self._report()
+
+    async def acquire(self, content_length=None):
+        """Waits for capacity and returns the charge to pass to release(); raises AdmissionRejected"""
+        charge = self._charge(content_length)
+        if not self._waiters and self._fits(charge):
+            self._admit(charge)
+            record_admission_metric("admitted")
+            self._report()
+            return charge
+        if len(self._waiters) >= self.queue_size:
+            record_admission_metric("rejected.queue_full")
+            raise AdmissionRejected("queue_full")
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append((charge, waiter))
+        record_admission_metric("queued")
+        self._report()
+        deadline = loop.time() + self.queue_timeout
+        try:
+            while not waiter.done():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                if pool_headroom() is not None:
+                    remaining = min(remaining, _POOL_RECHECK_INTERVAL)
+                await asyncio.wait({waiter}, timeout=remaining)
+                self._wake()
+        except asyncio.CancelledError:
+            # The client went away while queued
+            if waiter.done() and not waiter.cancelled():
+                self.release(charge)
+            else:
+                self._withdraw(charge, waiter)
+            raise
+        if waiter.done() and not waiter.cancelled():
+            record_admission_metric("admitted")
+            return charge
+        self._withdraw(charge, waiter)
+        record_admission_metric("rejected.queue_timeout")
+        raise AdmissionRejected("queue_timeout")
+
+    def _withdraw(self, charge, waiter):
+        waiter.cancel()
+        try:
+            self._waiters.remove((charge, waiter))
+        except ValueError:
+            pass
+        self._wake()
+
+    def release(self, charge):
+        self.active -= 1
+        self.active_bytes -= charge
+        self._wake()
+
+
+upload_admission = UploadAdmission()
+
+
+def rejected_response():
+    """503 telling the client when to retry"""
+    return Response(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+    )
+
+
+def content_length(request):
+    """The request's declared body size, or None"""
+    try:
+        return int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        return None
@@ -0,0 +1,124 @@
+"""Bulk delete vs. N single deletes against a moto-backed S3 and SQLite.
+
+Usage (from webapp/):
+    python benchmarks/bench_bulk_delete.py --files 2000
+
+Prints one JSON object with the wall time of each strategy. Both only record
+outbox entries on the request path, so the time the reconciler then needs to
+delete the bulk request's objects from S3 is reported separately.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _start_moto():
+    from moto.server import ThreadedMotoServer
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f"http://{host}:{port}"
+
+
+def _configure_env(endpoint, db_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["S3_ENDPOINT_URL"] = endpoint
+    os.environ["S3_BUCKET"] = "bench-bucket"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ["METADATA_CACHE_ENABLED"] = "false"
+
+
+async def _seed(count):
+    """Creates `count` objects and rows directly, bypassing the upload path"""
+    import s3_service
+    from database import AsyncSessionLocal
+    from models import FileMetadata
+
+    ids = []
+    rows = []
+    for _ in range(count):
+        file_id = str(uuid.uuid4())
+        file_name = f"{file_id}_bench.bin"
+        s3_service.get_s3_client().put_object(Bucket=s3_service.S3_BUCKET_NAME, Key=file_name, Body=b"x")
+        rows.append(FileMetadata(
+            id=file_id, file_name=file_name, url=s3_service.build_file_url(file_name),
+            size=1, upload_date=datetime.datetime.utcnow(),
+        ))
+        ids.append(file_id)
+    async with AsyncSessionLocal() as db:
+        db.add_all(rows)
+        await db.commit()
+    return ids
+
+
+async def _run(count):
+    import httpx
+    from main import app
+    import outbox
+    import s3_service
+
+    from database import get_engine
+    from migrations import apply_migrations
+
+    # ASGITransport does not run the lifespan, which is what normally migrates
+    apply_migrations(get_engine())
+    s3_service.get_s3_client().create_bucket(Bucket=s3_service.S3_BUCKET_NAME)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        ids = await _seed(count)
+        start = time.perf_counter()
+        for file_id in ids:
+            response = await client.delete(f"/v1/file/{file_id}")
+            assert response.status_code in (200, 204), response.status_code
+        single_seconds = time.perf_counter() - start
+        while await outbox.process_pending_operations():
+            pass
+
+        ids = await _seed(count)
+        start = time.perf_counter()
+        response = await client.post("/v1/files/delete", json={"ids": ids})
+        bulk_seconds = time.perf_counter() - start
+        assert response.status_code == 200 and response.json()["deleted"] == count, response.text
+
+        start = time.perf_counter()
+        while await outbox.process_pending_operations():
+            pass
+        drain_seconds = time.perf_counter() - start
+
+    return {
+        "benchmark": "bulk_delete",
+        "files": count,
+        "single_delete_seconds": round(single_seconds, 4),
+        "bulk_delete_seconds": round(bulk_seconds, 4),
+        "speedup": round(single_seconds / bulk_seconds, 2) if bulk_seconds else None,
+        "outbox_drain_seconds": round(drain_seconds, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000)
+    args = parser.parse_args()
+
+    server, endpoint = _start_moto()
+    with tempfile.TemporaryDirectory() as tmp:
+        _configure_env(endpoint, os.path.join(tmp, "bench.db"))
+        try:
+            result = asyncio.run(_run(args.files))
+        finally:
+            server.stop()
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Per-request logging cost on the caller's thread, before and after the queue.
+
+"before" is the original setup: a synchronous FileHandler and StreamHandler
+on the root logger, with the two f-string lines log_requests used to emit.
+"after" is logger_util's QueueHandler with the structured completion record;
+the file/stdout writes happen on the listener thread and are not timed.
+
+Usage (from webapp/):
+    python benchmarks/bench_logging.py --requests 20000
+
+Prints one JSON object with microseconds per request for each setup.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _log_before(logger, i):
+    logger.info(f"GET request to /v1/file/{i}")
+    logger.info(f"GET /v1/file/{i} completed in {1.2345:.2f} ms with status 200")
+
+
+def _log_after(logger, i):
+    logger.debug("%s request to %s", "GET", f"/v1/file/{i}")
+    logger.info(
+        "%s %s completed in %.2f ms with status %s", "GET", f"/v1/file/{i}", 1.2345, 200,
+        extra={
+            "request_id": "bench", "method": "GET", "route": "/v1/file/{id}",
+            "path": f"/v1/file/{i}", "status": 200, "duration_ms": 1.234,
+        },
+    )
+
+
+def _time(log_request, logger, requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        log_request(logger, i)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    log_path = os.path.join(tempfile.mkdtemp(), "bench.log")
+    root = logging.getLogger()
+
+    # before: synchronous handlers, stdout swapped for an in-memory sink
+    # so the terminal doesn't dominate the measurement
+    sink = io.StringIO()
+    sync_handlers = [logging.FileHandler(log_path), logging.StreamHandler(sink)]
+    for handler in sync_handlers:
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    root.handlers = sync_handlers
+    root.setLevel(logging.INFO)
+    before_us = _time(_log_before, logging.getLogger("main"), args.requests)
+    for handler in sync_handlers:
+        handler.close()
+
+    # after: the app's queue-backed setup
+    import logger_util
+    logger_util.stop_logging()
+    logger_util.LOG_QUEUE_SIZE = args.requests * 2
+    real_stdout, sys.stdout = sys.stdout, sink
+    try:
+        logger_util.setup_logging()
+        after_us = _time(_log_after, logger_util.get_logger("main"), args.requests)
+        logger_util.stop_logging()
+    finally:
+        sys.stdout = real_stdout
+
+    print(json.dumps({
+        "requests": args.requests,
+        "before_us_per_request": round(before_us, 2),
+        "after_us_per_request": round(after_us, 2),
+        "speedup": round(before_us / after_us, 2),
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Requests/sec through the old three-layer middleware stack vs. RequestMiddleware.
+
+"before" rebuilds the previous stack on the same routers: the
+MethodNotAllowedMiddleware BaseHTTPMiddleware plus the add_no_cache_header
+and log_requests @app.middleware("http") functions. "after" is main.app.
+GET /healthz is served from the cached readiness result and GET
+/v1/file/{id} from the metadata cache, so the numbers are dominated by
+per-request framework overhead. Logging is set to WARNING for both.
+
+Usage (from webapp/):
+    python benchmarks/bench_middleware.py --requests 5000 --concurrency 50
+
+Prints one JSON object with requests/sec per endpoint and stack.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _configure_env(db_path):
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["S3_BUCKET"] = "bench-bucket"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["LOG_LEVEL"] = "WARNING"
+    os.environ["METRICS_STATSD_ENABLED"] = "false"
+
+
+def _legacy_app():
+    from fastapi import FastAPI, Request
+    from starlette import status
+    from starlette.middleware.base import BaseHTTPMiddleware
+    from starlette.responses import Response
+    from logger_util import get_logger
+    from routers import health, files, bulk, monitoring
+
+    logger = get_logger("bench.legacy")
+    app = FastAPI()
+
+    class MethodNotAllowedMiddleware(BaseHTTPMiddleware):
+        async def dispatch(self, request: Request, call_next):
+            allowed_paths = ["/healthz", "/livez", "/metrics", "/v1/file", "/v1/files"]
+            if request.url.path in allowed_paths or request.url.path.startswith(("/v1/file/", "/v1/files/")):
+                return await call_next(request)
+            response = Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+            response.headers['Pragma'] = "no-cache"
+            return response
+
+    app.add_middleware(MethodNotAllowedMiddleware)
+    for module in (health, files, bulk, monitoring):
+        app.include_router(module.router)
+
+    @app.middleware("http")
+    async def add_no_cache_header(request: Request, call_next):
+        response = await call_next(request)
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers['Pragma'] = "no-cache"
+        return response
+
+    @app.middleware("http")
+    async def log_requests(request: Request, call_next):
+        start_time = time.time()
+        logger.info(f"{request.method} request to {request.url.path}")
+        response = await call_next(request)
+        duration = (time.time() - start_time) * 1000
+        logger.info(f"{request.method} {request.url.path} completed in {duration:.2f} ms with status {response.status_code}")
+        return response
+
+    return app
+
+
+async def _seed_file():
+    from database import AsyncSessionLocal
+    from models import FileMetadata
+
+    file_id = str(uuid.uuid4())
+    async with AsyncSessionLocal() as db:
+        db.add(FileMetadata(
+            id=file_id, file_name=f"{file_id}_bench.bin", url=f"https://bench/{file_id}",
+            size=1, upload_date=datetime.datetime.utcnow(),
+        ))
+        await db.commit()
+    return file_id
+
+
+async def _throughput(app, path, requests, concurrency):
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        response = await client.get(path)  # warm caches
+        assert response.status_code == 200, response.status_code
+        remaining = iter(range(requests))
+
+        async def worker():
+            for _ in remaining:
+                response = await client.get(path)
+                assert response.status_code == 200, response.status_code
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return requests / (time.perf_counter() - start)
+
+
+async def _run(requests, concurrency):
+    from main import app
+
+    legacy = _legacy_app()
+    file_id = await _seed_file()
+    result = {"benchmark": "middleware", "requests": requests, "concurrency": concurrency}
+    for name, path in (("healthz", "/healthz"), ("get_file", f"/v1/file/{file_id}")):
+        before = await _throughput(legacy, path, requests, concurrency)
+        after = await _throughput(app, path, requests, concurrency)
+        result[f"{name}_before_rps"] = round(before, 1)
+        result[f"{name}_after_rps"] = round(after, 1)
+        result[f"{name}_speedup"] = round(after / before, 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _configure_env(os.path.join(tmp, "bench.db"))
+        result = asyncio.run(_run(args.requests, args.concurrency))
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Startup cost: `import main` time and time to the first healthy /healthz.
+
+Import time comes from `python -X importtime -c "import main"` (the largest
+imports made directly by main are reported too). Time to healthy starts `python run.py`
+with one worker against a throwaway SQLite database and polls /healthz until
+it returns 200.
+
+Usage (from webapp/):
+    python benchmarks/bench_startup.py --runs 3
+    python benchmarks/bench_startup.py --baseline benchmarks/startup_baseline.json
+    python benchmarks/bench_startup.py --baseline benchmarks/startup_baseline.json --update-baseline
+
+With --baseline the script exits non-zero when a metric is more than
+--tolerance (default 25%) slower than the recorded baseline, so it can gate CI.
+
+Prints one JSON object with the median of each metric over --runs.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+WEBAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRACKED_METRICS = ("import_main_ms", "time_to_healthy_ms")
+
+
+def _env(db_path, **extra):
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        "S3_BUCKET": "bench-bucket",
+        "AWS_DEFAULT_REGION": env.get("AWS_DEFAULT_REGION", "us-east-1"),
+        "LOG_LEVEL": "WARNING",
+        "METRICS_STATSD_ENABLED": "false",
+    })
+    env.update(extra)
+    return env
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _import_time(env):
+    """Returns (cumulative ms for `main`, the largest imports made directly by main)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=WEBAPP_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    main_ms = None
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # importtime indents each nesting level by two spaces after "| "
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # children are printed before their parent, so reset at each top-level line
+        if depth == 0 and name.strip() == "main":
+            main_ms = int(cumulative) / 1000
+            break
+        if depth == 0:
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative) / 1000
+    largest = sorted(children.items(), key=lambda item: item[1], reverse=True)[:8]
+    return main_ms, {name: round(ms, 1) for name, ms in largest}
+
+
+def _time_to_healthy(env, timeout=60):
+    port = _free_port()
+    env = dict(env, APP_ENV="production", WEB_CONCURRENCY="1", APP_HOST="127.0.0.1", APP_PORT=str(port))
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "run.py"], cwd=WEBAPP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=1) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - start) * 1000
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if server.poll() is not None:
+                raise RuntimeError(f"run.py exited with {server.returncode} before becoming healthy")
+            time.sleep(0.01)
+        raise RuntimeError("server did not become healthy in time")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+
+def _check_baseline(result, baseline, tolerance):
+    regressions = {}
+    for metric in TRACKED_METRICS:
+        if metric in baseline and result[metric] > baseline[metric] * (1 + tolerance):
+            regressions[metric] = {"baseline": baseline[metric], "current": result[metric]}
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    imports, healthy = [], []
+    largest = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for run in range(args.runs):
+            env = _env(os.path.join(tmp, f"bench-{run}.db"))
+            import_ms, largest = _import_time(env)
+            imports.append(import_ms)
+            healthy.append(_time_to_healthy(env))
+
+    result = {
+        "benchmark": "startup",
+        "runs": args.runs,
+        "import_main_ms": round(statistics.median(imports), 1),
+        "time_to_healthy_ms": round(statistics.median(healthy), 1),
+        "largest_imports_ms": largest,
+    }
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({metric: result[metric] for metric in TRACKED_METRICS}, f, indent=2)
+            f.write("\n")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            result["regressions"] = _check_baseline(result, json.load(f), args.tolerance)
+
+    print(json.dumps(result))
+    if result.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
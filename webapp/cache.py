@@ -0,0 +1,195 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from logger_util import get_logger
+from metrics import record_cache_metric
+
+logger = get_logger(__name__)
+
+# File metadata is immutable after upload and only ever deleted, so it can be
+# cached aggressively. 404s are cached too, but only briefly.
+METADATA_CACHE_ENABLED = os.getenv("METADATA_CACHE_ENABLED", "true").lower() == "true"
+METADATA_CACHE_BACKEND = os.getenv("METADATA_CACHE_BACKEND", "memory").lower()  # memory | redis
+METADATA_CACHE_MAX_ENTRIES = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", "10000"))
+METADATA_CACHE_MAX_BYTES = int(os.getenv("METADATA_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", "300"))
+METADATA_CACHE_NEGATIVE_TTL = float(os.getenv("METADATA_CACHE_NEGATIVE_TTL", "5"))
+# How long a delete's tombstone keeps a read that raced the delete from
+# caching the row again
+METADATA_CACHE_TOMBSTONE_TTL = float(os.getenv("METADATA_CACHE_TOMBSTONE_TTL", "30"))
+METADATA_CACHE_REDIS_URL = os.getenv("METADATA_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+
+class LRUTTLCache:
+    """In-process LRU cache with per-entry TTL and caps on entry count and bytes.
+
+    get() returns a (found, value) tuple so a cached None (a negative result)
+    can be told apart from a miss. Values must be JSON-serializable; their
+    encoded length is what counts against max_bytes.
+
+    invalidate() leaves a tombstone that reads as a cached None and that
+    set() does not overwrite until it expires, so a read that fetched a row
+    before it was deleted cannot put it back into the cache.
+    """
+
+    def __init__(self, name, max_entries, max_bytes, clock=time.monotonic):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (value, expires_at, size, tombstone)
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def bytes_used(self):
+        return self._bytes
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= self._clock():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            record_cache_metric(self.name, "miss")
+            return False, None
+        self._entries.move_to_end(key)
+        record_cache_metric(self.name, "hit")
+        return True, entry[0]
+
+    async def set(self, key, value, ttl):
+        entry = self._entries.get(key)
+        if entry is not None and entry[3] and entry[1] > self._clock():
+            return
+        self._store(key, value, ttl, tombstone=False)
+
+    async def invalidate(self, key, ttl):
+        self._store(key, None, ttl, tombstone=True)
+
+    def _store(self, key, value, ttl, tombstone):
+        size = len(key) + len(json.dumps(value))
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, self._clock() + ttl, size, tombstone)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            evicted_key, _ = next(iter(self._entries.items()))
+            self._remove(evicted_key)
+            record_cache_metric(self.name, "eviction")
+
+    async def delete(self, key):
+        if key in self._entries:
+            self._remove(key)
+
+    async def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key):
+        _, _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+class RedisCache:
+    """Shared cache backend for any Redis-compatible server.
+
+    Expiry and eviction are left to the server. Errors are logged and treated
+    as misses so a cache outage never fails a request. A tombstone is stored
+    under the entry's own key, and set() only writes in a WATCH transaction
+    that sees no tombstone there.
+    """
+
+    TOMBSTONE = b"__deleted__"
+
+    def __init__(self, name, client, key_prefix="webapp:"):
+        self.name = name
+        self._client = client
+        self._prefix = f"{key_prefix}{name}:"
+
+    async def get(self, key):
+        try:
+            raw = await self._client.get(self._prefix + key)
+        except Exception as e:
+            logger.warning("Cache %s read failed: %s", self.name, e)
+            raw = None
+        if raw is None:
+            record_cache_metric(self.name, "miss")
+            return False, None
+        record_cache_metric(self.name, "hit")
+        if raw == self.TOMBSTONE:
+            return True, None
+        return True, json.loads(raw)
+
+    async def set(self, key, value, ttl):
+        from redis.exceptions import WatchError
+        redis_key = self._prefix + key
+        try:
+            async with self._client.pipeline(transaction=True) as pipe:
+                await pipe.watch(redis_key)
+                if await pipe.get(redis_key) == self.TOMBSTONE:
+                    return
+                pipe.multi()
+                pipe.set(redis_key, json.dumps(value), px=max(1, int(ttl * 1000)))
+                await pipe.execute()
+        except WatchError:
+            # The key changed since it was read, most likely a concurrent invalidate
+            pass
+        except Exception as e:
+            logger.warning("Cache %s write failed: %s", self.name, e)
+
+    async def invalidate(self, key, ttl):
+        try:
+            await self._client.set(self._prefix + key, self.TOMBSTONE, px=max(1, int(ttl * 1000)))
+        except Exception as e:
+            logger.warning("Cache %s invalidation failed for %s: %s", self.name, key, e)
+
+    async def delete(self, key):
+        try:
+            await self._client.delete(self._prefix + key)
+        except Exception as e:
+            logger.warning("Cache %s invalidation failed for %s: %s", self.name, key, e)
+
+    async def clear(self):
+        try:
+            async for key in self._client.scan_iter(match=f"{self._prefix}*"):
+                await self._client.delete(key)
+        except Exception as e:
+            logger.warning("Cache %s clear failed: %s", self.name, e)
+
+
+class NullCache:
+    """Cache that never stores anything, used when caching is disabled"""
+
+    name = "disabled"
+
+    async def get(self, key):
+        return False, None
+
+    async def set(self, key, value, ttl):
+        pass
+
+    async def invalidate(self, key, ttl):
+        pass
+
+    async def delete(self, key):
+        pass
+
+    async def clear(self):
+        pass
+
+
+def build_metadata_cache():
+    if not METADATA_CACHE_ENABLED:
+        return NullCache()
+    if METADATA_CACHE_BACKEND == "redis":
+        import redis.asyncio as redis  # optional dependency, only needed for the shared backend
+        return RedisCache("metadata", redis.from_url(METADATA_CACHE_REDIS_URL))
+    return LRUTTLCache("metadata", METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_MAX_BYTES)
+
+
+metadata_cache = build_metadata_cache()
@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import mimetypes
+import zlib
+
+try:
+    from awscrt import checksums as crt_checksums
+except ImportError:  # awscrt is optional; only needed for crc32c
+    crt_checksums = None
+
+# Algorithms we can compute while streaming, mapped to the S3 parameter that
+# carries the value for server-side integrity checking.
+CHECKSUM_ALGORITHMS = {
+    "md5": "ContentMD5",
+    "sha256": "ChecksumSHA256",
+    "crc32": "ChecksumCRC32",
+    "crc32c": "ChecksumCRC32C",
+}
+
+# Leading-byte signatures for the formats our clients actually upload
+_MAGIC_NUMBERS = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"BZh", "application/x-bzip2"),
+    (b"\xfd7zXZ\x00", "application/x-xz"),
+    (b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+]
+
+
+class StreamingChecksum:
+    """Incremental checksum that can be fed chunk by chunk"""
+
+    def __init__(self, algorithm):
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            raise ValueError(f"Unsupported checksum algorithm: {algorithm}")
+        if algorithm == "crc32c" and crt_checksums is None:
+            raise ValueError("crc32c checksums require the awscrt package")
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm) if algorithm in ("md5", "sha256") else None
+        self._crc = 0
+
+    def update(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+        elif self.algorithm == "crc32":
+            self._crc = zlib.crc32(data, self._crc)
+        else:
+            self._crc = crt_checksums.crc32c(data, self._crc)
+
+    def digest(self):
+        if self._hash is not None:
+            return self._hash.digest()
+        return self._crc.to_bytes(4, "big")
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+    def s3_value(self):
+        """Base64 digest in the form S3 expects for ContentMD5/Checksum* parameters"""
+        return base64.b64encode(self.digest()).decode("ascii")
+
+    def s3_params(self):
+        return {CHECKSUM_ALGORITHMS[self.algorithm]: self.s3_value()}
+
+    def stored_value(self):
+        """Self-describing value kept in FileMetadata.checksum, e.g. `sha256:ab12...`"""
+        return f"{self.algorithm}:{self.hexdigest()}"
+
+
+def checksum_of(algorithm, data):
+    checksum = StreamingChecksum(algorithm)
+    checksum.update(data)
+    return checksum
+
+
+def sniff_content_type(head, file_name=None, declared=None):
+    """Best-effort MIME type from the declared type, leading bytes, then file extension"""
+    if declared and declared != "application/octet-stream":
+        return declared
+    for magic, mime_type in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    if file_name:
+        guessed, _ = mimetypes.guess_type(file_name)
+        if guessed:
+            return guessed
+    return "application/octet-stream"
@@ -1,21 +1,132 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from dotenv import load_dotenv
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+from metrics import record_pool_checkout, record_pool_in_use
+from tracing import instrument_engine
 import os
-
-load_dotenv()
+import time
 
 URL_DATABASE = os.getenv("DATABASE_URL")
 
-engine = create_engine(URL_DATABASE)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Pool tuning. Size the pool so that (pool size + overflow) x instances stays
+# below the RDS max_connections. DB_POOL_SIZE=0 disables pooling entirely.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+# Async drivers used for each sync driver found in DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def to_async_url(url):
+    """Maps a sync DATABASE_URL (e.g. postgresql://, sqlite://) onto its async driver"""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for database backend {backend}")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that reports checkout wait time and connections in use"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            record_pool_checkout((time.perf_counter() - start) * 1000)
+            record_pool_in_use(self.checkedout())
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        record_pool_in_use(self.checkedout())
+
+
+def _async_engine_options(url):
+    options = {}
+    connect_args = {}
+    if url.get_backend_name() == "sqlite" or DB_POOL_SIZE <= 0:
+        # No pooling: SQLite is only used for local runs/tests, and aiosqlite
+        # connections are tied to the event loop that opened them
+        options["poolclass"] = NullPool
+    else:
+        options.update(
+            poolclass=InstrumentedAsyncQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+    if DB_STATEMENT_TIMEOUT_MS and url.get_backend_name() == "postgresql":
+        connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+
+# The sync engine is only used for schema migrations. Without pooling, no
+# connection is left open once they have run.
+engine = None
+
+
+def get_engine():
+    global engine
+    if engine is None:
+        engine = create_engine(URL_DATABASE, poolclass=NullPool)
+    return engine
+
+ASYNC_URL_DATABASE = to_async_url(URL_DATABASE)
+
+# The async engine (and with it the connection pool) is created per process on
+# first use, normally from the app lifespan, so that every server worker opens
+# its own pool after it starts rather than inheriting one from import time.
+async_engine = None
+_session_factory = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+def get_async_engine():
+    global async_engine
+    if async_engine is None:
+        async_engine = create_async_engine(ASYNC_URL_DATABASE, **_async_engine_options(ASYNC_URL_DATABASE))
+        instrument_engine(async_engine.sync_engine)
+        _session_factory.configure(bind=async_engine)
+    return async_engine
+
+
+def AsyncSessionLocal():
+    """Opens an AsyncSession on this process's engine (same call shape as a sessionmaker)"""
+    if async_engine is None:
+        get_async_engine()
+    return _session_factory()
+
+
+def pool_headroom():
+    """Connections the pool can still hand out without waiting, or None when unpooled"""
+    if async_engine is None or not isinstance(async_engine.pool, InstrumentedAsyncQueuePool):
+        return None
+    return DB_POOL_SIZE + DB_MAX_OVERFLOW - async_engine.pool.checkedout()
+
+
+async def dispose_async_engine():
+    """Closes this process's pooled connections; the next session opens a new engine"""
+    global async_engine
+    if async_engine is not None:
+        engine_to_dispose, async_engine = async_engine, None
+        await engine_to_dispose.dispose()
+
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -0,0 +1,107 @@
+# dedup.py
+#
+# Content-addressed deduplication of uploads. The SHA-256 of each upload is
+# computed while it streams; if a content_blobs row already has that hash the
+# S3 write is skipped and the new files row points at the existing object.
+# content_blobs.ref_count tracks how many files rows share an object, and
+# only releasing the last reference deletes it from S3. A reference is
+# committed before the upload's files row, so an upload that dies in between
+# leaves ref_count one too high; outbox.reconcile_blob_ref_counts corrects it.
+import datetime
+import os
+import time
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from database import AsyncSessionLocal
+from models import ContentBlob
+from logger_util import get_logger
+from metrics import record_db_metric
+
+logger = get_logger(__name__)
+
+UPLOAD_DEDUP = os.getenv("UPLOAD_DEDUP", "false").lower() == "true"
+# Independent of UPLOAD_CHECKSUM_ALGORITHM: dedup needs a collision-resistant hash
+DEDUP_HASH_ALGORITHM = "sha256"
+
+_REGISTER_ATTEMPTS = 3
+
+
+async def _claim(db, content_hash):
+    result = await db.execute(
+        update(ContentBlob)
+        .where(ContentBlob.content_hash == content_hash)
+        .values(ref_count=ContentBlob.ref_count + 1, claimed_at=datetime.datetime.utcnow())
+        .returning(ContentBlob.s3_key)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar_one_or_none()
+
+
+async def claim_blob(content_hash):
+    """Takes a reference on the object already holding `content_hash`.
+
+    Returns its S3 key, or None when the content is not stored yet. The
+    increment is a single UPDATE, so it cannot interleave with a concurrent
+    release of the same blob.
+    """
+    db_start = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        s3_key = await _claim(db, content_hash)
+        await db.commit()
+    record_db_metric("dedup_claim", (time.perf_counter() - db_start) * 1000)
+    return s3_key
+
+
+async def register_blob(content_hash, s3_key, size):
+    """Records a freshly written object as the blob for `content_hash`.
+
+    Returns the S3 key that holds the content from now on. When an identical
+    upload registered first, a reference to its object is taken instead and
+    the returned key differs from `s3_key`; the caller's object is then
+    redundant and should be deleted.
+    """
+    for _ in range(_REGISTER_ATTEMPTS):
+        async with AsyncSessionLocal() as db:
+            db.add(ContentBlob(
+                content_hash=content_hash, s3_key=s3_key, size=size, ref_count=1,
+                claimed_at=datetime.datetime.utcnow(),
+            ))
+            try:
+                await db.commit()
+                return s3_key
+            except IntegrityError:
+                await db.rollback()
+            existing = await _claim(db, content_hash)
+            await db.commit()
+        if existing is not None:
+            return existing
+        # The winner's blob was released between our insert and claim; try again
+    raise RuntimeError(f"Could not register blob {content_hash}")
+
+
+async def release_blob(db, content_hash):
+    """Drops one reference inside the caller's transaction.
+
+    Returns the S3 key to delete once the caller has committed, or None while
+    other files rows still use the object.
+    """
+    result = await db.execute(
+        update(ContentBlob)
+        .where(ContentBlob.content_hash == content_hash)
+        .values(ref_count=ContentBlob.ref_count - 1)
+        .returning(ContentBlob.ref_count, ContentBlob.s3_key)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    if row is None:
+        logger.warning("No content blob for %s; nothing to release", content_hash)
+        return None
+    ref_count, s3_key = row
+    if ref_count > 0:
+        return None
+    await db.execute(
+        delete(ContentBlob)
+        .where(ContentBlob.content_hash == content_hash, ContentBlob.ref_count <= 0)
+        .execution_options(synchronize_session=False)
+    )
+    return s3_key
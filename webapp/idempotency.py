@@ -0,0 +1,151 @@
+# idempotency.py
+#
+# Idempotency-Key support for POST /v1/file. A client that times out and
+# retries with the same key gets the original 201 back instead of a second
+# object and a second files row. The key is reserved before the upload
+# starts, its response is written in the same transaction as the files row,
+# and it is released again if the upload fails so the retry can proceed.
+#
+# A key is bound to a fingerprint of the request that reserved it, so a key
+# reused for a different request gets a 422 instead of someone else's file.
+import datetime
+import hashlib
+import json
+import os
+import time
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, or_, update
+from sqlalchemy.exc import IntegrityError
+from database import AsyncSessionLocal
+from models import IdempotencyKey, utc_isoformat
+from logger_util import get_logger
+from metrics import record_db_metric
+
+logger = get_logger(__name__)
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+# How long a completed upload's response is kept for replay
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+# A reservation still without a response after this many seconds is treated
+# as abandoned (the process handling it died) and may be taken over
+IDEMPOTENCY_LOCK_TIMEOUT = float(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "3600"))
+
+_RESERVE_ATTEMPTS = 3
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+
+def request_fingerprint(request):
+    """Hash of the method, path, query and Content-Length of an upload request.
+
+    The file name and bytes are inside the multipart body, which a replay
+    never reads; the declared length covers them as far as the headers can.
+    """
+    parts = (request.method, request.url.path, request.url.query, request.headers.get("content-length", ""))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def fingerprint_matches(row, fingerprint):
+    """Whether a reserved key may be used by a request with this fingerprint"""
+    # Keys reserved before fingerprints were recorded match any request
+    return row.fingerprint is None or row.fingerprint == fingerprint
+
+
+async def _take_over_stale(db, key, file_id, fingerprint):
+    stale_before = _utcnow() - datetime.timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)
+    result = await db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key, IdempotencyKey.response.is_(None),
+               IdempotencyKey.created_at < stale_before)
+        .values(file_id=file_id, fingerprint=fingerprint, created_at=_utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def reserve_key(key, file_id, fingerprint=None):
+    """Reserves `key` for an upload that will be stored as `file_id`.
+
+    Returns None when the caller now owns the key, or the existing
+    IdempotencyKey row when another request already used it (its response is
+    None while that upload is still running).
+    """
+    db_start = time.perf_counter()
+    try:
+        for _ in range(_RESERVE_ATTEMPTS):
+            async with AsyncSessionLocal() as db:
+                db.add(IdempotencyKey(key=key, file_id=file_id, fingerprint=fingerprint, created_at=_utcnow()))
+                try:
+                    await db.commit()
+                    return None
+                except IntegrityError:
+                    await db.rollback()
+                if await _take_over_stale(db, key, file_id, fingerprint):
+                    logger.warning("Took over abandoned idempotency key %s", key)
+                    return None
+                existing = await db.get(IdempotencyKey, key)
+            if existing is not None:
+                return existing
+            # The other reservation was released in between; try again
+        raise RuntimeError(f"Could not reserve idempotency key {key}")
+    finally:
+        record_db_metric("idempotency_reserve", (time.perf_counter() - db_start) * 1000)
+
+
+async def record_response(db, key, body):
+    """Stores the upload's response inside the caller's transaction"""
+    await db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key)
+        .values(response=json.dumps(jsonable_encoder(body)))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def stored_response(row):
+    body = json.loads(row.response)
+    upload_date = datetime.datetime.fromisoformat(body["upload_date"])
+    if upload_date.tzinfo is None:
+        # Stored while upload_date was serialized without its UTC offset
+        body["upload_date"] = utc_isoformat(upload_date)
+    return body
+
+
+async def release_key(key):
+    """Drops an unfinished reservation so a retry with the same key can upload again"""
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(IdempotencyKey)
+                .where(IdempotencyKey.key == key, IdempotencyKey.response.is_(None))
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+    except Exception as e:
+        # The reservation then expires after IDEMPOTENCY_LOCK_TIMEOUT
+        logger.error("Failed to release idempotency key %s: %s", key, e)
+
+
+async def prune_idempotency_keys():
+    """Deletes expired responses and abandoned reservations"""
+    now = _utcnow()
+    expired_before = now - datetime.timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    stale_before = now - datetime.timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            delete(IdempotencyKey)
+            .where(or_(
+                IdempotencyKey.created_at < expired_before,
+                IdempotencyKey.response.is_(None) & (IdempotencyKey.created_at < stale_before),
+            ))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+    if result.rowcount:
+        logger.info("Pruned %s idempotency keys", result.rowcount)
+    return result.rowcount
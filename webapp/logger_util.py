@@ -1,6 +1,18 @@
 # logger_util.py
+#
+# Request-path code only puts records on an in-memory queue (QueueHandler);
+# a QueueListener thread formats them and does the file/stdout writes, so
+# disk I/O never happens on the event loop thread.
+import atexit
+import contextvars
+import copy
+import datetime
+import json
 import os
 import logging
+import logging.handlers
+import queue
+import random
 import sys
 from pathlib import Path
 
@@ -17,18 +29,140 @@ if os.getenv('GITHUB_ACTIONS') == 'true' or hostname.endswith('.local'):
 else:
     LOG_FILE = '/var/log/webapp.log'
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+# Per-logger sampling of INFO and below, e.g. "main=0.1,routers.files=0.5".
+# Warnings and errors are never sampled.
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
 
-# Create and configure logger
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+
+# Set by the request middleware, picked up by every record logged while
+# that request is being handled
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Structured fields callers may pass through `extra=`
+STRUCTURED_FIELDS = ("request_id", "trace_id", "method", "route", "path", "status", "duration_ms")
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps the current request id on the record before it leaves the request's context"""
+
+    def filter(self, record):
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of INFO/DEBUG records for the configured loggers"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not self.rates:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the structured request fields when present"""
+
+    def format(self, record):
+        payload = {
+            "timestamp": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full.
+
+    Only the %-interpolation (and any traceback) is done on the caller's
+    thread; layout and JSON encoding happen on the listener thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+_listener = None
+
+
+def setup_logging():
+    """Installs the queue-backed root handler; safe to call more than once"""
+    global _listener
+    if _listener is not None:
+        return
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.FileHandler(LOG_FILE, delay=True), logging.StreamHandler(sys.stdout)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [queue_handler]
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flushes queued records and stops the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+setup_logging()
 
 
 # Reusable logger for other modules
 def get_logger(name: str):
-    return logging.getLogger(name)
\ No newline at end of file
+    return logging.getLogger(name)
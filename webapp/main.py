@@ -1,57 +1,61 @@
-from fastapi import FastAPI, Request
-from database import engine
-import models
-from routers import health, files
-from starlette import status
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+from database import get_engine, get_async_engine, dispose_async_engine
+from migrations import DB_MIGRATE_ON_STARTUP, DB_MIGRATE_STARTUP_WAIT, apply_migrations_with_retry
+from routers import health, files, bulk, monitoring, uploads
+from middleware import RequestMiddleware
 from logger_util import get_logger
-import time
+from readiness import health_check_retention_job
+from upload_sessions import upload_session_reaper_job
+from outbox import ORPHAN_SWEEP_INTERVAL, orphan_sweep_job, outbox_reconciler_job
+from metrics import statsd
+from tracing import TracedJSONResponse, exporter as trace_exporter
+from s3_service import get_s3_client, run_in_s3_executor, validate_checksum_algorithm
 
 
-models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
 logger = get_logger(__name__)
 
-class MethodNotAllowedMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        allowed_paths = ["/healthz", "/v1/file"]
-
-        # Allow exact matches or paths that start with "/v1/file/"
-        if request.url.path in allowed_paths or request.url.path.startswith("/v1/file/"):
-            return await call_next(request)
-
-        response = Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers['Pragma'] = "no-cache"
-        return response
-
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs once per server worker, after it has started: each worker gets its
+    # own DB pool and boto3 client. On SIGTERM the server stops accepting
+    # connections and waits for in-flight requests (uploads included) before
+    # this shutdown half runs.
+    validate_checksum_algorithm()
+    get_async_engine()
+    await run_in_s3_executor(get_s3_client)
+    background_tasks = []
+    if DB_MIGRATE_ON_STARTUP:
+        migration = asyncio.create_task(apply_migrations_with_retry(get_engine()))
+        background_tasks.append(migration)
+        await asyncio.wait([migration], timeout=DB_MIGRATE_STARTUP_WAIT)
+    background_tasks.append(asyncio.create_task(health_check_retention_job()))
+    background_tasks.append(asyncio.create_task(upload_session_reaper_job()))
+    background_tasks.append(asyncio.create_task(outbox_reconciler_job()))
+    if ORPHAN_SWEEP_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(orphan_sweep_job()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await dispose_async_engine()
+    statsd.stop()
+    trace_exporter.stop()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=TracedJSONResponse)
+
+# Allow exact matches or paths that start with "/v1/file/" or "/v1/files/"
 app.add_middleware(
-    MethodNotAllowedMiddleware
+    RequestMiddleware,
+    allowed_paths=["/healthz", "/livez", "/metrics", "/debug/profile", "/v1/file", "/v1/files", "/v1/uploads"],
+    allowed_prefixes=("/v1/file/", "/v1/files/", "/v1/uploads/"),
 )
 
 app.include_router(health.router)
 app.include_router(files.router)
-
-@app.middleware("http")
-async def add_no_cache_header(request: Request, call_next):
-    response = await call_next(request)
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers['Pragma'] = "no-cache"
-    return response
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    logger.info(f"{request.method} request to {request.url.path}")
-
-    try:
-        response = await call_next(request)
-    except Exception as e:
-        logger.exception("An unhandled exception occurred while processing the request.")
-        raise e
-
-    duration = (time.time() - start_time) * 1000
-    logger.info(f"{request.method} {request.url.path} completed in {duration:.2f} ms with status {response.status_code}")
-    return response
\ No newline at end of file
+app.include_router(bulk.router)
+app.include_router(uploads.router)
+app.include_router(monitoring.router)
@@ -1,9 +1,209 @@
 # metrics.py
+#
+# Metrics are aggregated in-process and flushed to StatsD from a background
+# thread, so recording a metric on the request path is a dict update rather
+# than a UDP sendto. Counters are summed, gauges keep their last value, and
+# timer samples are batched into packets up to METRICS_MAX_PACKET_SIZE.
+# The same aggregates back the Prometheus-style /metrics endpoint.
 
-from statsd import StatsClient
+import atexit
+import os
+import random
+import re
+import socket
+import threading
+from collections import defaultdict
 
 # StatsD runs on EC2 at localhost:8125
-statsd = StatsClient(host='localhost', port=8125)
+STATSD_HOST = os.getenv("STATSD_HOST", "localhost")
+STATSD_PORT = int(os.getenv("STATSD_PORT", "8125"))
+METRICS_STATSD_ENABLED = os.getenv("METRICS_STATSD_ENABLED", "true").lower() == "true"
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))
+# Fits a 1500-byte MTU after IP/UDP headers
+METRICS_MAX_PACKET_SIZE = int(os.getenv("METRICS_MAX_PACKET_SIZE", "1432"))
+# Timer samples kept per metric per flush; beyond this a uniform reservoir
+# sample is sent with a StatsD sample rate so the agent scales counts back up
+METRICS_MAX_TIMER_SAMPLES = int(os.getenv("METRICS_MAX_TIMER_SAMPLES", "1000"))
+
+# Prometheus histogram bucket bounds, in milliseconds
+HISTOGRAM_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class _TimerReservoir:
+    __slots__ = ("samples", "seen")
+
+    def __init__(self):
+        self.samples = []
+        self.seen = 0
+
+    def add(self, value, capacity):
+        self.seen += 1
+        if len(self.samples) < capacity:
+            self.samples.append(value)
+        else:
+            slot = random.randrange(self.seen)
+            if slot < capacity:
+                self.samples[slot] = value
+
+
+class _Histogram:
+    __slots__ = ("bucket_counts", "count", "total")
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(HISTOGRAM_BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+
+class MetricsAggregator:
+    """Thread-safe in-process aggregation with periodic StatsD flushes"""
+
+    def __init__(self, host=STATSD_HOST, port=STATSD_PORT, flush_interval=METRICS_FLUSH_INTERVAL,
+                 max_packet_size=METRICS_MAX_PACKET_SIZE, max_timer_samples=METRICS_MAX_TIMER_SAMPLES,
+                 statsd_enabled=METRICS_STATSD_ENABLED):
+        self.address = (host, port)
+        self.flush_interval = flush_interval
+        self.max_packet_size = max_packet_size
+        self.max_timer_samples = max_timer_samples
+        self.statsd_enabled = statsd_enabled
+        self._lock = threading.Lock()
+        # Pending since the last flush
+        self._counters = defaultdict(int)
+        self._timers = defaultdict(_TimerReservoir)
+        self._gauges = {}
+        # Cumulative, for /metrics
+        self._total_counters = defaultdict(int)
+        self._histograms = defaultdict(_Histogram)
+        self._last_gauges = {}
+        self._socket = None
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] += count
+            self._total_counters[name] += count
+        self._ensure_flusher()
+
+    def timing(self, name, value_ms):
+        with self._lock:
+            self._timers[name].add(value_ms, self.max_timer_samples)
+            self._histograms[name].observe(value_ms)
+        self._ensure_flusher()
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+            self._last_gauges[name] = value
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flusher is not None or not self.statsd_enabled:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def _drain(self):
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(int)
+            timers, self._timers = self._timers, defaultdict(_TimerReservoir)
+            gauges, self._gauges = self._gauges, {}
+        lines = [f"{name}:{value}|c" for name, value in counters.items()]
+        for name, reservoir in timers.items():
+            suffix = "" if reservoir.seen == len(reservoir.samples) else f"|@{len(reservoir.samples) / reservoir.seen:.6f}"
+            lines.extend(f"{name}:{value:.3f}|ms{suffix}" for value in reservoir.samples)
+        lines.extend(f"{name}:{value}|g" for name, value in gauges.items())
+        return lines
+
+    def _packets(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            line_size = len(line) + (1 if packet else 0)
+            if packet and size + line_size > self.max_packet_size:
+                yield "\n".join(packet).encode()
+                packet = []
+                line_size = len(line)
+                size = 0
+            packet.append(line)
+            size += line_size
+        if packet:
+            yield "\n".join(packet).encode()
+
+    def flush(self):
+        """Sends everything recorded since the last flush; returns the number of packets"""
+        lines = self._drain()
+        if not lines or not self.statsd_enabled:
+            return 0
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sent = 0
+        for packet in self._packets(lines):
+            try:
+                self._socket.sendto(packet, self.address)
+                sent += 1
+            except OSError:
+                # StatsD is fire-and-forget; a missing agent must never hurt the app
+                pass
+        return sent
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def prometheus_text(self):
+        """Renders the cumulative aggregates in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._total_counters)
+            gauges = dict(self._last_gauges)
+            histograms = {
+                name: (list(h.bucket_counts), h.count, h.total) for name, h in self._histograms.items()
+            }
+        out = []
+        for name, value in sorted(counters.items()):
+            metric = _prometheus_name(name) + "_total"
+            out.append(f"# TYPE {metric} counter")
+            out.append(f"{metric} {value}")
+        for name, value in sorted(gauges.items()):
+            metric = _prometheus_name(name)
+            out.append(f"# TYPE {metric} gauge")
+            out.append(f"{metric} {value}")
+        for name, (bucket_counts, count, total) in sorted(histograms.items()):
+            metric = _prometheus_name(name) + "_ms"
+            out.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(HISTOGRAM_BUCKETS_MS, bucket_counts):
+                cumulative += bucket_count
+                out.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            out.append(f'{metric}_bucket{{le="+Inf"}} {count}')
+            out.append(f"{metric}_sum {total:.3f}")
+            out.append(f"{metric}_count {count}")
+        return "\n".join(out) + "\n"
+
+
+_INVALID_PROMETHEUS_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _prometheus_name(name):
+    return "webapp_" + _INVALID_PROMETHEUS_CHARS.sub("_", name)
+
+
+statsd = MetricsAggregator()
+atexit.register(statsd.stop)
 
 def record_api_metric(api_name: str, duration_ms: float):
     statsd.incr(f"api.{api_name}.count")
@@ -13,4 +213,28 @@ def record_db_metric(query_name: str, duration_ms: float):
     statsd.timing(f"db.query.{query_name}.time", duration_ms)
 
 def record_s3_metric(op_name: str, duration_ms: float):
-    statsd.timing(f"s3.{op_name}.time", duration_ms)
\ No newline at end of file
+    statsd.timing(f"s3.{op_name}.time", duration_ms)
+
+def record_pool_checkout(wait_ms: float):
+    statsd.timing("db.pool.checkout_wait", wait_ms)
+
+def record_pool_in_use(connections: int):
+    statsd.gauge("db.pool.in_use", connections)
+
+def record_cache_metric(cache_name: str, event: str):
+    statsd.incr(f"cache.{cache_name}.{event}")
+
+def record_dedup_metric(event: str):
+    statsd.incr(f"upload.dedup.{event}")
+
+def record_outbox_metric(event: str, count: int = 1):
+    if count:
+        statsd.incr(f"outbox.{event}", count)
+
+def record_admission_metric(event: str):
+    statsd.incr(f"admission.upload.{event}")
+
+def record_upload_admission_state(active: int, inflight_bytes: int, queued: int):
+    statsd.gauge("admission.upload.active", active)
+    statsd.gauge("admission.upload.inflight_bytes", inflight_bytes)
+    statsd.gauge("admission.upload.queue_depth", queued)
@@ -0,0 +1,109 @@
+# middleware.py
+#
+# One raw ASGI middleware for everything that used to be split across
+# MethodNotAllowedMiddleware, add_no_cache_header and log_requests. Each of
+# those wrapped the request in BaseHTTPMiddleware's task/stream machinery;
+# this only wraps `send` to add headers, so streaming bodies pass through
+# untouched.
+import time
+import uuid
+from logger_util import get_logger, request_id_var
+from tracing import end_request_span, start_request_span
+
+logger = get_logger(__name__)
+
+NO_CACHE_HEADERS = (
+    (b"cache-control", b"no-cache, no-store, must-revalidate"),
+    (b"pragma", b"no-cache"),
+)
+_NO_CACHE_HEADER_NAMES = frozenset(name for name, _ in NO_CACHE_HEADERS)
+_REQUEST_ID_HEADER = b"x-request-id"
+_TRACEPARENT_HEADER = b"traceparent"
+
+
+class RequestMiddleware:
+    """Path allowlist, request id, no-cache headers and request logging in one pass.
+
+    Requests for paths outside `allowed_paths`/`allowed_prefixes` get a 405
+    without reaching the app, as before.
+    """
+
+    def __init__(self, app, allowed_paths=(), allowed_prefixes=()):
+        self.app = app
+        self.allowed_paths = frozenset(allowed_paths)
+        self.allowed_prefixes = tuple(allowed_prefixes)
+        self._headers = list(NO_CACHE_HEADERS)
+        self._method_not_allowed_headers = self._headers + [(b"content-length", b"0")]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        method = scope["method"]
+        path = scope["path"]
+        request_id = _header(scope, _REQUEST_ID_HEADER) or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        request_span, span_token = start_request_span(
+            f"{method} {path}", request_id, _header(scope, _TRACEPARENT_HEADER),
+            {"http.method": method, "http.target": path, "request_id": request_id},
+        )
+        response_headers = self._headers + [(_REQUEST_ID_HEADER, request_id.encode("latin-1"))]
+        status_code = None
+        logger.debug("%s request to %s", method, path)
+
+        async def send_with_headers(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = [
+                    (name, value) for name, value in message.get("headers", ())
+                    if name.lower() not in _NO_CACHE_HEADER_NAMES and name.lower() != _REQUEST_ID_HEADER
+                ]
+                message["headers"] = headers + response_headers
+            await send(message)
+
+        try:
+            if path in self.allowed_paths or path.startswith(self.allowed_prefixes):
+                await self.app(scope, receive, send_with_headers)
+            else:
+                await send_with_headers({
+                    "type": "http.response.start", "status": 405, "headers": self._method_not_allowed_headers,
+                })
+                await send_with_headers({"type": "http.response.body", "body": b""})
+        except Exception as e:
+            logger.exception("An unhandled exception occurred while processing the request.")
+            if request_span is not None:
+                request_span.record_error(e)
+            raise
+        finally:
+            request_id_var.reset(token)
+            if request_span is not None:
+                route_path = getattr(scope.get("route"), "path", path)
+                request_span.name = f"{method} {route_path}"
+                request_span.set_attribute("http.route", route_path)
+                request_span.set_attribute("http.status_code", status_code)
+                end_request_span(request_span, span_token)
+
+        duration = (time.perf_counter() - start_time) * 1000
+        route = scope.get("route")
+        logger.info(
+            "%s %s completed in %.2f ms with status %s", method, path, duration, status_code,
+            extra={
+                "request_id": request_id,
+                "method": method,
+                "route": getattr(route, "path", path),
+                "path": path,
+                "status": status_code,
+                "duration_ms": round(duration, 3),
+                "trace_id": request_span.trace_id if request_span is not None else None,
+            },
+        )
+
+
+def _header(scope, header_name):
+    for name, value in scope["headers"]:
+        if name == header_name and value:
+            return value.decode("latin-1")
+    return None
@@ -0,0 +1,99 @@
+import asyncio
+import os
+from sqlalchemy import BigInteger, Integer, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from database import Base
+import models  # noqa: F401 - registers the tables on Base.metadata
+from logger_util import get_logger
+
+logger = get_logger(__name__)
+
+# Migrations run from the app lifespan (or once from run.py, which then turns
+# this off for its workers), never at import time.
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true"
+# How long startup waits for the schema before serving anyway; if the database
+# is down the process still boots (readiness reports 503) and keeps retrying.
+DB_MIGRATE_STARTUP_WAIT = float(os.getenv("DB_MIGRATE_STARTUP_WAIT", "30"))
+DB_MIGRATE_RETRY_INTERVAL = float(os.getenv("DB_MIGRATE_RETRY_INTERVAL", "10"))
+
+
+def _add_missing_columns(connection):
+    """Adds nullable columns introduced after a table was first created.
+
+    create_all only creates missing tables, so columns added to an existing
+    model (e.g. files.checksum) would otherwise never reach databases that
+    already have the table.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            logger.info("Adding column %s.%s (%s)", table.name, column.name, column_type)
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def _integer_columns_to_widen(inspector):
+    """(table, column) pairs declared BigInteger that the database still stores as a 32-bit integer"""
+    narrow = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"]: column["type"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            current = existing.get(column.name)
+            if (isinstance(column.type, BigInteger) and isinstance(current, Integer)
+                    and not isinstance(current, BigInteger)):
+                narrow.append((table.name, column.name))
+    return narrow
+
+
+def _widen_integer_columns(connection):
+    """Turns Integer columns that became BigInteger (e.g. files.size) into BIGINT.
+
+    SQLite integers are already 64-bit and it cannot alter a column type, so
+    only other databases are changed.
+    """
+    if connection.dialect.name == "sqlite":
+        return
+    for table_name, column_name in _integer_columns_to_widen(inspect(connection)):
+        logger.info("Widening column %s.%s to BIGINT", table_name, column_name)
+        connection.execute(text(f'ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE BIGINT'))
+
+
+def _add_missing_indexes(connection):
+    """Creates indexes declared on models after their table already existed"""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s on %s", index.name, table.name)
+                index.create(bind=connection)
+
+
+def apply_migrations(engine):
+    """Creates missing tables, columns and indexes and widens 32-bit size columns; safe to run on every start"""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        _add_missing_columns(connection)
+        _widen_integer_columns(connection)
+        _add_missing_indexes(connection)
+
+
+async def apply_migrations_with_retry(engine, retry_interval=None):
+    """Runs apply_migrations off the event loop until the database accepts it"""
+    retry_interval = retry_interval or DB_MIGRATE_RETRY_INTERVAL
+    while True:
+        try:
+            await asyncio.to_thread(apply_migrations, engine)
+            return
+        except SQLAlchemyError as e:
+            logger.error("Migrations failed, retrying in %ss: %s", retry_interval, e)
+            await asyncio.sleep(retry_interval)
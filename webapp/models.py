@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Integer, DateTime, String
+from sqlalchemy import BigInteger, Column, Integer, DateTime, String, Index, Text
 from database import Base
 import datetime
 
 
+def utc_isoformat(value):
+    """ISO 8601 text with a +00:00 offset for a naive UTC timestamp column value"""
+    return value.replace(tzinfo=datetime.timezone.utc).isoformat()
+
+
 class HealthCheck(Base):
     __tablename__ = "health_checks"
 
@@ -16,5 +21,148 @@ class FileMetadata(Base):
     id = Column(String, primary_key=True)
     file_name = Column(String, nullable=False)
     url = Column(String, nullable=False)  # S3 object key, not full URL
-    size = Column(Integer, nullable=False)  # File size in bytes
-    upload_date = Column(DateTime, nullable=False)  # Upload timestamp
\ No newline at end of file
+    size = Column(BigInteger, nullable=False)  # File size in bytes; uploads may exceed 2 GiB
+    upload_date = Column(DateTime, nullable=False)  # Upload timestamp, naive UTC; serialize with utc_isoformat
+    checksum = Column(String, nullable=True)  # "<algorithm>:<hex digest>" computed during upload
+    s3_key = Column(String, nullable=True)  # Object holding the bytes; NULL on older rows, where it is file_name
+    content_hash = Column(String, nullable=True)  # Set when the object is shared through content_blobs
+
+    __table_args__ = (
+        # Keyset pagination for GET /v1/files walks (upload_date, id) in order
+        Index("ix_files_upload_date_id", "upload_date", "id"),
+        # The outbox reconciler and orphan sweep look rows up by object key
+        Index("ix_files_s3_key", "s3_key"),
+        Index("ix_files_file_name", "file_name"),
+        # ref_count reconciliation counts rows per content hash
+        Index("ix_files_content_hash", "content_hash"),
+    )
+
+    @property
+    def object_key(self):
+        return self.s3_key or self.file_name
+
+
+class ContentBlob(Base):
+    """One stored S3 object per distinct content, shared by every files row with that content.
+
+    ref_count is the number of files rows pointing at the object; the object
+    is deleted from S3 when the last of them is deleted. A reference is taken
+    before the files row is inserted, so ref_count can run ahead of the rows
+    for an upload that died in between; the orphan sweep recomputes it for
+    blobs not claimed within OUTBOX_UPLOAD_GRACE.
+    """
+    __tablename__ = "content_blobs"
+
+    content_hash = Column(String, primary_key=True)  # "sha256:<hex digest>"
+    s3_key = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)  # Last time an upload took a reference
+
+
+class IdempotencyKey(Base):
+    """Outcome of a POST /v1/file sent with an Idempotency-Key header.
+
+    The row is inserted before the upload starts, so a concurrent retry with
+    the same key sees it in progress; the response is stored in the same
+    transaction as the files row and replayed for later retries.
+    """
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    file_id = Column(String, nullable=False)
+    response = Column(Text, nullable=True)  # JSON body of the 201; NULL while the upload is running
+    fingerprint = Column(String, nullable=True)  # request_fingerprint() of the request that reserved the key
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_idempotency_keys_created_at", "created_at"),
+    )
+
+
+class UploadSession(Base):
+    """A resumable upload backed by an open S3 multipart upload.
+
+    The session id becomes the file id once the upload is completed.
+    Sessions idle past expires_at are aborted by the reaper in upload_sessions.py.
+    """
+    __tablename__ = "upload_sessions"
+
+    id = Column(String, primary_key=True)
+    s3_key = Column(String, nullable=False)
+    upload_id = Column(String, nullable=False)  # S3 multipart upload id
+    size = Column(BigInteger, nullable=False)  # Total bytes the client declared
+    part_size = Column(Integer, nullable=False)
+    content_type = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_upload_sessions_expires_at", "expires_at"),
+    )
+
+
+
+class DirectUpload(Base):
+    """A presigned upload issued by POST /v1/uploads and not yet completed.
+
+    Completion and abort use the key recorded here, not a name sent by the
+    client. Rows left past expires_at are removed by the reaper in upload_sessions.py.
+    """
+    __tablename__ = "direct_uploads"
+
+    id = Column(String, primary_key=True)  # Becomes the file id
+    s3_key = Column(String, nullable=False)
+    upload_id = Column(String, nullable=True)  # S3 multipart upload id; NULL for presigned POST uploads
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_direct_uploads_expires_at", "expires_at"),
+    )
+
+class UploadSessionPart(Base):
+    """One part of an upload session that S3 has acknowledged"""
+    __tablename__ = "upload_session_parts"
+
+    session_id = Column(String, primary_key=True)
+    part_number = Column(Integer, primary_key=True)
+    etag = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+
+
+class PendingS3Operation(Base):
+    """Outbox row for an S3 object that should be deleted once nothing references it.
+
+    Written in the same transaction as the database change that made the
+    object redundant (or, for uploads, just before the object is written) and
+    worked off by the reconciler in outbox.py.
+    """
+    __tablename__ = "pending_s3_operations"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    s3_key = Column(String, nullable=False)
+    reason = Column(String, nullable=False)  # upload_intent | file_deleted | upload_rejected | unreferenced_blob | orphan
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_pending_s3_operations_next_attempt_at", "next_attempt_at"),
+        Index("ix_pending_s3_operations_s3_key", "s3_key"),
+    )
+
+
+class JobLease(Base):
+    """Time-limited lease that lets one process run a periodic job for all workers.
+
+    A process runs the job only if it can insert the row or take it over
+    once expires_at has passed.
+    """
+    __tablename__ = "job_leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)  # "<hostname>:<pid>" of the last process to run the job
+    expires_at = Column(DateTime, nullable=False)
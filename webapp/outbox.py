@@ -0,0 +1,331 @@
+# outbox.py
+#
+# Transactional outbox for S3 deletes. Instead of calling S3 inline and
+# compensating when the database step fails, request handlers write a
+# pending_s3_operations row in the same transaction as their database change
+# and return. A background reconciler deletes the objects in batches, and
+# re-checks before each delete that no files or content_blobs row still
+# points at the key, so a stale or duplicate entry can never remove live data.
+#
+# Uploads record an "upload_intent" row just before their object becomes
+# visible in S3 and drop it in the transaction that inserts the files row.
+# If that insert fails, or the process dies in between, the intent comes due
+# after OUTBOX_UPLOAD_GRACE seconds and the orphaned object is removed.
+#
+# Several workers may pick up the same rows; S3 deletes are idempotent, so
+# that only costs a duplicate request.
+#
+# Deduplicated uploads take their content_blobs reference before the files
+# insert commits. The orphan sweep therefore also recomputes ref_count from
+# the files rows for blobs nobody has claimed within the grace period, and
+# queues the objects of blobs that turn out to be unreferenced. Every worker
+# schedules the sweep, but a job_leases row lets only one process per
+# ORPHAN_SWEEP_INTERVAL actually list the bucket.
+import asyncio
+import datetime
+import os
+import socket
+import time
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from database import AsyncSessionLocal
+from models import ContentBlob, FileMetadata, JobLease, PendingS3Operation
+from s3_service import S3_BUCKET_NAME, delete_files_from_s3_async, get_s3_client, run_in_s3_executor
+from logger_util import get_logger
+from metrics import record_db_metric, record_outbox_metric, record_s3_metric
+
+logger = get_logger(__name__)
+
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "1000"))
+# Longest an upload may take between its object appearing in S3 and its files
+# row being committed; upload intents and orphan candidates younger than this
+# are left alone
+OUTBOX_UPLOAD_GRACE = float(os.getenv("OUTBOX_UPLOAD_GRACE", "3600"))
+# How often the bucket is listed for objects without a files row; 0 disables
+ORPHAN_SWEEP_INTERVAL = float(os.getenv("ORPHAN_SWEEP_INTERVAL", "86400"))
+
+ORPHAN_SWEEP_LEASE = "orphan_sweep"
+# A lease runs a little short of the interval, so the process holding it is
+# not locked out of its own next run by timer drift
+_LEASE_FRACTION = 0.9
+
+OUTBOX_RETRY_BASE = 5
+OUTBOX_RETRY_MAX = 3600
+# Keeps IN (...) lists well under driver bind-parameter limits
+_KEY_CHUNK = 1000
+
+_wakeup = None
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def notify():
+    """Wakes this process's reconciler so newly committed deletes run promptly"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def enqueue_delete(db, s3_key, reason="file_deleted"):
+    """Schedules `s3_key` for deletion inside the caller's transaction; call notify() after commit"""
+    db.add(PendingS3Operation(s3_key=s3_key, reason=reason, next_attempt_at=_utcnow()))
+
+
+async def record_upload_intent(s3_key):
+    """Commits an intent to delete `s3_key` unless an upload claims it within the grace period.
+
+    Returns the intent id, which the upload passes to clear_upload_intent in
+    the transaction that inserts its files row.
+    """
+    db_start = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        intent = PendingS3Operation(
+            s3_key=s3_key, reason="upload_intent",
+            next_attempt_at=_utcnow() + datetime.timedelta(seconds=OUTBOX_UPLOAD_GRACE),
+        )
+        db.add(intent)
+        await db.commit()
+    record_db_metric("outbox_upload_intent", (time.perf_counter() - db_start) * 1000)
+    return intent.id
+
+
+async def release_upload_intent(intent_id):
+    """Makes an intent due now, for an upload that will never claim its object"""
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(PendingS3Operation)
+                .where(PendingS3Operation.id == intent_id)
+                .values(next_attempt_at=_utcnow())
+            )
+            await db.commit()
+        notify()
+    except Exception as e:
+        # The intent still comes due after OUTBOX_UPLOAD_GRACE
+        logger.error("Failed to release upload intent %s: %s", intent_id, e)
+
+
+async def clear_upload_intent(db, intent_id):
+    """Drops an upload intent inside the caller's transaction"""
+    await db.execute(delete(PendingS3Operation).where(PendingS3Operation.id == intent_id))
+
+
+async def referenced_keys(db, keys):
+    """The subset of `keys` that a files or content_blobs row still points at"""
+    referenced = set()
+    for chunk in _chunks(list(keys), _KEY_CHUNK):
+        files = await db.execute(
+            select(FileMetadata.s3_key, FileMetadata.file_name).where(or_(
+                FileMetadata.s3_key.in_(chunk),
+                and_(FileMetadata.s3_key.is_(None), FileMetadata.file_name.in_(chunk)),
+            ))
+        )
+        referenced.update(s3_key or file_name for s3_key, file_name in files.tuples())
+        blobs = await db.execute(select(ContentBlob.s3_key).where(ContentBlob.s3_key.in_(chunk)))
+        referenced.update(blobs.scalars())
+    return referenced
+
+
+def _retry_delay(attempts):
+    return min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+
+
+async def process_pending_operations(batch_size=None):
+    """Works off one batch of due operations and returns how many were due"""
+    batch_size = batch_size or OUTBOX_BATCH_SIZE
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(PendingS3Operation)
+            .where(PendingS3Operation.next_attempt_at <= _utcnow())
+            .order_by(PendingS3Operation.next_attempt_at)
+            .limit(batch_size)
+        )
+        operations = result.scalars().all()
+        if not operations:
+            return 0
+        keys = {operation.s3_key for operation in operations}
+        # A key that is referenced again (a committed upload, a shared blob) is kept
+        to_delete = sorted(keys - await referenced_keys(db, keys))
+
+    s3_start = time.perf_counter()
+    errors = await delete_files_from_s3_async(to_delete) if to_delete else {}
+    record_s3_metric("outbox_delete", (time.perf_counter() - s3_start) * 1000)
+
+    done = [operation.id for operation in operations if operation.s3_key not in errors]
+    failed = [operation for operation in operations if operation.s3_key in errors]
+    async with AsyncSessionLocal() as db:
+        for chunk in _chunks(done, _KEY_CHUNK):
+            await db.execute(delete(PendingS3Operation).where(PendingS3Operation.id.in_(chunk)))
+        for operation in failed:
+            attempts = operation.attempts + 1
+            await db.execute(
+                update(PendingS3Operation)
+                .where(PendingS3Operation.id == operation.id)
+                .values(
+                    attempts=attempts,
+                    next_attempt_at=_utcnow() + datetime.timedelta(seconds=_retry_delay(attempts)),
+                    last_error=errors[operation.s3_key][:1000],
+                )
+            )
+        await db.commit()
+
+    deleted = len(to_delete) - len(errors)
+    record_outbox_metric("deleted", deleted)
+    record_outbox_metric("skipped", len(keys) - len(to_delete))
+    record_outbox_metric("failed", len(failed))
+    for operation in failed:
+        logger.error("Outbox delete of %s failed (attempt %s): %s",
+                     operation.s3_key, operation.attempts + 1, errors[operation.s3_key])
+    if deleted:
+        logger.info("Outbox deleted %s objects", deleted)
+    return len(operations)
+
+
+def _list_page(continuation_token):
+    params = {"ContinuationToken": continuation_token} if continuation_token else {}
+    return get_s3_client().list_objects_v2(Bucket=S3_BUCKET_NAME, **params)
+
+
+async def sweep_orphaned_objects():
+    """Schedules deletion of objects older than the upload grace period that no row points at"""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=OUTBOX_UPLOAD_GRACE)
+    enqueued = 0
+    continuation_token = None
+    while True:
+        page = await run_in_s3_executor(_list_page, continuation_token)
+        candidates = [obj["Key"] for obj in page.get("Contents", []) if obj["LastModified"] < cutoff]
+        if candidates:
+            async with AsyncSessionLocal() as db:
+                pending = await db.execute(
+                    select(PendingS3Operation.s3_key).where(PendingS3Operation.s3_key.in_(candidates))
+                )
+                skip = await referenced_keys(db, candidates) | set(pending.scalars())
+                orphans = [key for key in candidates if key not in skip]
+                for key in orphans:
+                    enqueue_delete(db, key, reason="orphan")
+                await db.commit()
+            enqueued += len(orphans)
+        if not page.get("IsTruncated"):
+            break
+        continuation_token = page["NextContinuationToken"]
+    if enqueued:
+        logger.warning("Orphan sweep found %s objects without a files row; scheduled for deletion", enqueued)
+        record_outbox_metric("orphans", enqueued)
+        notify()
+    return enqueued
+
+
+async def reconcile_blob_ref_counts():
+    """Resets content_blobs.ref_count to the number of files rows using each blob.
+
+    Only blobs last claimed before the upload grace period are touched, so a
+    reference taken by an upload that is still inserting its files row is
+    never undone. Blobs left with no references are dropped and their objects
+    queued for deletion. Returns the number of blobs corrected.
+    """
+    settled_before = _utcnow() - datetime.timedelta(seconds=OUTBOX_UPLOAD_GRACE)
+    files_count = (
+        select(func.count(FileMetadata.id))
+        .where(FileMetadata.content_hash == ContentBlob.content_hash)
+        .scalar_subquery()
+    )
+    db_start = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(ContentBlob)
+            .where(
+                ContentBlob.ref_count != files_count,
+                or_(ContentBlob.claimed_at.is_(None), ContentBlob.claimed_at < settled_before),
+            )
+            .values(ref_count=files_count)
+            .returning(ContentBlob.content_hash, ContentBlob.s3_key, ContentBlob.ref_count)
+            .execution_options(synchronize_session=False)
+        )
+        corrected = result.all()
+        unreferenced = [(content_hash, s3_key) for content_hash, s3_key, ref_count in corrected if ref_count <= 0]
+        for chunk in _chunks(unreferenced, _KEY_CHUNK):
+            await db.execute(
+                delete(ContentBlob)
+                .where(ContentBlob.content_hash.in_([content_hash for content_hash, _ in chunk]))
+                .execution_options(synchronize_session=False)
+            )
+        for _, s3_key in unreferenced:
+            enqueue_delete(db, s3_key, reason="unreferenced_blob")
+        await db.commit()
+    record_db_metric("reconcile_blob_ref_counts", (time.perf_counter() - db_start) * 1000)
+    if corrected:
+        logger.warning("Corrected ref_count of %s content blobs; %s had no files left", len(corrected), len(unreferenced))
+        record_outbox_metric("blob_ref_counts_corrected", len(corrected))
+    if unreferenced:
+        notify()
+    return len(corrected)
+
+
+async def outbox_reconciler_job(interval=None):
+    """Background task that works off the outbox, woken early by notify()"""
+    global _wakeup
+    interval = interval or OUTBOX_POLL_INTERVAL
+    _wakeup = asyncio.Event()
+    while True:
+        _wakeup.clear()
+        try:
+            while await process_pending_operations() >= OUTBOX_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logger.error("Outbox reconciler run failed: %s", e)
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def acquire_lease(name, seconds):
+    """Takes the named job lease for `seconds` unless another process holds it; returns True on success"""
+    now = _utcnow()
+    holder = f"{socket.gethostname()}:{os.getpid()}"
+    expires_at = now + datetime.timedelta(seconds=seconds)
+    async with AsyncSessionLocal() as db:
+        db.add(JobLease(name=name, holder=holder, expires_at=expires_at))
+        try:
+            await db.commit()
+            return True
+        except IntegrityError:
+            await db.rollback()
+        # A single conditional UPDATE, so of several processes only one takes over
+        result = await db.execute(
+            update(JobLease)
+            .where(JobLease.name == name, JobLease.expires_at <= now)
+            .values(holder=holder, expires_at=expires_at)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        return result.rowcount == 1
+
+
+async def run_orphan_sweep(interval=None):
+    """Reconciles blob ref_counts and sweeps the bucket if this process wins the lease for this interval"""
+    interval = interval or ORPHAN_SWEEP_INTERVAL
+    if not await acquire_lease(ORPHAN_SWEEP_LEASE, interval * _LEASE_FRACTION):
+        logger.debug("Orphan sweep already ran in another process this interval")
+        return False
+    await reconcile_blob_ref_counts()
+    await sweep_orphaned_objects()
+    return True
+
+
+async def orphan_sweep_job(interval=None):
+    """Background task that periodically runs run_orphan_sweep"""
+    interval = interval or ORPHAN_SWEEP_INTERVAL
+    while True:
+        # Not at startup, so restarting workers does not list the bucket each time
+        await asyncio.sleep(interval)
+        try:
+            await run_orphan_sweep(interval)
+        except Exception as e:
+            logger.error("Orphan sweep failed: %s", e)
@@ -18,6 +18,10 @@ Environment="PATH=/opt/csye6225/webapp/venv/bin"
 ExecStart=/opt/csye6225/webapp/venv/bin/python3 /opt/csye6225/webapp/run.py
 Restart=always
 RestartSec=5
+# SIGTERM goes to the server supervisor only; it drains the workers
+# (GRACEFUL_SHUTDOWN_TIMEOUT, 60s by default) before systemd escalates
+KillMode=mixed
+TimeoutStopSec=75
 StandardOutput=syslog
 StandardError=syslog
 SyslogIdentifier=csye6225
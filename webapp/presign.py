@@ -0,0 +1,77 @@
+# presign.py
+#
+# Presigned S3 URLs so clients move file bytes to and from S3 directly
+# instead of through this process. Signing is local (no S3 round trip); it
+# runs on the S3 pool only because a credential refresh may hit the network.
+# Download URLs are cached per key and reused until shortly before they expire.
+import math
+import os
+from cache import LRUTTLCache
+from s3_service import S3_BUCKET_NAME, S3_PART_SIZE, get_s3_client, run_in_s3_executor
+
+# Lifetime of upload URLs (single POST and per-part PUTs)
+PRESIGN_UPLOAD_EXPIRY = int(os.getenv("PRESIGN_UPLOAD_EXPIRY", "3600"))
+# Lifetime of GET /v1/file/{id}?presign=true download URLs
+PRESIGN_DOWNLOAD_EXPIRY = int(os.getenv("PRESIGN_DOWNLOAD_EXPIRY", "300"))
+# A cached download URL is only handed out while it has at least this many seconds left
+PRESIGN_REFRESH_MARGIN = int(os.getenv("PRESIGN_REFRESH_MARGIN", "60"))
+PRESIGN_CACHE_MAX_ENTRIES = int(os.getenv("PRESIGN_CACHE_MAX_ENTRIES", "10000"))
+
+# Uploads at or above this size get presigned multipart part URLs
+PRESIGN_MULTIPART_THRESHOLD = S3_PART_SIZE
+S3_MAX_PARTS = 10000
+
+download_url_cache = LRUTTLCache("presign", PRESIGN_CACHE_MAX_ENTRIES, PRESIGN_CACHE_MAX_ENTRIES * 2048)
+
+
+def part_size_for(size):
+    """Smallest part size >= S3_PART_SIZE that keeps the upload within S3's part limit"""
+    return max(S3_PART_SIZE, math.ceil(size / S3_MAX_PARTS))
+
+
+async def presign_post(s3_key, size, content_type=None, expires_in=None):
+    """Presigned POST form for a single-request upload of exactly `size` bytes"""
+    fields = {"Content-Type": content_type} if content_type else None
+    conditions = [["content-length-range", size, size]]
+    if content_type:
+        conditions.append({"Content-Type": content_type})
+    return await run_in_s3_executor(
+        get_s3_client().generate_presigned_post,
+        Bucket=S3_BUCKET_NAME, Key=s3_key, Fields=fields, Conditions=conditions,
+        ExpiresIn=expires_in or PRESIGN_UPLOAD_EXPIRY,
+    )
+
+
+def _presign_parts(s3_key, upload_id, part_count, expires_in):
+    client = get_s3_client()
+    return [
+        {
+            "part_number": part_number,
+            "url": client.generate_presigned_url(
+                "upload_part",
+                Params={"Bucket": S3_BUCKET_NAME, "Key": s3_key, "UploadId": upload_id, "PartNumber": part_number},
+                ExpiresIn=expires_in,
+            ),
+        }
+        for part_number in range(1, part_count + 1)
+    ]
+
+
+async def presign_parts(s3_key, upload_id, part_count, expires_in=None):
+    """Presigned PUT URL for every part of a multipart upload"""
+    return await run_in_s3_executor(_presign_parts, s3_key, upload_id, part_count, expires_in or PRESIGN_UPLOAD_EXPIRY)
+
+
+async def presign_download(s3_key):
+    """Short-lived GET URL for `s3_key`, reused from the cache while it is fresh enough"""
+    found, url = await download_url_cache.get(s3_key)
+    if found:
+        return url
+    url = await run_in_s3_executor(
+        get_s3_client().generate_presigned_url,
+        "get_object", Params={"Bucket": S3_BUCKET_NAME, "Key": s3_key}, ExpiresIn=PRESIGN_DOWNLOAD_EXPIRY,
+    )
+    reuse_for = PRESIGN_DOWNLOAD_EXPIRY - PRESIGN_REFRESH_MARGIN
+    if reuse_for > 0:
+        await download_url_cache.set(s3_key, url, reuse_for)
+    return url
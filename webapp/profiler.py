@@ -0,0 +1,63 @@
+# profiler.py
+#
+# Opt-in sampling profiler. While a profile runs, a background thread wakes
+# every PROFILE_SAMPLE_INTERVAL seconds, takes the stack of every other thread
+# from sys._current_frames() and counts identical stacks. The result is in
+# the collapsed format ("thread;outer;...;inner count" per line) read by
+# flamegraph.pl, speedscope and inferno. Sampling only reads frames, so the
+# profiled code runs unmodified; the cost is one stack walk per thread per tick.
+import collections
+import os
+import sys
+import threading
+import time
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# Only one profile at a time: concurrent samplers would distort each other
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running"""
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(thread_name, frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+def sample_stacks(seconds, interval=None):
+    """Samples every thread's stack for `seconds` and returns a Counter of collapsed stacks"""
+    interval = interval or PROFILE_SAMPLE_INTERVAL
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusyError("A profile is already running")
+    try:
+        own_thread = threading.get_ident()
+        stacks = collections.Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    stacks[_collapse(names.get(thread_id, str(thread_id)), frame)] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profile_lock.release()
+
+
+def collapsed_text(stacks):
+    """Renders sampled stacks in the collapsed flamegraph format, hottest first"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+import os
+import time
+from sqlalchemy import delete, select, text
+import models
+from database import AsyncSessionLocal
+from logger_util import get_logger
+from metrics import record_db_metric, record_s3_metric
+import s3_service
+
+logger = get_logger(__name__)
+
+# "ping" runs SELECT 1; "insert" keeps the original behaviour of writing a
+# health_checks row per check (still rate limited by the cache interval).
+HEALTHZ_MODE = os.getenv("HEALTHZ_MODE", "ping").lower()
+# Probes within this many seconds share the last result instead of hitting the DB
+HEALTHZ_CACHE_SECONDS = float(os.getenv("HEALTHZ_CACHE_SECONDS", "2"))
+HEALTHZ_CHECK_S3 = os.getenv("HEALTHZ_CHECK_S3", "false").lower() == "true"
+
+# health_checks retention, enforced by a background job
+HEALTH_CHECK_RETENTION_HOURS = float(os.getenv("HEALTH_CHECK_RETENTION_HOURS", "24"))
+HEALTH_CHECK_PRUNE_INTERVAL = float(os.getenv("HEALTH_CHECK_PRUNE_INTERVAL", "600"))
+HEALTH_CHECK_PRUNE_BATCH = 5000
+
+
+async def check_database():
+    async with AsyncSessionLocal() as db:
+        db_start = time.perf_counter()
+        if HEALTHZ_MODE == "insert":
+            db.add(models.HealthCheck())
+            await db.commit()
+        else:
+            await db.execute(text("SELECT 1"))
+        record_db_metric("get_healthz", (time.perf_counter() - db_start) * 1000)
+
+
+async def check_s3():
+    s3_start = time.perf_counter()
+    await s3_service.run_in_s3_executor(s3_service.get_s3_client().head_bucket, Bucket=s3_service.S3_BUCKET_NAME)
+    record_s3_metric("healthz", (time.perf_counter() - s3_start) * 1000)
+
+
+async def run_checks():
+    await check_database()
+    if HEALTHZ_CHECK_S3:
+        await check_s3()
+
+
+class ReadinessProbe:
+    """Caches the readiness result and collapses concurrent probes into one check.
+
+    Load balancer probes arriving while a check is running wait for that
+    check instead of starting their own, and results are reused for
+    `interval` seconds.
+    """
+
+    def __init__(self, check, interval, clock=time.monotonic):
+        self._check = check
+        self.interval = interval
+        self._clock = clock
+        self._result = None
+        self._expires_at = 0.0
+        self._inflight = None
+
+    def reset(self):
+        self._result = None
+        self._expires_at = 0.0
+        self._inflight = None
+
+    async def is_ready(self):
+        if self._result is not None and self._clock() < self._expires_at:
+            return self._result
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._run())
+        # shield: a probe that disconnects must not cancel the check others are waiting on
+        return await asyncio.shield(self._inflight)
+
+    async def _run(self):
+        try:
+            await self._check()
+            ready = True
+        except Exception as e:
+            logger.error("Readiness check failed: %s", e, exc_info=True)
+            ready = False
+        self._result = ready
+        self._expires_at = self._clock() + self.interval
+        self._inflight = None
+        return ready
+
+
+readiness_probe = ReadinessProbe(run_checks, HEALTHZ_CACHE_SECONDS)
+
+
+async def prune_health_checks(retention_hours=None):
+    """Deletes health_checks rows older than the retention window, in batches"""
+    retention_hours = HEALTH_CHECK_RETENTION_HOURS if retention_hours is None else retention_hours
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=retention_hours)
+    deleted = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            batch = (
+                select(models.HealthCheck.id)
+                .where(models.HealthCheck.datetime < cutoff)
+                .limit(HEALTH_CHECK_PRUNE_BATCH)
+                .scalar_subquery()
+            )
+            result = await db.execute(delete(models.HealthCheck).where(models.HealthCheck.id.in_(batch)))
+            await db.commit()
+            deleted += result.rowcount
+            if result.rowcount < HEALTH_CHECK_PRUNE_BATCH:
+                break
+    if deleted:
+        logger.info("Pruned %s health_checks rows older than %sh", deleted, retention_hours)
+    return deleted
+
+
+async def health_check_retention_job(interval=None):
+    """Background task that keeps health_checks bounded"""
+    interval = interval or HEALTH_CHECK_PRUNE_INTERVAL
+    while True:
+        try:
+            await prune_health_checks()
+        except Exception as e:
+            logger.error("health_checks retention run failed: %s", e)
+        await asyncio.sleep(interval)
@@ -0,0 +1,240 @@
+import base64
+import datetime
+import json
+from fastapi import APIRouter, Request
+from pydantic import ValidationError
+from starlette import status
+from starlette.responses import Response, StreamingResponse
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from database import AsyncSessionLocal
+from models import FileMetadata
+from cache import metadata_cache, METADATA_CACHE_TTL, METADATA_CACHE_NEGATIVE_TTL, METADATA_CACHE_TOMBSTONE_TTL
+from routers.files import file_metadata_payload
+from dedup import release_blob
+from outbox import enqueue_delete, notify as notify_outbox
+from schemas import FileBatchRequest, FileBulkDeleteRequest
+from logger_util import get_logger
+from metrics import record_api_metric, record_db_metric
+import time
+
+router = APIRouter()
+logger = get_logger(__name__)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Keeps IN (...) lists well under driver bind-parameter limits
+DB_ID_CHUNK = 1000
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def encode_cursor(file_record):
+    """Opaque cursor pointing just after `file_record` in (upload_date, id) order"""
+    raw = json.dumps([file_record.upload_date.isoformat(), file_record.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    upload_date, file_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    return datetime.datetime.fromisoformat(upload_date), str(file_id)
+
+
+@router.post("/v1/files/batch", status_code=status.HTTP_200_OK)
+async def batch_get_files(request: Request):
+    """Resolves metadata for many file ids with a single indexed IN query"""
+    start_time = time.perf_counter()
+    try:
+        batch = FileBatchRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        logger.warning("Invalid batch lookup request: %s validation errors", e.error_count())
+        record_api_metric("batch_get_files", (time.perf_counter() - start_time) * 1000)
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+    ids = list(dict.fromkeys(batch.ids))  # de-duplicate, keep request order
+    found = {}
+    misses = []
+    for file_id in ids:
+        hit, payload = await metadata_cache.get(file_id)
+        if not hit:
+            misses.append(file_id)
+        elif payload is not None:
+            found[file_id] = payload
+
+    if misses:
+        try:
+            db_start = time.perf_counter()
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(select(FileMetadata).where(FileMetadata.id.in_(misses)))
+                records = result.scalars().all()
+            record_db_metric("batch_get_files", (time.perf_counter() - db_start) * 1000)
+        except SQLAlchemyError as db_err:
+            logger.error("Database connectivity error: %s", db_err)
+            record_api_metric("batch_get_files", (time.perf_counter() - start_time) * 1000)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        for record in records:
+            found[record.id] = file_metadata_payload(record)
+            await metadata_cache.set(record.id, found[record.id], METADATA_CACHE_TTL)
+        for file_id in misses:
+            if file_id not in found:
+                await metadata_cache.set(file_id, None, METADATA_CACHE_NEGATIVE_TTL)
+
+    record_api_metric("batch_get_files", (time.perf_counter() - start_time) * 1000)
+    return {
+        "files": [found[file_id] for file_id in ids if file_id in found],
+        "missing": [file_id for file_id in ids if file_id not in found],
+    }
+
+
+async def _stream_page(db, result, first, limit, start_time):
+    """Yields one JSON document, a row at a time, ending with the next-page cursor.
+
+    The caller has already run the query and fetched `first`, so a database
+    that is down is answered with a 503 before any byte is sent. One extra row
+    is fetched to learn whether another page exists; rows are emitted one
+    behind so the look-ahead row is never sent.
+    """
+    previous = first
+    emitted = 0
+    next_cursor = None
+    try:
+        yield b'{"files": ['
+        if previous is not None:
+            async for record in result:
+                yield (b"," if emitted else b"") + json.dumps(file_metadata_payload(previous)).encode()
+                emitted += 1
+                if emitted == limit:
+                    next_cursor = encode_cursor(previous)
+                    break
+                previous = record
+            else:
+                yield (b"," if emitted else b"") + json.dumps(file_metadata_payload(previous)).encode()
+        yield b'], "next_cursor": ' + json.dumps(next_cursor).encode() + b"}"
+    except SQLAlchemyError as db_err:
+        # The 200 is already sent; ending here leaves the client an incomplete document
+        logger.error("Database error while streaming the file listing: %s", db_err)
+    finally:
+        await result.close()
+        await db.close()
+        record_db_metric("list_files", (time.perf_counter() - start_time) * 1000)
+        record_api_metric("list_files", (time.perf_counter() - start_time) * 1000)
+
+
+@router.get("/v1/files", status_code=status.HTTP_200_OK)
+async def list_files(request: Request):
+    """Keyset-paginated listing ordered by (upload_date, id)"""
+    start_time = time.perf_counter()
+    params = request.query_params
+    if set(params) - {"limit", "cursor"} or await request.body():
+        record_api_metric("list_files", (time.perf_counter() - start_time) * 1000)
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = int(params.get("limit", DEFAULT_PAGE_SIZE))
+        after = decode_cursor(params["cursor"]) if params.get("cursor") else None
+    except (ValueError, TypeError):
+        record_api_metric("list_files", (time.perf_counter() - start_time) * 1000)
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        record_api_metric("list_files", (time.perf_counter() - start_time) * 1000)
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+    statement = select(FileMetadata).order_by(FileMetadata.upload_date, FileMetadata.id).limit(limit + 1)
+    if after is not None:
+        statement = statement.where(tuple_(FileMetadata.upload_date, FileMetadata.id) > tuple_(*after))
+
+    db = AsyncSessionLocal()
+    try:
+        result = await db.stream_scalars(statement)
+        first = await anext(result, None)
+    except SQLAlchemyError as db_err:
+        await db.close()
+        logger.error("Database connectivity error: %s", db_err)
+        record_api_metric("list_files", (time.perf_counter() - start_time) * 1000)
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    # The session and metrics are closed out by the generator once the body is sent
+    return StreamingResponse(_stream_page(db, result, first, limit, start_time), media_type="application/json")
+
+
+@router.post("/v1/files/delete", status_code=status.HTTP_200_OK)
+async def bulk_delete_files(request: Request):
+    """Deletes many files in one DB transaction and queues their S3 objects.
+
+    The rows, the blob references of deduplicated rows and one outbox entry
+    per object that is no longer referenced are written together; the outbox
+    reconciler then removes the objects with batched DeleteObjects calls.
+    Returns a result per requested id.
+    """
+    start_time = time.perf_counter()
+    try:
+        bulk = FileBulkDeleteRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        logger.warning("Invalid bulk delete request: %s validation errors", e.error_count())
+        record_api_metric("bulk_delete_files", (time.perf_counter() - start_time) * 1000)
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+    ids = list(dict.fromkeys(bulk.ids))
+    results = {file_id: {"id": file_id, "status": "not_found"} for file_id in ids}
+    try:
+        db_start = time.perf_counter()
+        keys = []
+        shared = []
+        deleted_ids = []
+        async with AsyncSessionLocal() as db:
+            # DELETE ... RETURNING: only rows this transaction actually removed
+            # are released, so a concurrent delete of the same id cannot drop
+            # a blob reference twice
+            for chunk in _chunks(ids, DB_ID_CHUNK):
+                rows = await db.execute(
+                    delete(FileMetadata)
+                    .where(FileMetadata.id.in_(chunk))
+                    .returning(FileMetadata.id, FileMetadata.file_name, FileMetadata.s3_key, FileMetadata.content_hash)
+                    .execution_options(synchronize_session=False)
+                )
+                for file_id, file_name, s3_key, content_hash in rows.tuples():
+                    deleted_ids.append(file_id)
+                    if content_hash:
+                        shared.append(content_hash)
+                    else:
+                        keys.append(s3_key or file_name)
+            for content_hash in shared:
+                unreferenced_key = await release_blob(db, content_hash)
+                if unreferenced_key:
+                    keys.append(unreferenced_key)
+            for s3_key in keys:
+                enqueue_delete(db, s3_key)
+            await db.commit()
+        record_db_metric("bulk_delete_files", (time.perf_counter() - db_start) * 1000)
+    except SQLAlchemyError as db_err:
+        logger.error("Database connectivity error: %s", db_err)
+        record_api_metric("bulk_delete_files", (time.perf_counter() - start_time) * 1000)
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    notify_outbox()
+
+    for file_id in deleted_ids:
+        results[file_id] = {"id": file_id, "status": "deleted"}
+        await metadata_cache.invalidate(file_id, METADATA_CACHE_TOMBSTONE_TTL)
+
+    logger.info("Bulk delete: %s deleted, %s not found; %s objects queued", len(deleted_ids), len(ids) - len(deleted_ids), len(keys))
+    record_api_metric("bulk_delete_files", (time.perf_counter() - start_time) * 1000)
+    return {
+        "results": list(results.values()),
+        "deleted": len(deleted_ids),
+    }
+
+
+@router.api_route("/v1/files/delete", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def bulk_delete_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@router.api_route("/v1/files", methods=["POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def files_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@router.api_route("/v1/files/batch", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def batch_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -1,11 +1,25 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, status, Depends, Request
+from fastapi import APIRouter, HTTPException, status, Depends, Request
+from fastapi.encoders import jsonable_encoder
 from starlette import status
-from starlette.responses import Response
-from sqlalchemy.orm import Session
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, Response
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
 from database import get_db
-from models import FileMetadata
-from s3_service import upload_file_to_s3, delete_file_from_s3
+from models import FileMetadata, utc_isoformat
+from s3_service import object_key_from_url
+from presign import presign_download
+from dedup import release_blob
+from outbox import clear_upload_intent, enqueue_delete, release_upload_intent, notify as notify_outbox
+from idempotency import (
+    IDEMPOTENCY_KEY_HEADER, IDEMPOTENCY_REPLAYED_HEADER, MAX_IDEMPOTENCY_KEY_LENGTH,
+    fingerprint_matches, record_response, release_key, request_fingerprint, reserve_key, stored_response,
+)
+from cache import metadata_cache, METADATA_CACHE_TTL, METADATA_CACHE_NEGATIVE_TTL, METADATA_CACHE_TOMBSTONE_TTL
+from admission import AdmissionRejected, content_length, upload_admission, rejected_response as admission_rejected_response
+import upload_stream
+from upload_stream import UploadTooLargeError, stream_upload_to_s3, upload_form_file_to_s3
 import uuid
 #import logging
 from logger_util import get_logger
@@ -18,188 +32,309 @@ router = APIRouter()
 # logger = logging.getLogger(__name__)
 logger = get_logger(__name__)
 
+
+def file_metadata_payload(file_record):
+    """JSON-ready metadata for a file, as returned by GET /v1/file/{id} and cached"""
+    return jsonable_encoder({
+        "id": file_record.id,
+        "file_name": file_record.file_name,
+        "file_url": file_record.url,  # S3 URL, not actual file content
+        "size": file_record.size,
+        "upload_date": utc_isoformat(file_record.upload_date),
+        "checksum": file_record.checksum
+    })
+
+
 @router.post("/v1/file", status_code=status.HTTP_201_CREATED)
-async def upload_file(file: UploadFile = File(None), db: Session = Depends(get_db)):
-    start_time = time.time()
+async def upload_file(request: Request, db: AsyncSession = Depends(get_db)):
+    start_time = time.perf_counter()
     """Uploads a file to S3 and returns the file URL"""
-    if file is None:
-        logger.warning("No file was provided in the request.")
+    try:
+        charge = await upload_admission.acquire(content_length(request))
+    except AdmissionRejected as e:
+        logger.warning("Upload rejected by admission control: %s", e.reason)
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        return admission_rejected_response()
+    try:
+        return await _upload_file(request, db, start_time)
+    finally:
+        upload_admission.release(charge)
+
+
+async def _upload_file(request, db, start_time):
+    """Handles an admitted upload, replaying it when its Idempotency-Key was seen before"""
+    file_id = str(uuid.uuid4())  # Generate a unique file ID
+
+    idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+    if not idempotency_key:
+        return await _store_upload(request, db, file_id, start_time)
+    if len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
         response_400 = Response(status_code=status.HTTP_400_BAD_REQUEST)
-        response_400.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_400.headers['Pragma'] = "no-cache"
         return response_400
 
-    file_id = str(uuid.uuid4())  # Generate a unique file ID
-    file_name = f"{file_id}_{file.filename}"  # Append UUID for uniqueness
+    fingerprint = request_fingerprint(request)
+    try:
+        existing = await reserve_key(idempotency_key, file_id, fingerprint)
+    except SQLAlchemyError as db_err:
+        logger.error("Database connectivity error: %s", db_err)
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        response_503 = Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return response_503
+    if existing is not None:
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        if not fingerprint_matches(existing, fingerprint):
+            logger.warning("Idempotency key %s reused for a different request", idempotency_key)
+            response_422 = Response(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            return response_422
+        if existing.response is None:
+            # The first request with this key is still uploading
+            response_409 = Response(status_code=status.HTTP_409_CONFLICT)
+            return response_409
+        logger.info("Replaying upload %s for idempotency key %s", existing.file_id, idempotency_key)
+        return JSONResponse(
+            status_code=status.HTTP_201_CREATED,
+            content=stored_response(existing),
+            headers={IDEMPOTENCY_REPLAYED_HEADER: "true"},
+        )
 
+    stored = False
     try:
-        s3_start = time.time()
-        metadata = upload_file_to_s3(file.file, file_name)
-        s3_duration = (time.time() - s3_start) * 1000
-        record_s3_metric("upload_file", s3_duration)
+        result = await _store_upload(request, db, file_id, start_time, idempotency_key)
+        # Only a successful upload returns a plain dict; its key now holds the response
+        stored = isinstance(result, dict)
+        return result
+    finally:
+        if not stored:
+            await release_key(idempotency_key)
 
+
+async def _store_upload(request, db, file_id, start_time, idempotency_key=None):
+    """Streams the request's file into S3 and records its files row"""
+    try:
+        s3_start = time.perf_counter()
+        if upload_stream.UPLOAD_STREAMING:
+            uploaded = await stream_upload_to_s3(request, file_id)
+        else:
+            uploaded = await upload_form_file_to_s3(request, file_id)
+    except UploadTooLargeError as e:
+        logger.warning("Rejected upload %s: %s", file_id, e)
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        response_413 = Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        return response_413
+    except ClientDisconnect:
+        logger.warning("Client disconnected during upload %s; S3 upload aborted.", file_id)
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        response_400 = Response(status_code=status.HTTP_400_BAD_REQUEST)
+        return response_400
+    except SQLAlchemyError as db_err:
+        # Upload intents and dedup references are written while the file streams
+        logger.error("Database error during upload %s: %s", file_id, db_err)
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        response_503 = Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return response_503
+    except Exception as e:
+        logger.warning("Upload %s failed before reaching the database: %s", file_id, e)
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        raise HTTPException(status_code=400, detail="Bad request")
+
+    if uploaded is None:
+        logger.warning("No file was provided in the request.")
+        record_api_metric("upload_file", (time.perf_counter() - start_time) * 1000)
+        response_400 = Response(status_code=status.HTTP_400_BAD_REQUEST)
+        return response_400
+
+    file_name, metadata = uploaded
+    s3_duration = (time.perf_counter() - s3_start) * 1000
+    record_s3_metric("upload_file", s3_duration)
+
+    try:
         # Store metadata in the database using `file_id` as the primary key
         file_metadata = FileMetadata(
             id=file_id,  # Using file_id as primary key
             file_name=file_name,
             url=metadata["file_url"],  # Store only the S3 key
             size=metadata["size"],
-            upload_date=metadata["upload_date"]
+            upload_date=metadata["upload_date"],
+            checksum=metadata["checksum"],
+            s3_key=metadata["s3_key"],
+            content_hash=metadata["content_hash"]
         )
-        db_start = time.time()
-        db.add(file_metadata)
-        db.commit()
-        db.refresh(file_metadata)
-        db_duration = (time.time() - db_start) * 1000
-        record_db_metric("upload_file", db_duration)
-        logger.info(f"Successfully uploaded file: {file_name}, stored in S3 and metadata in DB.")
-        logger.info(f"Successfully retrieved metadata for file ID: {id}")
-        api_duration = (time.time() - start_time) * 1000
-        record_api_metric("upload_file", api_duration)
-        return {
+        body = {
             "file_name": file_name,
             "file_id": file_id,
             "file_url": metadata["file_url"],
             "size": metadata["size"],
             #"content_type": metadata["content_type"],
-            "upload_date": metadata["upload_date"],
+            "upload_date": utc_isoformat(metadata["upload_date"]),
+            "checksum": metadata["checksum"],
             "message": "File added"
         }
+        db_start = time.perf_counter()
+        db.add(file_metadata)
+        if idempotency_key:
+            # Same transaction as the files row, so a replay never points at a missing file
+            await record_response(db, idempotency_key, body)
+        if metadata.get("outbox_id"):
+            await clear_upload_intent(db, metadata["outbox_id"])
+        await db.commit()
+        await db.refresh(file_metadata)
+        db_duration = (time.perf_counter() - db_start) * 1000
+        record_db_metric("upload_file", db_duration)
+        logger.info("Successfully uploaded file: %s, stored in S3 and metadata in DB.", file_name)
+        api_duration = (time.perf_counter() - start_time) * 1000
+        record_api_metric("upload_file", api_duration)
+        return body
     except SQLAlchemyError as db_err:
-        db.rollback()
-        logger.error(f"Database connectivity check failed: {db_err}", exc_info=True)
+        await db.rollback()
+        logger.error("Database connectivity check failed: %s", db_err, exc_info=True)
         # print(f"Database connectivity check failed: {db_err}")
+        # No inline S3 delete: the upload's outbox intent removes the object once
+        # nothing references it. Releasing the intent just makes that happen sooner.
         try:
-            delete_file_from_s3(file_name)
-            logger.info(f"Deleted file {file_name} from S3 after DB failure.")
-        except Exception as s3_err:
-            logger.error(f"Failed to delete {file_name} from S3: {str(s3_err)}")
-        api_duration = (time.time() - start_time) * 1000
+            if metadata["content_hash"]:
+                # The object may be shared; only drop it if this was its last reference
+                unreferenced_key = await release_blob(db, metadata["content_hash"])
+                if unreferenced_key:
+                    enqueue_delete(db, unreferenced_key)
+                await db.commit()
+            if metadata.get("outbox_id"):
+                await release_upload_intent(metadata["outbox_id"])
+            notify_outbox()
+        except Exception as cleanup_err:
+            logger.error("Could not release upload %s after DB failure: %s", file_name, cleanup_err)
+        api_duration = (time.perf_counter() - start_time) * 1000
         record_api_metric("upload_file", api_duration)
         response_503 = Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
-        response_503.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_503.headers['Pragma'] = "no-cache"
         return response_503
     except Exception as e:
         logger.warning("No file was provided in the request.")
         # final API duration
-        api_duration = (time.time() - start_time) * 1000
+        api_duration = (time.perf_counter() - start_time) * 1000
         record_api_metric("upload_file", api_duration)
-        raise HTTPException(status_code=400, detail=f"Bad request: {str(e)}")
+        raise HTTPException(status_code=400, detail="Bad request")
 
 @router.api_route("/v1/file", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
 async def method_not_allowed():
     response = Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers['Pragma'] = "no-cache"
     return response
 
+async def _with_download_url(payload, request):
+    """Adds a presigned GET URL to the payload when the client asked for ?presign=true"""
+    if request.query_params.get("presign", "false").lower() != "true":
+        return payload
+    return {**payload, "download_url": await presign_download(object_key_from_url(payload["file_url"]))}
+
 @router.get("/v1/file/{id}", status_code=status.HTTP_200_OK)
-async def get_file_info(id: str, request: Request, db: Session = Depends(get_db)):
-    start_time = time.time()
+async def get_file_info(id: str, request: Request, db: AsyncSession = Depends(get_db)):
+    start_time = time.perf_counter()
 
     if await request.body():
+        record_api_metric("get_file", (time.perf_counter() - start_time) * 1000)
         response_400 = Response(status_code=status.HTTP_400_BAD_REQUEST)
-        response_400.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_400.headers['Pragma'] = "no-cache"
         return response_400
 
     try:
+        # Metadata never changes after upload, so serve repeat reads from the cache
+        found, payload = await metadata_cache.get(id)
+        if found:
+            api_duration = (time.perf_counter() - start_time) * 1000
+            record_api_metric("get_file", api_duration)
+            if payload is None:
+                response_404 = Response(status_code=status.HTTP_404_NOT_FOUND)
+                return response_404
+            return await _with_download_url(payload, request)
+
         # Fetch file metadata from the database
-        db_start = time.time()
-        file_record = db.query(FileMetadata).filter(FileMetadata.id == id).first()
-        record_db_metric("get_file", (time.time() - db_start) * 1000)
+        db_start = time.perf_counter()
+        file_record = await db.get(FileMetadata, id)
+        record_db_metric("get_file", (time.perf_counter() - db_start) * 1000)
         if not file_record:
-            logger.warning(f"File with id {id} not found in DB")
+            logger.warning("File with id %s not found in DB", id)
+            await metadata_cache.set(id, None, METADATA_CACHE_NEGATIVE_TTL)
             response_404 = Response(status_code=status.HTTP_404_NOT_FOUND)
-            response_404.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response_404.headers['Pragma'] = "no-cache"
-            api_duration = (time.time() - start_time) * 1000
+            api_duration = (time.perf_counter() - start_time) * 1000
             record_api_metric("get_file", api_duration)
             return response_404
-        logger.info(f"Successfully retrieved metadata for file ID: {id}")
-        api_duration = (time.time() - start_time) * 1000
+        logger.info("Successfully retrieved metadata for file ID: %s", id)
+        payload = file_metadata_payload(file_record)
+        await metadata_cache.set(id, payload, METADATA_CACHE_TTL)
+        api_duration = (time.perf_counter() - start_time) * 1000
         record_api_metric("get_file", api_duration)
-        return {
-            "id": file_record.id,
-            "file_name": file_record.file_name,
-            "file_url": file_record.url,  # S3 URL, not actual file content
-            "size": file_record.size,
-            "upload_date": file_record.upload_date
-        }
+        return await _with_download_url(payload, request)
     
     except SQLAlchemyError as db_err:
-        logger.error(f"Database connectivity error: {db_err}")
+        logger.error("Database connectivity error: %s", db_err)
         response_503 = Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
-        response_503.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_503.headers['Pragma'] = "no-cache"
-        api_duration = (time.time() - start_time) * 1000
+        api_duration = (time.perf_counter() - start_time) * 1000
         record_api_metric("get_file", api_duration)
         return response_503
 
     
     except Exception as e:
-        logger.error(f"Error retrieving file metadata for {id}: {str(e)}")
+        logger.error("Error retrieving file metadata for %s: %s", id, e)
         response_404 = Response(status_code=status.HTTP_404_NOT_FOUND)
-        response_404.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_404.headers['Pragma'] = "no-cache"
-        api_duration = (time.time() - start_time) * 1000
+        api_duration = (time.perf_counter() - start_time) * 1000
         record_api_metric("get_file", api_duration)
         return response_404
 
 
 @router.delete("/v1/file/{id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_file(id: str, request: Request, db: Session = Depends(get_db)):
+async def delete_file(id: str, request: Request, db: AsyncSession = Depends(get_db)):
     """Deletes a file from both S3 and the database"""
-    start_time = time.time()
+    start_time = time.perf_counter()
 
     if await request.body():
+        record_api_metric("delete_file", (time.perf_counter() - start_time) * 1000)
         response_400 = Response(status_code=status.HTTP_400_BAD_REQUEST)
-        response_400.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_400.headers['Pragma'] = "no-cache"
         return response_400
-    db_start = time.time()
-    file_record = db.query(FileMetadata).filter(FileMetadata.id == id).first()
-    record_db_metric("delete_file", (time.time() - db_start) * 1000)
-    if not file_record:
-        logger.warning(f"File with ID {id} not found in the database. Skipping deletion.")
-        response_404 = Response(status_code=status.HTTP_404_NOT_FOUND)
-        response_404.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_404.headers['Pragma'] = "no-cache"
-        api_duration = (time.time() - start_time) * 1000
-        record_api_metric("get_file", api_duration)
-        return response_404
     try:
-        # Delete the file from S3
-        try:
-            s3_start = time.time()
-            delete_file_from_s3(file_record.file_name)  # Passing the stored S3 key
-            s3_duration = (time.time() - s3_start) * 1000
-            record_s3_metric("delete_file", s3_duration)
-            logger.info(f"Deleted file {file_record.file_name} from S3.")
-        except Exception as s3_err:
-            logger.error(f"Failed to delete {file_record.file_name} from S3: {str(s3_err)}")
+        # The row goes first; its S3 object is deleted by the outbox reconciler
+        # once the transaction has committed and nothing else references it.
+        # DELETE ... RETURNING, so of two concurrent deletes only the one that
+        # actually removed the row releases the blob.
+        db_start = time.perf_counter()
+        result = await db.execute(
+            delete(FileMetadata)
+            .where(FileMetadata.id == id)
+            .returning(FileMetadata.file_name, FileMetadata.s3_key, FileMetadata.content_hash)
+            .execution_options(synchronize_session=False)
+        )
+        deleted = result.first()
+        if deleted is None:
+            await db.rollback()
+            record_db_metric("delete_file", (time.perf_counter() - db_start) * 1000)
+            logger.warning("File with ID %s not found in the database. Skipping deletion.", id)
             response_404 = Response(status_code=status.HTTP_404_NOT_FOUND)
-            response_404.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response_404.headers['Pragma'] = "no-cache"
-            api_duration = (time.time() - start_time) * 1000
+            api_duration = (time.perf_counter() - start_time) * 1000
             record_api_metric("delete_file", api_duration)
             return response_404
+        file_name, s3_key, content_hash = deleted
+        if content_hash:
+            # Shared object: only drop it with its last reference
+            unreferenced_key = await release_blob(db, content_hash)
+        else:
+            unreferenced_key = s3_key or file_name
+        if unreferenced_key:
+            enqueue_delete(db, unreferenced_key)
+        await db.commit()
+        record_db_metric("delete_file", (time.perf_counter() - db_start) * 1000)
+    except SQLAlchemyError as db_err:
+        await db.rollback()
+        logger.error("Error deleting file %s: %s", id, db_err)
+        record_api_metric("delete_file", (time.perf_counter() - start_time) * 1000)
+        response_503 = Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return response_503
+    notify_outbox()
+    # A tombstone, so a read that raced this delete cannot cache the row again
+    await metadata_cache.invalidate(id, METADATA_CACHE_TOMBSTONE_TTL)
+    logger.info("Deleted file %s; its S3 object is left to the outbox.", id)
+    record_api_metric("delete_file", (time.perf_counter() - start_time) * 1000)
+    response_204 = Response(status_code=status.HTTP_204_NO_CONTENT)
+    return response_204
 
-        # Delete file metadata from the database
-        db.delete(file_record)
-        db.commit()
-
-    except Exception as e:
-        logger.error(f"Error deleting file {id}: {str(e)}")
-        response_400 = Response(status_code=status.HTTP_400_BAD_REQUEST)
-        response_400.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response_400.headers['Pragma'] = "no-cache"
-        return response_400
 
 @router.api_route("/v1/file/{id}", methods=["POST", "PUT", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
 async def method_not_allowed():
     response = Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers['Pragma'] = "no-cache"
     return response
@@ -0,0 +1,65 @@
+import asyncio
+import os
+from fastapi import APIRouter, Request
+from starlette import status
+from starlette.responses import Response
+from metrics import statsd
+from profiler import PROFILER_ENABLED, PROFILE_MAX_SECONDS, ProfilerBusyError, collapsed_text, sample_stacks
+from logger_util import get_logger
+
+router = APIRouter()
+logger = get_logger(__name__)
+
+METRICS_ENDPOINT_ENABLED = os.getenv("METRICS_ENDPOINT_ENABLED", "true").lower() == "true"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics", status_code=status.HTTP_200_OK, response_model=None)
+async def prometheus_metrics(request: Request):
+    """Prometheus scrape endpoint serving the in-process metric aggregates"""
+    if not METRICS_ENDPOINT_ENABLED:
+        response = Response(status_code=status.HTTP_404_NOT_FOUND)
+    elif request.query_params:
+        response = Response(status_code=status.HTTP_400_BAD_REQUEST)
+    else:
+        response = Response(content=statsd.prometheus_text(), media_type=PROMETHEUS_CONTENT_TYPE)
+    return response
+
+
+@router.api_route("/metrics", methods=["POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def metrics_method_not_allowed():
+    response = Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+    return response
+
+
+@router.get("/debug/profile", status_code=status.HTTP_200_OK, response_model=None)
+async def profile(request: Request):
+    """Samples all threads for ?seconds=N and returns flamegraph-ready collapsed stacks.
+
+    Disabled (404) unless PROFILER_ENABLED is set. The sampler runs on a
+    worker thread, so the event loop keeps serving the load being profiled.
+    """
+    if not PROFILER_ENABLED:
+        response = Response(status_code=status.HTTP_404_NOT_FOUND)
+        return response
+    try:
+        seconds = float(request.query_params.get("seconds", "10"))
+    except ValueError:
+        seconds = 0
+    if set(request.query_params) - {"seconds"} or not 0 < seconds <= PROFILE_MAX_SECONDS:
+        response = Response(status_code=status.HTTP_400_BAD_REQUEST)
+        return response
+    try:
+        stacks = await asyncio.to_thread(sample_stacks, seconds)
+    except ProfilerBusyError:
+        response = Response(status_code=status.HTTP_409_CONFLICT)
+        return response
+    logger.info("Profiled %.1f s: %s samples over %s distinct stacks", seconds, sum(stacks.values()), len(stacks))
+    response = Response(content=collapsed_text(stacks), media_type="text/plain; charset=utf-8")
+    return response
+
+
+@router.api_route("/debug/profile", methods=["POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def profile_method_not_allowed():
+    response = Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+    return response
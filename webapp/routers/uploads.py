@@ -0,0 +1,435 @@
+import datetime
+import math
+import uuid
+from datetime import timezone
+from fastapi import APIRouter, Request
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
+from starlette import status
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, Response
+from botocore.exceptions import ClientError
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from database import AsyncSessionLocal
+import upload_sessions
+from upload_sessions import UPLOAD_SESSION_TTL_HOURS, InvalidChunkError, SessionOffsetError
+from models import DirectUpload, FileMetadata, UploadSession, utc_isoformat
+from cache import metadata_cache
+from outbox import clear_upload_intent, enqueue_delete, record_upload_intent, notify as notify_outbox
+from admission import AdmissionRejected, content_length, upload_admission, rejected_response as admission_rejected_response
+from presign import PRESIGN_MULTIPART_THRESHOLD, part_size_for, presign_parts, presign_post
+from s3_service import (
+    S3_BUCKET_NAME, build_file_url, get_s3_client, run_in_s3_executor,
+)
+from schemas import DirectUploadRequest
+from upload_stream import MAX_UPLOAD_SIZE
+from logger_util import get_logger
+from metrics import record_api_metric, record_db_metric, record_s3_metric
+import time
+
+router = APIRouter()
+logger = get_logger(__name__)
+
+
+def _s3_key(file_id, file_name):
+    return f"{file_id}_{file_name}"
+
+
+def _valid_file_id(file_id):
+    try:
+        return str(uuid.UUID(file_id)) == file_id
+    except ValueError:
+        return False
+
+
+@router.post("/v1/uploads", status_code=status.HTTP_201_CREATED)
+async def start_direct_upload(request: Request):
+    """Issues presigned URLs so the client uploads straight to S3.
+
+    Below PRESIGN_MULTIPART_THRESHOLD the client gets a presigned POST form;
+    larger files get a multipart upload with a presigned PUT URL per part.
+    POST /v1/uploads/{file_id}/complete then records the file under the key
+    stored here.
+    """
+    start_time = time.perf_counter()
+    try:
+        try:
+            upload = DirectUploadRequest.model_validate_json(await request.body())
+        except ValidationError as e:
+            logger.warning("Invalid direct upload request: %s validation errors", e.error_count())
+            return Response(status_code=status.HTTP_400_BAD_REQUEST)
+        if upload.size > MAX_UPLOAD_SIZE:
+            return Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        file_id = str(uuid.uuid4())
+        s3_key = _s3_key(file_id, upload.file_name)
+        body = {"file_id": file_id, "file_name": s3_key}
+        try:
+            s3_start = time.perf_counter()
+            if upload.size < PRESIGN_MULTIPART_THRESHOLD:
+                post = await presign_post(s3_key, upload.size, upload.content_type)
+                body.update(method="POST", url=post["url"], fields=post["fields"])
+            else:
+                params = {"ContentType": upload.content_type} if upload.content_type else {}
+                response = await run_in_s3_executor(
+                    get_s3_client().create_multipart_upload, Bucket=S3_BUCKET_NAME, Key=s3_key, **params,
+                )
+                part_size = part_size_for(upload.size)
+                parts = await presign_parts(s3_key, response["UploadId"], math.ceil(upload.size / part_size))
+                body.update(method="PUT", upload_id=response["UploadId"], part_size=part_size, parts=parts)
+            record_s3_metric("start_direct_upload", (time.perf_counter() - s3_start) * 1000)
+        except ClientError as e:
+            logger.error("Could not start direct upload %s: %s", s3_key, e)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        direct_upload = DirectUpload(
+            id=file_id,
+            s3_key=s3_key,
+            upload_id=body.get("upload_id"),
+            expires_at=datetime.datetime.utcnow() + datetime.timedelta(hours=UPLOAD_SESSION_TTL_HOURS),
+        )
+        try:
+            db_start = time.perf_counter()
+            async with AsyncSessionLocal() as db:
+                db.add(direct_upload)
+                await db.commit()
+            record_db_metric("start_direct_upload", (time.perf_counter() - db_start) * 1000)
+        except SQLAlchemyError as db_err:
+            # An unrecorded multipart upload is left to the bucket's lifecycle rule
+            logger.error("Database connectivity error: %s", db_err)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return body
+    finally:
+        record_api_metric("start_direct_upload", (time.perf_counter() - start_time) * 1000)
+
+
+def _list_parts(s3_key, upload_id):
+    parts = []
+    for page in get_s3_client().get_paginator("list_parts").paginate(
+        Bucket=S3_BUCKET_NAME, Key=s3_key, UploadId=upload_id,
+    ):
+        parts.extend({"PartNumber": p["PartNumber"], "ETag": p["ETag"]} for p in page.get("Parts", []))
+    return parts
+
+
+async def _complete_multipart(s3_key, upload_id):
+    parts = await run_in_s3_executor(_list_parts, s3_key, upload_id)
+    if not parts:
+        raise ValueError("No parts were uploaded")
+    await run_in_s3_executor(
+        get_s3_client().complete_multipart_upload,
+        Bucket=S3_BUCKET_NAME, Key=s3_key, UploadId=upload_id, MultipartUpload={"Parts": parts},
+    )
+
+
+@router.post("/v1/uploads/{file_id}/complete", status_code=status.HTTP_201_CREATED)
+async def complete_direct_upload(file_id: str):
+    """Finishes a direct upload and writes its files row.
+
+    The object key and multipart upload id are the ones recorded by
+    start_direct_upload; anything the client sends in the body is ignored.
+    """
+    start_time = time.perf_counter()
+    try:
+        if not _valid_file_id(file_id):
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+        try:
+            async with AsyncSessionLocal() as db:
+                direct_upload = await db.get(DirectUpload, file_id)
+                completed = direct_upload is None and await db.get(FileMetadata, file_id) is not None
+            if direct_upload is None:
+                return Response(status_code=status.HTTP_409_CONFLICT if completed else status.HTTP_404_NOT_FOUND)
+            s3_key = direct_upload.s3_key
+            # Covers the object until its files row is committed. A failed
+            # completion can be retried, so the intent is not released but comes
+            # due after OUTBOX_UPLOAD_GRACE if no retry claims the object.
+            intent_id = await record_upload_intent(s3_key)
+        except SQLAlchemyError as db_err:
+            logger.error("Database connectivity error: %s", db_err)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            s3_start = time.perf_counter()
+            if direct_upload.upload_id:
+                await _complete_multipart(s3_key, direct_upload.upload_id)
+            head = await run_in_s3_executor(get_s3_client().head_object, Bucket=S3_BUCKET_NAME, Key=s3_key)
+            record_s3_metric("complete_direct_upload", (time.perf_counter() - s3_start) * 1000)
+        except (ClientError, ValueError) as e:
+            logger.warning("Direct upload %s could not be completed: %s", s3_key, e)
+            return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+        if head["ContentLength"] > MAX_UPLOAD_SIZE:
+            logger.warning("Direct upload %s exceeds the size limit; deleting it", s3_key)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await clear_upload_intent(db, intent_id)
+                    enqueue_delete(db, s3_key, reason="upload_rejected")
+                    await db.execute(delete(DirectUpload).where(DirectUpload.id == file_id))
+                    await db.commit()
+                notify_outbox()
+            except SQLAlchemyError as db_err:
+                # The upload intent still comes due after OUTBOX_UPLOAD_GRACE
+                logger.error("Could not queue deletion of oversized upload %s: %s", s3_key, db_err)
+            return Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        file_metadata = FileMetadata(
+            id=file_id,
+            file_name=s3_key,
+            url=build_file_url(s3_key),
+            size=head["ContentLength"],
+            upload_date=head["LastModified"].astimezone(timezone.utc).replace(tzinfo=None),
+            s3_key=s3_key,
+        )
+        try:
+            db_start = time.perf_counter()
+            async with AsyncSessionLocal() as db:
+                db.add(file_metadata)
+                await db.execute(delete(DirectUpload).where(DirectUpload.id == file_id))
+                await clear_upload_intent(db, intent_id)
+                await db.commit()
+            record_db_metric("complete_direct_upload", (time.perf_counter() - db_start) * 1000)
+        except IntegrityError:
+            # Completed twice: the first call already recorded this file
+            return Response(status_code=status.HTTP_409_CONFLICT)
+        except SQLAlchemyError as db_err:
+            logger.error("Database connectivity error: %s", db_err)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        # A GET issued before completion may have cached a 404
+        await metadata_cache.delete(file_id)
+
+        logger.info("Direct upload %s completed (%s bytes)", s3_key, file_metadata.size)
+        return JSONResponse(status_code=status.HTTP_201_CREATED, content={
+            "file_name": s3_key,
+            "file_id": file_id,
+            "file_url": file_metadata.url,
+            "size": file_metadata.size,
+            "upload_date": utc_isoformat(file_metadata.upload_date),
+            "checksum": None,
+            "message": "File added",
+        })
+    finally:
+        record_api_metric("complete_direct_upload", (time.perf_counter() - start_time) * 1000)
+
+
+@router.post("/v1/uploads/{file_id}/abort", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_direct_upload(file_id: str):
+    """Drops the uploaded parts of a multipart direct upload that will not be completed"""
+    start_time = time.perf_counter()
+    try:
+        if not _valid_file_id(file_id):
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+        try:
+            async with AsyncSessionLocal() as db:
+                direct_upload = await db.get(DirectUpload, file_id)
+        except SQLAlchemyError as db_err:
+            logger.error("Database connectivity error: %s", db_err)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if direct_upload is None:
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+        if not direct_upload.upload_id:
+            # A presigned POST upload has no parts to drop
+            return Response(status_code=status.HTTP_400_BAD_REQUEST)
+        try:
+            await run_in_s3_executor(
+                get_s3_client().abort_multipart_upload,
+                Bucket=S3_BUCKET_NAME, Key=direct_upload.s3_key, UploadId=direct_upload.upload_id,
+            )
+        except ClientError as e:
+            logger.warning("Abort of direct upload %s failed: %s", file_id, e)
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(delete(DirectUpload).where(DirectUpload.id == file_id))
+                await db.commit()
+        except SQLAlchemyError as db_err:
+            # The parts are gone; the reaper drops the row once it expires
+            logger.error("Could not remove aborted direct upload %s: %s", file_id, db_err)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    finally:
+        record_api_metric("abort_direct_upload", (time.perf_counter() - start_time) * 1000)
+
+
+def _session_payload(session, offset):
+    return jsonable_encoder({
+        "session_id": session.id,
+        "file_name": session.s3_key,
+        "size": session.size,
+        "part_size": session.part_size,
+        "offset": offset,
+        "expires_at": session.expires_at,
+    })
+
+
+def _offset_conflict(offset):
+    return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"offset": offset})
+
+
+@router.post("/v1/uploads/sessions", status_code=status.HTTP_201_CREATED)
+async def create_upload_session(request: Request):
+    """Starts a resumable upload; the client then PUTs ranged chunks to the session"""
+    start_time = time.perf_counter()
+    try:
+        try:
+            upload = DirectUploadRequest.model_validate_json(await request.body())
+        except ValidationError as e:
+            logger.warning("Invalid upload session request: %s validation errors", e.error_count())
+            return Response(status_code=status.HTTP_400_BAD_REQUEST)
+        if upload.size > MAX_UPLOAD_SIZE:
+            return Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        try:
+            session = await upload_sessions.create_session(upload.file_name, upload.size, upload.content_type)
+        except (ClientError, SQLAlchemyError) as e:
+            logger.error("Could not create upload session for %s: %s", upload.file_name, e)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return JSONResponse(status_code=status.HTTP_201_CREATED, content=_session_payload(session, 0))
+    finally:
+        record_api_metric("create_upload_session", (time.perf_counter() - start_time) * 1000)
+
+
+@router.get("/v1/uploads/sessions/{session_id}", status_code=status.HTTP_200_OK)
+async def get_upload_session(session_id: str):
+    """Reports how many bytes have been received, i.e. where the client should resume"""
+    start_time = time.perf_counter()
+    try:
+        try:
+            async with AsyncSessionLocal() as db:
+                session = await upload_sessions.get_session(db, session_id)
+                if session is None:
+                    return Response(status_code=status.HTTP_404_NOT_FOUND)
+                offset = await upload_sessions.received_bytes(db, session_id)
+        except SQLAlchemyError as db_err:
+            logger.error("Database connectivity error: %s", db_err)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return _session_payload(session, offset)
+    finally:
+        record_api_metric("get_upload_session", (time.perf_counter() - start_time) * 1000)
+
+
+@router.put("/v1/uploads/sessions/{session_id}", status_code=status.HTTP_200_OK)
+async def upload_session_chunk(session_id: str, request: Request):
+    """Writes the chunk described by the Content-Range header.
+
+    The chunk must start at the current offset (409 with the offset
+    otherwise) and, unless it is the last, cover whole parts.
+    """
+    start_time = time.perf_counter()
+    try:
+        try:
+            charge = await upload_admission.acquire(content_length(request))
+        except AdmissionRejected as e:
+            logger.warning("Chunk for upload session %s rejected by admission control: %s", session_id, e.reason)
+            return admission_rejected_response()
+        try:
+            return await _write_session_chunk(session_id, request)
+        finally:
+            upload_admission.release(charge)
+    finally:
+        record_api_metric("upload_session_chunk", (time.perf_counter() - start_time) * 1000)
+
+
+async def _write_session_chunk(session_id, request):
+    try:
+        content_range = upload_sessions.parse_content_range(request.headers.get("content-range"))
+        async with AsyncSessionLocal() as db:
+            session = await upload_sessions.get_session(db, session_id)
+            if session is None:
+                return Response(status_code=status.HTTP_404_NOT_FOUND)
+            offset = await upload_sessions.received_bytes(db, session_id)
+        offset = await upload_sessions.write_chunk(session, offset, content_range, request.stream())
+    except InvalidChunkError as e:
+        logger.warning("Rejected chunk for upload session %s: %s", session_id, e)
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+    except SessionOffsetError as e:
+        return _offset_conflict(e.offset)
+    except ClientDisconnect:
+        logger.warning("Client disconnected during a chunk of upload session %s", session_id)
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+    except (ClientError, SQLAlchemyError) as e:
+        logger.error("Chunk for upload session %s failed: %s", session_id, e)
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return _session_payload(session, offset)
+
+
+@router.post("/v1/uploads/sessions/{session_id}/complete", status_code=status.HTTP_201_CREATED)
+async def complete_upload_session(session_id: str):
+    """Turns a fully received session into a file; repeating the call returns the same file"""
+    start_time = time.perf_counter()
+    try:
+        try:
+            async with AsyncSessionLocal() as db:
+                session = await upload_sessions.get_session(db, session_id)
+                if session is None:
+                    # Already completed: answer the retry with the file it produced
+                    file_metadata = await db.get(FileMetadata, session_id)
+                    if file_metadata is None:
+                        return Response(status_code=status.HTTP_404_NOT_FOUND)
+                    status_code = status.HTTP_200_OK
+            if session is not None:
+                file_metadata = await upload_sessions.complete_session(session)
+                status_code = status.HTTP_201_CREATED
+        except SessionOffsetError as e:
+            return _offset_conflict(e.offset)
+        except (ClientError, SQLAlchemyError) as e:
+            logger.error("Could not complete upload session %s: %s", session_id, e)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        await metadata_cache.delete(session_id)
+
+        return JSONResponse(status_code=status_code, content=jsonable_encoder({
+            "file_name": file_metadata.file_name,
+            "file_id": file_metadata.id,
+            "file_url": file_metadata.url,
+            "size": file_metadata.size,
+            "upload_date": utc_isoformat(file_metadata.upload_date),
+            "checksum": file_metadata.checksum,
+            "message": "File added",
+        }))
+    finally:
+        record_api_metric("complete_upload_session", (time.perf_counter() - start_time) * 1000)
+
+
+@router.delete("/v1/uploads/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload_session(session_id: str):
+    start_time = time.perf_counter()
+    try:
+        try:
+            async with AsyncSessionLocal() as db:
+                session = await db.get(UploadSession, session_id)
+            if session is None:
+                return Response(status_code=status.HTTP_404_NOT_FOUND)
+            await upload_sessions.abort_session(session)
+        except (ClientError, SQLAlchemyError) as e:
+            logger.error("Could not abort upload session %s: %s", session_id, e)
+            return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    finally:
+        record_api_metric("abort_upload_session", (time.perf_counter() - start_time) * 1000)
+
+
+@router.api_route("/v1/uploads", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def uploads_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@router.api_route("/v1/uploads/{file_id}/complete", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def complete_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@router.api_route("/v1/uploads/{file_id}/abort", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def abort_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@router.api_route("/v1/uploads/sessions", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def sessions_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@router.api_route("/v1/uploads/sessions/{session_id}", methods=["POST", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def session_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@router.api_route("/v1/uploads/sessions/{session_id}/complete", methods=["GET", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"], status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+async def session_complete_method_not_allowed():
+    return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -1,4 +1,81 @@
+import os
 import uvicorn
+from dotenv import load_dotenv
+
+# Before any app module reads its settings; workers inherit the environment
+load_dotenv()
+
+# production: several worker processes, no reloader. development: one
+# process with the file-watcher reloader, as `python run.py` used to be.
+APP_ENV = os.getenv("APP_ENV", "production").lower()
+APP_HOST = os.getenv("APP_HOST", "0.0.0.0")
+APP_PORT = int(os.getenv("APP_PORT", "8080"))
+# The default metadata cache (cache.py) lives in each worker's memory and a
+# delete only evicts the copy in the worker that served it, so other workers
+# would keep serving the deleted file until the TTL runs out. Several workers
+# are only safe with a shared (redis) cache or with caching turned off.
+SHARED_METADATA_CACHE = (
+    os.getenv("METADATA_CACHE_ENABLED", "true").lower() != "true"
+    or os.getenv("METADATA_CACHE_BACKEND", "memory").lower() == "redis"
+)
+# One worker per core by default when the cache is shared, otherwise one;
+# each worker has its own event loop, DB pool and S3 client, so size
+# DB_POOL_SIZE with the worker count in mind.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str((os.cpu_count() or 1) if SHARED_METADATA_CACHE else 1)))
+# Seconds to let in-flight requests (e.g. large uploads) finish after SIGTERM
+GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "60"))
+
+
+def server_options(app_env=None):
+    """Keyword arguments for uvicorn.run for the given APP_ENV"""
+    app_env = APP_ENV if app_env is None else app_env
+    options = {
+        "host": APP_HOST,
+        "port": APP_PORT,
+        # "auto" picks uvloop and httptools when they are installed
+        "loop": "auto",
+        "http": "auto",
+        "timeout_graceful_shutdown": GRACEFUL_SHUTDOWN_TIMEOUT,
+    }
+    if app_env == "development":
+        options["reload"] = True
+    else:
+        options["workers"] = max(1, WEB_CONCURRENCY)
+        if options["workers"] > 1 and not SHARED_METADATA_CACHE:
+            from logger_util import get_logger
+            get_logger("run").warning(
+                "Running %d workers with the in-process metadata cache: a delete only evicts the "
+                "cached entry in one worker, so the others can serve the deleted file for up to "
+                "METADATA_CACHE_TTL seconds. Set METADATA_CACHE_BACKEND=redis or WEB_CONCURRENCY=1.",
+                options["workers"],
+            )
+        options["proxy_headers"] = True
+    return options
+
+
+def apply_migrations_once():
+    """Runs schema migrations in the supervisor so workers don't race on DDL.
+
+    If the database is unreachable the server still starts; the workers then
+    keep retrying from their lifespan instead.
+    """
+    from sqlalchemy.exc import SQLAlchemyError
+    from database import get_engine
+    from logger_util import get_logger
+    from migrations import apply_migrations
+    try:
+        apply_migrations(get_engine())
+    except SQLAlchemyError as e:
+        get_logger("run").error("Migrations failed before starting workers, leaving them to retry: %s", e)
+        return
+    # Inherited by the worker processes
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "false"
+
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True)
+    from s3_service import validate_checksum_algorithm
+    # In the supervisor as well, so a bad setting stops the server before
+    # any worker is spawned rather than failing each worker's lifespan
+    validate_checksum_algorithm()
+    apply_migrations_once()
+    uvicorn.run("main:app", **server_options())
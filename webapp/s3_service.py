@@ -1,52 +1,291 @@
-import boto3
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from botocore.exceptions import NoCredentialsError, ClientError
 import os
+import threading
+from content_info import StreamingChecksum, checksum_of, sniff_content_type
+from logger_util import get_logger
+from tracing import SPAN_KIND_CLIENT, span
+
+logger = get_logger(__name__)
 
 #S3_BUCKET_NAME = "webapptestamogh"
 S3_BUCKET_NAME = os.getenv("S3_BUCKET")
+# Optional override so the app can talk to a local S3 stand-in (e.g. moto server)
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+# boto3 is blocking, so every S3 call is pushed onto this bounded pool
+# instead of running on the event loop. The pool size caps how many S3
+# transfers can be in flight at once on this instance.
+S3_MAX_WORKERS = int(os.getenv("S3_MAX_WORKERS", "8"))
+
+# Multipart tuning for streamed uploads. S3 rejects non-final parts under 5 MiB.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_PART_SIZE = max(S3_MIN_PART_SIZE, int(os.getenv("S3_PART_SIZE_MB", "8")) * 1024 * 1024)
+S3_UPLOAD_PARALLELISM = int(os.getenv("S3_UPLOAD_PARALLELISM", "4"))
+
+# DeleteObjects accepts at most this many keys per call
+S3_DELETE_BATCH_SIZE = 1000
+
+# Checksum computed while the upload streams: md5, sha256, crc32, crc32c or none.
+# It is stored on FileMetadata and sent to S3 so the object is verified server-side.
+UPLOAD_CHECKSUM_ALGORITHM = os.getenv("UPLOAD_CHECKSUM_ALGORITHM", "sha256").lower()
 
 # Initialize S3 client
 # s3_client = boto3.client("s3")
 
-session = boto3.Session()
-s3_client = session.client("s3")
-AWS_REGION = session.region_name
+# Created per process on first use (normally from the app lifespan) so each
+# server worker builds its own client and connection pool after it starts.
+s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    global s3_client
+    if s3_client is None:
+        with _s3_client_lock:
+            if s3_client is None:
+                import boto3  # deferred: importing boto3 is a large share of startup time
+                s3_client = boto3.Session().client("s3", endpoint_url=S3_ENDPOINT_URL)
+    return s3_client
+
+
+def validate_checksum_algorithm():
+    """Fails fast on an unknown UPLOAD_CHECKSUM_ALGORITHM or a missing backend (awscrt for crc32c)"""
+    if UPLOAD_CHECKSUM_ALGORITHM != "none":
+        StreamingChecksum(UPLOAD_CHECKSUM_ALGORITHM)
 
-def upload_file_to_s3(file_obj, file_name):
-    """Uploads file to S3 and returns the file URL"""
-    try:
-        s3_client.upload_fileobj(file_obj, S3_BUCKET_NAME, file_name)
-        # file_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{file_name}"
-        # Fetch the actual URL from S3 metadata
-        metadata = s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=file_name)
-        # Extract required metadata
-        file_size = metadata["ContentLength"]  # File size in bytes
-        content_type = metadata["ContentType"]  # MIME type
-        upload_date = metadata["LastModified"].isoformat()  # Upload timestamp
-
-        # Construct actual file URL from AWS S3
-        file_url = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{file_name}"
-        # return file_url
-        return {
-            "s3_key": file_name,
-            "size": file_size,
-            "content_type": content_type,
-            "upload_date": upload_date,
-            "file_url": file_url
-        }
-    except NoCredentialsError:
-        raise Exception("AWS credentials not available")
+
+s3_executor = ThreadPoolExecutor(max_workers=S3_MAX_WORKERS, thread_name_prefix="s3-io")
+
+
+async def run_in_s3_executor(func, *args, **kwargs):
+    """Runs a blocking S3 call on the S3 thread pool and awaits the result"""
+    loop = asyncio.get_running_loop()
+    with span(f"s3 {getattr(func, '__name__', 'call').lstrip('_')}", SPAN_KIND_CLIENT):
+        return await loop.run_in_executor(s3_executor, functools.partial(func, *args, **kwargs))
+
+
+def build_file_url(file_name):
+    # Construct actual file URL from AWS S3
+    return f"https://{S3_BUCKET_NAME}.s3.{get_s3_client().meta.region_name}.amazonaws.com/{file_name}"
+
+
+def object_key_from_url(file_url):
+    """Inverse of build_file_url"""
+    return file_url.split(".amazonaws.com/", 1)[1]
+
+
+def _response_timestamp(response):
+    """Upload timestamp from the S3 response Date header, so no head_object is needed.
+
+    Returned as naive UTC to match the `timestamp without time zone` column;
+    asyncpg refuses timezone-aware values for it.
+    """
+    date = response.get("ResponseMetadata", {}).get("HTTPHeaders", {}).get("date")
+    timestamp = parsedate_to_datetime(date) if date else datetime.now(timezone.utc)
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
 
 
 def delete_file_from_s3(file_name):
     """Deletes a file from S3"""
     try:
-        s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=file_name)
-        print(f"Deleted {file_name} from S3.")
+        get_s3_client().delete_object(Bucket=S3_BUCKET_NAME, Key=file_name)
+        logger.debug("Deleted %s from S3.", file_name)
     except NoCredentialsError:
         raise Exception("AWS credentials not available")
     except ClientError as e:
         if e.response["Error"]["Code"] == "NoSuchKey":
-            print(f"File {file_name} not found in S3.")
+            logger.info("File %s not found in S3.", file_name)
+        else:
+            raise Exception(f"Error deleting {file_name} from S3: {str(e)}")
+
+
+async def delete_file_from_s3_async(file_name):
+    """Non-blocking variant of delete_file_from_s3 for async handlers"""
+    return await run_in_s3_executor(delete_file_from_s3, file_name)
+
+
+def delete_files_from_s3(file_names):
+    """Deletes up to S3_DELETE_BATCH_SIZE keys with one DeleteObjects call.
+
+    Returns a dict of key -> error message for the keys S3 failed to delete;
+    keys that did not exist count as deleted, as with delete_file_from_s3.
+    """
+    try:
+        response = get_s3_client().delete_objects(
+            Bucket=S3_BUCKET_NAME,
+            Delete={"Objects": [{"Key": name} for name in file_names], "Quiet": True},
+        )
+    except NoCredentialsError:
+        raise Exception("AWS credentials not available")
+    return {
+        error["Key"]: f"{error.get('Code')}: {error.get('Message')}"
+        for error in response.get("Errors", [])
+        if error.get("Code") != "NoSuchKey"
+    }
+
+
+async def delete_files_from_s3_async(file_names):
+    """Deletes any number of keys, sending DeleteObjects batches in parallel on the S3 pool"""
+    batches = [file_names[i:i + S3_DELETE_BATCH_SIZE] for i in range(0, len(file_names), S3_DELETE_BATCH_SIZE)]
+    results = await asyncio.gather(
+        *(run_in_s3_executor(delete_files_from_s3, batch) for batch in batches), return_exceptions=True
+    )
+    errors = {}
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException):
+            errors.update({name: str(result) for name in batch})
         else:
-            raise Exception(f"Error deleting {file_name} from S3: {str(e)}")
\ No newline at end of file
+            errors.update(result)
+    return errors
+
+
+class S3MultipartWriter:
+    """Streams bytes into S3 as a multipart upload without spooling them locally.
+
+    Data is buffered only up to one part; full parts are uploaded on the S3
+    thread pool with at most `parallelism` parts in flight, so memory per
+    request stays around part_size * (parallelism + 1). Objects smaller than
+    one part are sent with a single PutObject instead.
+
+    Size, content type and checksum are worked out from the bytes as they
+    pass through, and the ETag/timestamp come from the PutObject or
+    CompleteMultipartUpload response, so no head_object call is needed.
+    """
+
+    _SNIFF_BYTES = 16
+
+    def __init__(self, file_name, content_type=None, part_size=None, parallelism=None, checksum_algorithm=None,
+                 content_hash_algorithm=None):
+        self.file_name = file_name
+        self.declared_content_type = content_type
+        self.content_type = None
+        self.part_size = part_size or S3_PART_SIZE
+        self.size = 0
+        algorithm = checksum_algorithm or UPLOAD_CHECKSUM_ALGORITHM
+        self.checksum = StreamingChecksum(algorithm) if algorithm != "none" else None
+        # Optional second digest used to find identical content (see dedup.py)
+        if content_hash_algorithm is None:
+            self.content_hash = None
+        elif self.checksum is not None and self.checksum.algorithm == content_hash_algorithm:
+            self.content_hash = self.checksum
+        else:
+            self.content_hash = StreamingChecksum(content_hash_algorithm)
+        self._head = b""
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._tasks = []
+        self._slots = asyncio.Semaphore(parallelism or S3_UPLOAD_PARALLELISM)
+
+    async def write(self, data):
+        if len(self._head) < self._SNIFF_BYTES:
+            self._head += data[:self._SNIFF_BYTES - len(self._head)]
+        if self.checksum is not None:
+            self.checksum.update(data)
+        if self.content_hash is not None and self.content_hash is not self.checksum:
+            self.content_hash.update(data)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            chunk = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            await self._submit_part(chunk)
+
+    def _resolve_content_type(self):
+        if self.content_type is None:
+            self.content_type = sniff_content_type(self._head, self.file_name, self.declared_content_type)
+        return self.content_type
+
+    async def _submit_part(self, chunk):
+        self._raise_failed_parts()
+        if self._upload_id is None:
+            params = {}
+            if self.checksum is not None and self.checksum.algorithm != "md5":
+                params["ChecksumAlgorithm"] = self.checksum.algorithm.upper()
+            response = await run_in_s3_executor(
+                get_s3_client().create_multipart_upload,
+                Bucket=S3_BUCKET_NAME, Key=self.file_name, ContentType=self._resolve_content_type(), **params,
+            )
+            self._upload_id = response["UploadId"]
+        # Wait for a free slot so a fast client cannot queue unbounded parts in memory
+        await self._slots.acquire()
+        part_number = len(self._tasks) + 1
+        task = asyncio.ensure_future(run_in_s3_executor(self._upload_part, part_number, chunk))
+        task.add_done_callback(lambda _: self._slots.release())
+        self._tasks.append(task)
+
+    def _upload_part(self, part_number, chunk):
+        # Per-part checksum is computed here, on the pool, not on the event loop
+        checksum_params = checksum_of(self.checksum.algorithm, chunk).s3_params() if self.checksum else {}
+        response = get_s3_client().upload_part(
+            Bucket=S3_BUCKET_NAME, Key=self.file_name, UploadId=self._upload_id,
+            PartNumber=part_number, Body=chunk, **checksum_params,
+        )
+        part = {"PartNumber": part_number, "ETag": response["ETag"]}
+        part.update({k: v for k, v in checksum_params.items() if k != "ContentMD5"})
+        return part
+
+    def _raise_failed_parts(self):
+        for task in self._tasks:
+            if task.done() and task.exception() is not None:
+                raise task.exception()
+
+    async def complete(self):
+        """Flushes the last part, finishes the upload and returns its metadata"""
+        if self._upload_id is None:
+            checksum_params = self.checksum.s3_params() if self.checksum else {}
+            response = await run_in_s3_executor(
+                get_s3_client().put_object,
+                Bucket=S3_BUCKET_NAME, Key=self.file_name, Body=bytes(self._buffer),
+                ContentType=self._resolve_content_type(), **checksum_params,
+            )
+        else:
+            if self._buffer:
+                await self._submit_part(bytes(self._buffer))
+            parts = await asyncio.gather(*self._tasks)
+            response = await run_in_s3_executor(
+                get_s3_client().complete_multipart_upload,
+                Bucket=S3_BUCKET_NAME, Key=self.file_name, UploadId=self._upload_id,
+                MultipartUpload={"Parts": sorted(parts, key=lambda p: p["PartNumber"])},
+            )
+            # Finished: a later abort() (e.g. when the dedup step fails) has nothing to drop
+            self._upload_id = None
+            self._tasks = []
+        self._buffer = bytearray()
+        return self._metadata(self.file_name, response)
+
+    def existing_object_metadata(self, s3_key):
+        """Metadata for this upload's bytes when they are already stored under `s3_key`"""
+        return self._metadata(s3_key, {})
+
+    def _metadata(self, s3_key, response):
+        return {
+            "s3_key": s3_key,
+            "size": self.size,
+            "content_type": self._resolve_content_type(),
+            "upload_date": _response_timestamp(response),
+            "file_url": build_file_url(s3_key),
+            "etag": response.get("ETag"),
+            "checksum": self.checksum.stored_value() if self.checksum else None,
+            "content_hash": self.content_hash.stored_value() if self.content_hash else None,
+        }
+
+    async def abort(self):
+        """Drops any uploaded parts so an interrupted upload leaves nothing billable behind"""
+        self._buffer = bytearray()
+        if self._upload_id is None:
+            return
+        # Part uploads already running on the pool cannot be cancelled; let them settle first
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        try:
+            await run_in_s3_executor(
+                get_s3_client().abort_multipart_upload,
+                Bucket=S3_BUCKET_NAME, Key=self.file_name, UploadId=self._upload_id,
+            )
+        except ClientError as e:
+            logger.error("Failed to abort multipart upload for %s: %s", self.file_name, e)
+        self._upload_id = None
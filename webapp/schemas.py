@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
+from typing import List, Optional
 
 class HealthCheck(BaseModel):
     id : int
@@ -7,3 +8,22 @@ class HealthCheck(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+# Largest number of ids accepted by the batch file endpoints
+MAX_BATCH_IDS = 1000
+
+class FileBatchRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_IDS)
+
+# Bulk delete fans out into DeleteObjects calls of 1000 keys each
+MAX_BULK_DELETE_IDS = 10000
+
+class FileBulkDeleteRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=MAX_BULK_DELETE_IDS)
+
+
+class DirectUploadRequest(BaseModel):
+    file_name: str = Field(..., min_length=1, max_length=255)
+    size: int = Field(..., ge=1)
+    content_type: Optional[str] = Field(None, max_length=255)
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sys
+import tempfile
+import pytest
+import boto3
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Defaults so the suite can run without a live Postgres or AWS account.
+# Anything already set in the environment (e.g. in CI) wins.
+TEST_DB_PATH = os.path.join(tempfile.gettempdir(), "webapp_test.db")
+if "DATABASE_URL" not in os.environ and os.path.exists(TEST_DB_PATH):
+    os.remove(TEST_DB_PATH)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{TEST_DB_PATH}")
+# TestClient runs each request on a fresh event loop, and pooled asyncpg
+# connections cannot move between loops, so tests run without a pool.
+os.environ.setdefault("DB_POOL_SIZE", "0")
+os.environ.setdefault("S3_BUCKET", "webapp-test-bucket")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database_schema():
+    """Creates the tables once; the app itself only migrates from its lifespan"""
+    from database import get_engine
+    from migrations import apply_migrations
+    apply_migrations(get_engine())
+
+
+@pytest.fixture(scope="session")
+def moto_s3():
+    """Starts a moto S3 server and points s3_service at it"""
+    from moto.server import ThreadedMotoServer
+    import s3_service
+
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    client = boto3.client(
+        "s3",
+        endpoint_url=f"http://{host}:{port}",
+        region_name="us-east-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+    client.create_bucket(Bucket=s3_service.S3_BUCKET_NAME)
+
+    original_client = s3_service.s3_client
+    s3_service.s3_client = client
+    yield client
+    s3_service.s3_client = original_client
+    server.stop()
+
+
+@pytest.fixture
+def drain_outbox():
+    """Runs the outbox reconciler until nothing is due, as its background job would"""
+    import outbox
+
+    def drain():
+        while asyncio.run(outbox.process_pending_operations()):
+            pass
+    return drain
@@ -0,0 +1,133 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+import admission
+from admission import AdmissionRejected, UploadAdmission
+from main import app
+
+client = TestClient(app)
+
+
+def _limiter(**options):
+    defaults = {"max_concurrency": 1, "max_bytes": 0, "queue_size": 4, "queue_timeout": 1, "pool_reserve": 0}
+    return UploadAdmission(**{**defaults, **options})
+
+
+def test_waiters_are_admitted_in_order_when_slots_free():
+    async def scenario():
+        limiter = _limiter()
+        first = await limiter.acquire(10)
+        admitted = []
+
+        async def wait(name):
+            charge = await limiter.acquire(10)
+            admitted.append(name)
+            return charge
+
+        waiters = [asyncio.ensure_future(wait("second")), asyncio.ensure_future(wait("third"))]
+        await asyncio.sleep(0.01)
+        assert limiter.queued == 2 and admitted == []
+        limiter.release(first)
+        second = await waiters[0]
+        assert admitted == ["second"] and limiter.active == 1
+        limiter.release(second)
+        limiter.release(await waiters[1])
+        assert admitted == ["second", "third"]
+        assert (limiter.active, limiter.active_bytes, limiter.queued) == (0, 0, 0)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_and_timeout_are_rejected(mocker):
+    record = mocker.patch("admission.record_admission_metric")
+
+    async def scenario():
+        limiter = _limiter(queue_size=1, queue_timeout=0.05)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await limiter.acquire()
+        assert full.value.reason == "queue_full"
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await waiter
+        assert timed_out.value.reason == "queue_timeout"
+        assert limiter.queued == 0 and limiter.active == 1
+
+    asyncio.run(scenario())
+    events = [call.args[0] for call in record.call_args_list]
+    assert events == ["admitted", "queued", "rejected.queue_full", "rejected.queue_timeout"]
+
+
+def test_byte_budget_limits_inflight_uploads():
+    async def scenario():
+        limiter = _limiter(max_concurrency=0, max_bytes=100, queue_timeout=0.05)
+        first = await limiter.acquire(60)
+        with pytest.raises(AdmissionRejected):
+            await limiter.acquire(60)
+        assert await limiter.acquire(40) == 40
+        limiter.release(first)
+        limiter.release(40)
+        # Larger than the whole budget: admitted alone, charged the budget
+        assert await limiter.acquire(500) == 100
+        assert limiter.active_bytes == 100
+
+    asyncio.run(scenario())
+
+
+def test_uploads_leave_pool_connections_for_reads(mocker):
+    headroom = mocker.patch("admission.pool_headroom", return_value=2)
+
+    async def scenario():
+        limiter = _limiter(max_concurrency=10, pool_reserve=2)
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.1)
+        assert not waiter.done()
+        headroom.return_value = 3
+        await asyncio.wait_for(waiter, timeout=1)
+        assert limiter.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        limiter = _limiter()
+        charge = await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert limiter.queued == 0
+        limiter.release(charge)
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_saturated_uploads_get_fast_503_while_reads_continue(moto_s3, mocker):
+    uploaded = client.post("/v1/file", files={"file": ("admitted.txt", b"admitted")})
+    assert uploaded.status_code == 201
+
+    limiter = _limiter(queue_size=0)
+    mocker.patch("routers.files.upload_admission", limiter)
+    held = asyncio.run(limiter.acquire())
+
+    response = client.post("/v1/file", files={"file": ("rejected.txt", b"rejected")})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(admission.ADMISSION_RETRY_AFTER)
+    assert client.get(f"/v1/file/{uploaded.json()['file_id']}").status_code == 200
+    assert client.get("/livez").status_code == 200
+
+    limiter.release(held)
+    assert client.post("/v1/file", files={"file": ("later.txt", b"later")}).status_code == 201
+    assert limiter.active == 0
+
+
+def test_session_chunks_go_through_admission(mocker):
+    limiter = _limiter(queue_size=0)
+    mocker.patch("routers.uploads.upload_admission", limiter)
+    asyncio.run(limiter.acquire())
+    response = client.put("/v1/uploads/sessions/unknown", content=b"x", headers={"Content-Range": "bytes 0-0/1"})
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
@@ -0,0 +1,104 @@
+import asyncio
+import datetime
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select, update
+import s3_service
+from database import AsyncSessionLocal
+from models import PendingS3Operation
+from main import app
+
+client = TestClient(app)
+
+
+def _upload(name):
+    response = client.post("/v1/file", files={"file": (name, b"bulk delete me")})
+    assert response.status_code == 201
+    return response.json()
+
+
+def _object_exists(s3, key):
+    return s3.list_objects_v2(Bucket=s3_service.S3_BUCKET_NAME, Prefix=key)["KeyCount"] == 1
+
+
+def test_bulk_delete_reports_per_id_results(moto_s3, drain_outbox):
+    files = [_upload(f"bulk-{i}.txt") for i in range(3)]
+    ids = [f["file_id"] for f in files[:2]] + ["no-such-file"]
+
+    response = client.post("/v1/files/delete", json={"ids": ids})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["deleted"] == 2
+    assert "failed" not in body
+    assert {r["id"]: r["status"] for r in body["results"]} == {
+        ids[0]: "deleted", ids[1]: "deleted", "no-such-file": "not_found",
+    }
+    drain_outbox()
+    for f in files[:2]:
+        assert not _object_exists(moto_s3, f["file_name"])
+        assert client.get(f"/v1/file/{f['file_id']}").status_code == 404
+    assert _object_exists(moto_s3, files[2]["file_name"])
+    assert client.get(f"/v1/file/{files[2]['file_id']}").status_code == 200
+
+
+async def _pending(s3_key):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(PendingS3Operation).where(PendingS3Operation.s3_key == s3_key))
+        return result.scalars().all()
+
+
+async def _make_due(s3_key):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(PendingS3Operation)
+            .where(PendingS3Operation.s3_key == s3_key)
+            .values(next_attempt_at=datetime.datetime.utcnow())
+        )
+        await db.commit()
+
+
+def test_bulk_delete_retries_failed_s3_deletes(moto_s3, mocker, drain_outbox):
+    files = [_upload(f"partial-{i}.txt") for i in range(2)]
+    failing_key = files[0]["file_name"]
+
+    def delete_objects(**kwargs):
+        return {"Errors": [{"Key": failing_key, "Code": "AccessDenied", "Message": "denied"}]}
+
+    mocker.patch.object(moto_s3, "delete_objects", side_effect=delete_objects)
+    response = client.post("/v1/files/delete", json={"ids": [f["file_id"] for f in files]})
+
+    # The rows are gone as soon as the delete is recorded
+    body = response.json()
+    assert body["deleted"] == 2
+    assert client.get(f"/v1/file/{files[0]['file_id']}").status_code == 404
+
+    drain_outbox()
+    pending = asyncio.run(_pending(failing_key))
+    assert len(pending) == 1
+    assert pending[0].attempts == 1
+    assert "AccessDenied" in pending[0].last_error
+    assert pending[0].next_attempt_at > datetime.datetime.utcnow()
+    assert _object_exists(moto_s3, failing_key)
+
+    mocker.stopall()
+    asyncio.run(_make_due(failing_key))
+    drain_outbox()
+    assert asyncio.run(_pending(failing_key)) == []
+    assert not _object_exists(moto_s3, failing_key)
+
+
+def test_delete_files_from_s3_batches_by_1000(moto_s3, mocker):
+    delete_objects = mocker.patch.object(moto_s3, "delete_objects", return_value={})
+    errors = asyncio.run(s3_service.delete_files_from_s3_async([f"key-{i}" for i in range(2500)]))
+    assert errors == {}
+    assert sorted(len(c.kwargs["Delete"]["Objects"]) for c in delete_objects.call_args_list) == [500, 1000, 1000]
+
+
+@pytest.mark.parametrize("body", [b"{}", b'{"ids": []}', b"nope"])
+def test_bulk_delete_rejects_bad_bodies(body):
+    assert client.post("/v1/files/delete", content=body).status_code == 400
+
+
+def test_bulk_delete_method_not_allowed():
+    assert client.get("/v1/files/delete").status_code == 405
@@ -0,0 +1,102 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import LRUTTLCache
+from main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    lru = LRUTTLCache("metadata", max_entries=1000, max_bytes=1_000_000)
+    monkeypatch.setattr("routers.files.metadata_cache", lru)
+    monkeypatch.setattr("routers.bulk.metadata_cache", lru)
+    return lru
+
+
+@pytest.fixture(scope="module")
+def uploaded_ids(moto_s3):
+    ids = []
+    for i in range(5):
+        response = client.post("/v1/file", files={"file": (f"batch-{i}.txt", f"content {i}".encode())})
+        assert response.status_code == 201
+        ids.append(response.json()["file_id"])
+    return ids
+
+
+def test_batch_lookup_uses_one_query(uploaded_ids, fresh_cache, mocker):
+    execute = mocker.spy(AsyncSession, "execute")
+    response = client.post("/v1/files/batch", json={"ids": uploaded_ids[:3] + ["missing-id", uploaded_ids[0]]})
+    assert response.status_code == 200
+    body = response.json()
+    assert [f["id"] for f in body["files"]] == uploaded_ids[:3]
+    assert body["missing"] == ["missing-id"]
+    assert execute.call_count == 1
+
+    # Everything is cached now, so a repeat lookup skips the database
+    client.post("/v1/files/batch", json={"ids": uploaded_ids[:3] + ["missing-id"]})
+    assert execute.call_count == 1
+
+
+@pytest.mark.parametrize("body", [b"not json", b'{"ids": []}', b'{"ids": "abc"}'])
+def test_batch_lookup_rejects_bad_bodies(body, fresh_cache):
+    response = client.post("/v1/files/batch", content=body)
+    assert response.status_code == 400
+    assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
+
+
+def test_batch_lookup_limits_id_count(fresh_cache):
+    response = client.post("/v1/files/batch", json={"ids": [str(i) for i in range(1001)]})
+    assert response.status_code == 400
+
+
+def test_list_files_pages_through_everything_in_order(uploaded_ids):
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/v1/files", params=params)
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
+        page = response.json()
+        assert len(page["files"]) <= 2
+        seen.extend(page["files"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    keys = [(f["upload_date"], f["id"]) for f in seen]
+    assert keys == sorted(keys)
+    assert len(keys) == len(set(keys))
+    assert set(uploaded_ids) <= {f["id"] for f in seen}
+
+
+def test_list_files_answers_503_when_the_database_is_down(mocker):
+    mocker.patch.object(AsyncSession, "stream_scalars", side_effect=OperationalError("SELECT", {}, Exception("down")))
+    record = mocker.patch("routers.bulk.record_api_metric")
+    response = client.get("/v1/files")
+    assert response.status_code == 503
+    assert record.call_count == 1
+
+
+def test_list_files_records_its_metric_once_the_page_is_sent(uploaded_ids, mocker):
+    record = mocker.patch("routers.bulk.record_api_metric")
+    response = client.get("/v1/files", params={"limit": 2})
+    assert response.status_code == 200
+    assert len(response.json()["files"]) == 2
+    record.assert_called_once()
+    assert record.call_args.args[0] == "list_files"
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=5000", "limit=abc", "cursor=%%%", "other=1"])
+def test_list_files_rejects_bad_parameters(query):
+    assert client.get(f"/v1/files?{query}").status_code == 400
+
+
+@pytest.mark.parametrize("method", ["PUT", "DELETE", "PATCH"])
+def test_list_files_method_not_allowed(method):
+    assert client.request(method, "/v1/files").status_code == 405
@@ -0,0 +1,40 @@
+import asyncio
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+import database
+
+
+def test_to_async_url_maps_sync_drivers():
+    assert database.to_async_url("postgresql://u:p@db:5432/app").drivername == "postgresql+asyncpg"
+    assert database.to_async_url("postgresql+psycopg2://u:p@db/app").drivername == "postgresql+asyncpg"
+    assert database.to_async_url("sqlite:///./local.db").drivername == "sqlite+aiosqlite"
+
+
+def test_postgres_pool_options_follow_env(monkeypatch):
+    monkeypatch.setattr(database, "DB_POOL_SIZE", 20)
+    monkeypatch.setattr(database, "DB_MAX_OVERFLOW", 5)
+    monkeypatch.setattr(database, "DB_STATEMENT_TIMEOUT_MS", 1500)
+    options = database._async_engine_options(database.to_async_url("postgresql://u:p@db/app"))
+    assert options["poolclass"] is database.InstrumentedAsyncQueuePool
+    assert options["pool_size"] == 20
+    assert options["max_overflow"] == 5
+    assert options["connect_args"] == {"server_settings": {"statement_timeout": "1500"}}
+
+
+def test_instrumented_pool_reports_checkout_wait_and_in_use(tmp_path, mocker):
+    checkout = mocker.patch("database.record_pool_checkout")
+    in_use = mocker.patch("database.record_pool_in_use")
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=database.InstrumentedAsyncQueuePool
+    )
+
+    async def run():
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+        await engine.dispose()
+
+    asyncio.run(run())
+
+    assert checkout.call_count >= 1
+    assert in_use.call_args_list[0].args == (1,)
+    assert in_use.call_args_list[-1].args == (0,)
@@ -0,0 +1,210 @@
+import asyncio
+import uuid
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+import dedup
+import outbox
+import s3_service
+import upload_stream
+from database import AsyncSessionLocal
+from models import ContentBlob, FileMetadata
+from main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture(params=[False, True], ids=["buffered", "streaming"])
+def dedup_enabled(request, mocker):
+    mocker.patch.object(dedup, "UPLOAD_DEDUP", True)
+    mocker.patch.object(upload_stream, "UPLOAD_STREAMING", request.param)
+
+
+def _unique_content():
+    return f"dedup-{uuid.uuid4()}".encode() * 64
+
+
+def _upload(name, content):
+    response = client.post("/v1/file", files={"file": (name, content)})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def _object_keys(s3, content):
+    """Keys of every stored object whose bytes equal `content`"""
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=s3_service.S3_BUCKET_NAME):
+        for obj in page.get("Contents", []):
+            if obj["Size"] == len(content):
+                body = s3.get_object(Bucket=s3_service.S3_BUCKET_NAME, Key=obj["Key"])["Body"].read()
+                if body == content:
+                    keys.append(obj["Key"])
+    return keys
+
+
+async def _blob(content_hash):
+    async with AsyncSessionLocal() as db:
+        return await db.get(ContentBlob, content_hash)
+
+
+async def _rows(ids):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(FileMetadata).where(FileMetadata.id.in_(ids)))
+        return result.scalars().all()
+
+
+def test_identical_upload_reuses_the_stored_object(moto_s3, dedup_enabled):
+    content = _unique_content()
+    first = _upload("a.bin", content)
+    second = _upload("b.bin", content)
+
+    assert first["file_id"] != second["file_id"]
+    assert second["file_name"].endswith("_b.bin")
+    assert second["file_url"] == first["file_url"]
+    assert _object_keys(moto_s3, content) == [first["file_name"]]
+
+    rows = asyncio.run(_rows([first["file_id"], second["file_id"]]))
+    assert {row.object_key for row in rows} == {first["file_name"]}
+    blob = asyncio.run(_blob(rows[0].content_hash))
+    assert blob.ref_count == 2
+
+
+def test_object_is_deleted_with_its_last_reference(moto_s3, dedup_enabled, drain_outbox):
+    content = _unique_content()
+    first = _upload("a.bin", content)
+    second = _upload("b.bin", content)
+    content_hash = asyncio.run(_rows([first["file_id"]]))[0].content_hash
+
+    assert client.delete(f"/v1/file/{first['file_id']}").status_code == 204
+    drain_outbox()
+    assert _object_keys(moto_s3, content) == [first["file_name"]]
+    assert client.get(f"/v1/file/{second['file_id']}").status_code == 200
+    assert asyncio.run(_blob(content_hash)).ref_count == 1
+
+    assert client.delete(f"/v1/file/{second['file_id']}").status_code == 204
+    drain_outbox()
+    assert _object_keys(moto_s3, content) == []
+    assert asyncio.run(_blob(content_hash)) is None
+
+
+def test_bulk_delete_releases_shared_references(moto_s3, dedup_enabled, drain_outbox):
+    content = _unique_content()
+    uploads = [_upload(f"bulk-{i}.bin", content) for i in range(3)]
+
+    response = client.post("/v1/files/delete", json={"ids": [u["file_id"] for u in uploads[:2]]})
+    assert response.status_code == 200
+    assert response.json()["deleted"] == 2
+    drain_outbox()
+    assert len(_object_keys(moto_s3, content)) == 1
+
+    response = client.post("/v1/files/delete", json={"ids": [uploads[2]["file_id"]]})
+    assert response.json()["deleted"] == 1
+    drain_outbox()
+    assert _object_keys(moto_s3, content) == []
+
+
+def test_ref_counts_of_dead_uploads_are_reconciled(moto_s3, mocker, drain_outbox):
+    mocker.patch.object(dedup, "UPLOAD_DEDUP", True)
+    content = _unique_content()
+    uploaded = _upload("kept.bin", content)
+    content_hash = asyncio.run(_rows([uploaded["file_id"]]))[0].content_hash
+    # An upload that took a reference and died before inserting its files row
+    assert asyncio.run(dedup.claim_blob(content_hash)) == uploaded["file_name"]
+    # And one that registered a new blob and died
+    leaked_key = f"{uuid.uuid4()}_leaked.bin"
+    moto_s3.put_object(Bucket=s3_service.S3_BUCKET_NAME, Key=leaked_key, Body=b"leaked")
+    assert asyncio.run(dedup.register_blob("sha256:leaked", leaked_key, 6)) == leaked_key
+
+    # Recent claims may still belong to uploads in flight
+    asyncio.run(outbox.reconcile_blob_ref_counts())
+    assert asyncio.run(_blob(content_hash)).ref_count == 2
+
+    mocker.patch.object(outbox, "OUTBOX_UPLOAD_GRACE", -60)
+    assert asyncio.run(outbox.reconcile_blob_ref_counts()) >= 2
+    assert asyncio.run(_blob(content_hash)).ref_count == 1
+    assert asyncio.run(_blob("sha256:leaked")) is None
+    drain_outbox()
+    assert moto_s3.list_objects_v2(Bucket=s3_service.S3_BUCKET_NAME, Prefix=leaked_key)["KeyCount"] == 0
+
+    assert client.delete(f"/v1/file/{uploaded['file_id']}").status_code == 204
+    drain_outbox()
+    assert _object_keys(moto_s3, content) == []
+
+
+@pytest.mark.parametrize("failing", ["claim_blob", "register_blob"])
+def test_dedup_outage_during_upload_is_a_503(moto_s3, dedup_enabled, mocker, failing):
+    outage = OperationalError("UPDATE content_blobs", {}, Exception("database is down"))
+    mocker.patch.object(dedup, failing, side_effect=outage)
+    release = mocker.spy(outbox, "release_upload_intent")
+    response = client.post("/v1/file", files={"file": ("outage.bin", _unique_content())})
+    assert response.status_code == 503
+    assert "content_blobs" not in response.text
+    # An object already written for a new blob is handed to the outbox
+    assert release.call_count == (failing == "register_blob")
+
+
+def test_dedup_disabled_stores_every_upload(moto_s3):
+    content = _unique_content()
+    _upload("a.bin", content)
+    _upload("b.bin", content)
+    assert len(_object_keys(moto_s3, content)) == 2
+
+
+async def _upload_concurrently(content, count):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+        return await asyncio.gather(*(
+            async_client.post("/v1/file", files={"file": (f"same-{i}.bin", content)}) for i in range(count)
+        ))
+
+
+def test_simultaneous_identical_uploads_share_one_object(moto_s3, dedup_enabled, mocker, drain_outbox):
+    content = _unique_content()
+    count = 8
+    # Hold every upload at the claim step until all have hashed their content,
+    # so they all miss, write their own object and race to register it
+    arrived = 0
+    all_arrived = None
+    real_claim = dedup.claim_blob
+
+    async def claim_after_everyone_hashed(content_hash):
+        nonlocal arrived, all_arrived
+        all_arrived = all_arrived or asyncio.Event()
+        arrived += 1
+        if arrived == count:
+            all_arrived.set()
+        await asyncio.wait_for(all_arrived.wait(), timeout=10)
+        return await real_claim(content_hash)
+
+    mocker.patch.object(dedup, "claim_blob", side_effect=claim_after_everyone_hashed)
+    responses = asyncio.run(_upload_concurrently(content, count))
+    # The losers' redundant objects are removed through the outbox
+    drain_outbox()
+
+    assert [r.status_code for r in responses] == [201] * count
+    assert len({r.json()["file_id"] for r in responses}) == count
+    keys = _object_keys(moto_s3, content)
+    assert len(keys) == 1
+    assert {r.json()["file_url"] for r in responses} == {s3_service.build_file_url(keys[0])}
+
+    rows = asyncio.run(_rows([r.json()["file_id"] for r in responses]))
+    assert {row.object_key for row in rows} == set(keys)
+    assert asyncio.run(_blob(rows[0].content_hash)).ref_count == count
+
+    for r in responses:
+        assert client.delete(f"/v1/file/{r.json()['file_id']}").status_code == 204
+    drain_outbox()
+    assert _object_keys(moto_s3, content) == []
+
+
+def test_multipart_duplicate_aborts_its_parts(moto_s3, dedup_enabled):
+    content = _unique_content() * 4096  # over one part: written as a multipart upload
+    assert len(content) > s3_service.S3_PART_SIZE
+    first = _upload("big-a.bin", content)
+    second = _upload("big-b.bin", content)
+
+    assert second["file_url"] == first["file_url"]
+    assert _object_keys(moto_s3, content) == [first["file_name"]]
+    assert not moto_s3.list_multipart_uploads(Bucket=s3_service.S3_BUCKET_NAME).get("Uploads")
@@ -4,6 +4,7 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from main import app
+from readiness import readiness_probe
 from unittest.mock import patch
 
 client = TestClient(app)
@@ -41,8 +42,10 @@ def test_healthz_method_not_allowed(method):
     assert response.headers["Pragma"] == "no-cache"
 
 def test_healthz_database_failure(mocker):
-    mocker.patch("routers.health.models.HealthCheck", side_effect=Exception("Database error"))
+    mocker.patch("readiness.check_database", side_effect=Exception("Database error"))
+    readiness_probe.reset()
     response = client.get("/healthz")
+    readiness_probe.reset()
     assert response.status_code == 503
     assert "Cache-Control" in response.headers
     assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
@@ -0,0 +1,73 @@
+import json
+import logging
+from fastapi.testclient import TestClient
+from logger_util import JsonFormatter, RequestContextFilter, SamplingFilter, parse_sample_rates, request_id_var
+from main import app
+import middleware
+
+client = TestClient(app)
+
+
+def _record(name="main", level=logging.INFO, msg="hello %s", args=("world",), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+def test_json_formatter_includes_structured_fields():
+    record = _record(request_id="abc", route="/v1/file/{id}", status=200, duration_ms=1.5)
+    payload = json.loads(JsonFormatter().format(record))
+    assert payload["message"] == "hello world"
+    assert payload["level"] == "INFO"
+    assert payload["logger"] == "main"
+    assert payload["request_id"] == "abc"
+    assert payload["route"] == "/v1/file/{id}"
+    assert payload["status"] == 200
+    assert payload["duration_ms"] == 1.5
+    assert "method" not in payload
+
+
+def test_request_context_filter_stamps_current_request_id():
+    token = request_id_var.set("req-1")
+    try:
+        record = _record()
+        RequestContextFilter().filter(record)
+    finally:
+        request_id_var.reset(token)
+    assert record.request_id == "req-1"
+
+
+def test_sampling_filter_only_drops_low_levels_of_configured_loggers():
+    sampler = SamplingFilter(parse_sample_rates("main=0, routers.files=1"))
+    assert not sampler.filter(_record("main"))
+    assert sampler.filter(_record("main", level=logging.WARNING))
+    assert sampler.filter(_record("routers.files"))
+    assert sampler.filter(_record("cache"))
+
+
+def test_disabled_level_does_not_format_arguments():
+    class Expensive:
+        def __str__(self):
+            raise AssertionError("formatted a disabled log line")
+
+    logging.getLogger("main").debug("value %s", Expensive())
+
+
+def test_request_id_is_propagated_to_response():
+    response = client.get("/livez", headers={"X-Request-ID": "client-id-123"})
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"] == "client-id-123"
+
+
+def test_request_id_is_generated_and_logged(mocker):
+    spy = mocker.spy(middleware.logger, "info")
+    response = client.get("/livez")
+    request_id = response.headers["X-Request-ID"]
+    assert len(request_id) == 32
+
+    extra = spy.call_args.kwargs["extra"]
+    assert extra["request_id"] == request_id
+    assert extra["route"] == "/livez"
+    assert extra["method"] == "GET"
+    assert extra["status"] == 200
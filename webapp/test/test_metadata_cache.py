@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import fakeredis
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import LRUTTLCache, RedisCache
+from main import app
+
+client = TestClient(app)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_ttl_cache_expires_entries():
+    clock = FakeClock()
+    lru = LRUTTLCache("test", max_entries=10, max_bytes=10_000, clock=clock)
+
+    async def run():
+        await lru.set("a", {"v": 1}, ttl=10)
+        assert await lru.get("a") == (True, {"v": 1})
+        clock.now = 11
+        assert await lru.get("a") == (False, None)
+        assert len(lru) == 0
+
+    asyncio.run(run())
+
+
+def test_lru_ttl_cache_evicts_least_recently_used(mocker):
+    metric = mocker.patch("cache.record_cache_metric")
+    lru = LRUTTLCache("test", max_entries=2, max_bytes=10_000)
+
+    async def run():
+        await lru.set("a", 1, ttl=60)
+        await lru.set("b", 2, ttl=60)
+        await lru.get("a")  # "b" is now the least recently used
+        await lru.set("c", 3, ttl=60)
+        assert await lru.get("b") == (False, None)
+        assert await lru.get("a") == (True, 1)
+
+    asyncio.run(run())
+    assert mocker.call("test", "eviction") in metric.call_args_list
+
+
+def test_lru_ttl_cache_respects_byte_cap():
+    lru = LRUTTLCache("test", max_entries=100, max_bytes=30)
+
+    async def run():
+        await lru.set("a", "x" * 10, ttl=60)
+        await lru.set("b", "y" * 10, ttl=60)
+        await lru.set("c", "z" * 10, ttl=60)
+        await lru.set("huge", "w" * 100, ttl=60)  # larger than the whole cache, never stored
+
+    asyncio.run(run())
+    assert lru.bytes_used <= 30
+    assert len(lru) == 2
+
+
+def test_redis_cache_round_trip_and_negative_entries():
+    redis_cache = RedisCache("test", fakeredis.FakeAsyncRedis())
+
+    async def run():
+        await redis_cache.set("present", {"id": "present"}, ttl=60)
+        await redis_cache.set("missing", None, ttl=60)
+        assert await redis_cache.get("present") == (True, {"id": "present"})
+        assert await redis_cache.get("missing") == (True, None)
+        assert await redis_cache.get("unknown") == (False, None)
+        await redis_cache.delete("present")
+        assert await redis_cache.get("present") == (False, None)
+
+    asyncio.run(run())
+
+
+def test_delete_only_evicts_the_local_worker_cache():
+    # Two workers, each with its own in-process cache: the one that handles
+    # the delete forgets the file, the other keeps serving it. This is why
+    # run.py warns about several workers without a shared backend.
+    worker_a = LRUTTLCache("metadata", max_entries=10, max_bytes=10_000)
+    worker_b = LRUTTLCache("metadata", max_entries=10, max_bytes=10_000)
+    shared = fakeredis.FakeAsyncRedis()
+    redis_a, redis_b = RedisCache("metadata", shared), RedisCache("metadata", shared)
+
+    async def run():
+        for cache in (worker_a, worker_b, redis_a):
+            await cache.set("file", {"id": "file"}, ttl=60)
+        await worker_a.delete("file")
+        assert await worker_a.get("file") == (False, None)
+        assert await worker_b.get("file") == (True, {"id": "file"})
+        await redis_a.delete("file")
+        assert await redis_b.get("file") == (False, None)
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    lru = LRUTTLCache("metadata", max_entries=100, max_bytes=100_000)
+    monkeypatch.setattr("routers.files.metadata_cache", lru)
+    return lru
+
+
+def test_get_file_served_from_cache_and_invalidated_on_delete(moto_s3, fresh_cache, mocker):
+    upload = client.post("/v1/file", files={"file": ("cached.txt", b"cache me")}).json()
+    file_id = upload["file_id"]
+    db_get = mocker.spy(AsyncSession, "get")
+
+    first = client.get(f"/v1/file/{file_id}")
+    second = client.get(f"/v1/file/{file_id}")
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert db_get.call_count == 1
+
+    assert client.delete(f"/v1/file/{file_id}").status_code == 204
+    assert client.get(f"/v1/file/{file_id}").status_code == 404
+
+
+def test_read_racing_a_delete_cannot_recache_the_row(moto_s3, fresh_cache, mocker):
+    file_id = client.post("/v1/file", files={"file": ("raced.txt", b"raced")}).json()["file_id"]
+    read_done = threading.Event()
+    deleted = threading.Event()
+    original_get = AsyncSession.get
+
+    async def get_then_wait_for_delete(self, model, ident, *args, **kwargs):
+        row = await original_get(self, model, ident, *args, **kwargs)
+        if ident == file_id and not deleted.is_set():
+            read_done.set()
+            await asyncio.to_thread(deleted.wait, 5)
+        return row
+
+    mocker.patch.object(AsyncSession, "get", get_then_wait_for_delete)
+    responses = {}
+    reader = threading.Thread(target=lambda: responses.update(read=client.get(f"/v1/file/{file_id}")))
+    reader.start()
+    assert read_done.wait(5)
+    # The delete commits and invalidates while the read holds the old row
+    assert client.delete(f"/v1/file/{file_id}").status_code == 204
+    deleted.set()
+    reader.join(5)
+
+    assert responses["read"].status_code == 200
+    assert client.get(f"/v1/file/{file_id}").status_code == 404
+
+
+def test_tombstones_are_not_overwritten_by_set():
+    clock = [0.0]
+    lru = LRUTTLCache("test", max_entries=10, max_bytes=10_000, clock=lambda: clock[0])
+    redis_cache = RedisCache("test", fakeredis.FakeAsyncRedis())
+
+    async def run():
+        for cache in (lru, redis_cache):
+            await cache.invalidate("gone", ttl=30)
+            await cache.set("gone", {"id": "gone"}, ttl=60)
+            assert await cache.get("gone") == (True, None)
+        clock[0] = 31
+        await lru.set("gone", {"id": "gone"}, ttl=60)
+        assert await lru.get("gone") == (True, {"id": "gone"})
+
+    asyncio.run(run())
+
+
+def test_get_file_caches_not_found(fresh_cache, mocker):
+    db_get = mocker.spy(AsyncSession, "get")
+    assert client.get("/v1/file/never-uploaded").status_code == 404
+    assert client.get("/v1/file/never-uploaded").status_code == 404
+    assert db_get.call_count == 1
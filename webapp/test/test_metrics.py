@@ -0,0 +1,105 @@
+import socket
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+from metrics import MetricsAggregator
+from main import app
+from upload_stream import MAX_UPLOAD_SIZE
+
+client = TestClient(app)
+
+
+def _receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1)
+    return sock
+
+
+def _receive_all(sock, packets):
+    return [sock.recvfrom(65535)[0].decode() for _ in range(packets)]
+
+
+def test_recording_does_not_send_until_flush():
+    sock = _receiver()
+    aggregator = MetricsAggregator(*sock.getsockname(), flush_interval=3600)
+    aggregator.incr("api.get_file.count")
+    aggregator.incr("api.get_file.count")
+    aggregator.timing("api.get_file.latency", 12.5)
+    aggregator.gauge("db.pool.in_use", 3)
+
+    sock.settimeout(0.05)
+    try:
+        sock.recvfrom(65535)
+        assert False, "metrics were sent before flush"
+    except socket.timeout:
+        pass
+
+    assert aggregator.flush() == 1
+    sock.settimeout(1)
+    lines = set(_receive_all(sock, 1)[0].split("\n"))
+    assert lines == {"api.get_file.count:2|c", "api.get_file.latency:12.500|ms", "db.pool.in_use:3|g"}
+    assert aggregator.flush() == 0
+
+
+def test_flush_packs_lines_up_to_packet_size():
+    sock = _receiver()
+    aggregator = MetricsAggregator(*sock.getsockname(), flush_interval=3600, max_packet_size=200)
+    for i in range(100):
+        aggregator.timing("db.query.get_file.time", float(i))
+
+    packets = aggregator.flush()
+    received = _receive_all(sock, packets)
+    assert 1 < packets < 100
+    assert all(len(p.encode()) <= 200 for p in received)
+    assert sum(len(p.split("\n")) for p in received) == 100
+
+
+def test_timer_reservoir_is_bounded_and_rate_annotated():
+    sock = _receiver()
+    aggregator = MetricsAggregator(*sock.getsockname(), flush_interval=3600, max_timer_samples=10)
+    for i in range(1000):
+        aggregator.timing("s3.upload_file.time", float(i))
+
+    received = _receive_all(sock, aggregator.flush())
+    lines = [line for packet in received for line in packet.split("\n")]
+    assert len(lines) == 10
+    assert all(line.endswith("|@0.010000") for line in lines)
+
+
+def test_prometheus_text_renders_cumulative_aggregates():
+    aggregator = MetricsAggregator(statsd_enabled=False)
+    aggregator.incr("api.get_file.count", 3)
+    aggregator.timing("api.get_file.latency", 4)
+    aggregator.timing("api.get_file.latency", 300)
+    aggregator.flush()  # flushing must not reset what Prometheus sees
+
+    text = aggregator.prometheus_text()
+    assert "webapp_api_get_file_count_total 3" in text
+    assert 'webapp_api_get_file_latency_ms_bucket{le="5"} 1' in text
+    assert 'webapp_api_get_file_latency_ms_bucket{le="+Inf"} 2' in text
+    assert "webapp_api_get_file_latency_ms_count 2" in text
+
+
+def test_metrics_endpoint():
+    client.get("/livez")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
+    assert client.post("/metrics").status_code == 405
+
+
+@pytest.mark.parametrize("method, path, body, status_code, api_name", [
+    ("post", "/v1/uploads", "not json", 400, "start_direct_upload"),
+    ("post", "/v1/uploads", f'{{"file_name": "big.bin", "size": {MAX_UPLOAD_SIZE + 1}}}', 413, "start_direct_upload"),
+    ("post", f"/v1/uploads/{uuid.uuid4()}/abort", None, 404, "abort_direct_upload"),
+    ("get", f"/v1/uploads/sessions/{uuid.uuid4()}", None, 404, "get_upload_session"),
+    ("delete", f"/v1/uploads/sessions/{uuid.uuid4()}", None, 404, "abort_upload_session"),
+])
+def test_upload_endpoints_record_one_api_metric(mocker, method, path, body, status_code, api_name):
+    record = mocker.patch("routers.uploads.record_api_metric")
+    response = client.request(method.upper(), path, content=body)
+    assert response.status_code == status_code
+    record.assert_called_once()
+    assert record.call_args.args[0] == api_name
@@ -0,0 +1,40 @@
+from fastapi.testclient import TestClient
+from main import app
+
+client = TestClient(app)
+
+
+def _assert_no_cache(response):
+    assert response.headers.get_list("Cache-Control") == ["no-cache, no-store, must-revalidate"]
+    assert response.headers.get_list("Pragma") == ["no-cache"]
+
+
+def test_unknown_path_is_rejected_with_405():
+    response = client.get("/not-a-route")
+    assert response.status_code == 405
+    assert response.content == b""
+    _assert_no_cache(response)
+    assert response.headers["X-Request-ID"]
+
+
+def test_no_cache_headers_on_handler_responses():
+    _assert_no_cache(client.get("/livez"))
+    _assert_no_cache(client.get("/livez?x=1"))
+    _assert_no_cache(client.post("/healthz"))
+    _assert_no_cache(client.get("/v1/file/does-not-exist"))
+
+
+def test_streaming_response_passes_through():
+    with client.stream("GET", "/v1/files?limit=5") as response:
+        body = b"".join(response.iter_bytes())
+    assert response.status_code == 200
+    _assert_no_cache(response)
+    assert body.startswith(b'{"files": [')
+    assert body.endswith(b"}")
+
+
+def test_handler_headers_are_not_duplicated():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    _assert_no_cache(response)
+    assert response.headers["content-type"].startswith("text/plain")
@@ -0,0 +1,187 @@
+import asyncio
+import datetime
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+import outbox
+import routers.uploads
+import s3_service
+import upload_stream
+from database import AsyncSessionLocal
+from models import PendingS3Operation
+from main import app
+
+client = TestClient(app)
+
+
+def _upload(name, content=b"outbox"):
+    response = client.post("/v1/file", files={"file": (name, content)})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def _object_exists(s3, key):
+    return s3.list_objects_v2(Bucket=s3_service.S3_BUCKET_NAME, Prefix=key)["KeyCount"] == 1
+
+
+async def _pending(s3_key):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(PendingS3Operation).where(PendingS3Operation.s3_key == s3_key))
+        return result.scalars().all()
+
+
+async def _pending_by_reason(reason):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(PendingS3Operation).where(PendingS3Operation.reason == reason))
+        return result.scalars().all()
+
+
+async def _make_due(s3_key):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(PendingS3Operation)
+            .where(PendingS3Operation.s3_key == s3_key)
+            .values(next_attempt_at=datetime.datetime.utcnow())
+        )
+        await db.commit()
+
+
+async def _enqueue(s3_key):
+    async with AsyncSessionLocal() as db:
+        outbox.enqueue_delete(db, s3_key)
+        await db.commit()
+
+
+def test_successful_upload_clears_its_intent(moto_s3):
+    uploaded = _upload("kept.txt")
+    assert asyncio.run(_pending(uploaded["file_name"])) == []
+
+
+def test_delete_returns_before_s3_and_reconciler_removes_object(moto_s3, drain_outbox):
+    uploaded = _upload("gone.txt")
+    assert client.delete(f"/v1/file/{uploaded['file_id']}").status_code == 204
+    assert client.get(f"/v1/file/{uploaded['file_id']}").status_code == 404
+    assert len(asyncio.run(_pending(uploaded["file_name"]))) == 1
+
+    drain_outbox()
+    assert not _object_exists(moto_s3, uploaded["file_name"])
+    assert asyncio.run(_pending(uploaded["file_name"])) == []
+
+
+def test_failed_metadata_insert_leaves_no_orphan(moto_s3, mocker, drain_outbox):
+    mocker.patch("routers.files.clear_upload_intent", side_effect=SQLAlchemyError("database is down"))
+    response = client.post("/v1/file", files={"file": ("orphan.txt", b"orphan")})
+    assert response.status_code == 503
+
+    pending = asyncio.run(_pending_by_reason("upload_intent"))
+    key = next(op.s3_key for op in pending if op.s3_key.endswith("_orphan.txt"))
+    assert _object_exists(moto_s3, key)
+    drain_outbox()
+    assert not _object_exists(moto_s3, key)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_outbox_outage_during_upload_is_a_503(moto_s3, mocker, streaming):
+    mocker.patch.object(upload_stream, "UPLOAD_STREAMING", streaming)
+    outage = OperationalError("INSERT INTO pending_s3_operations", {}, Exception("database is down"))
+    mocker.patch("outbox.record_upload_intent", side_effect=outage)
+    response = client.post("/v1/file", files={"file": ("outage.txt", b"outage")})
+    assert response.status_code == 503
+    assert "pending_s3_operations" not in response.text
+
+
+def test_abandoned_upload_intent_deletes_object_after_grace(moto_s3, drain_outbox):
+    key = "abandoned-upload.txt"
+    asyncio.run(outbox.record_upload_intent(key))
+    moto_s3.put_object(Bucket=s3_service.S3_BUCKET_NAME, Key=key, Body=b"x")
+
+    drain_outbox()
+    assert _object_exists(moto_s3, key)  # still inside the grace period
+
+    asyncio.run(_make_due(key))
+    drain_outbox()
+    assert not _object_exists(moto_s3, key)
+
+
+def test_direct_and_session_completions_clear_their_intents(moto_s3, mocker):
+    direct_intent = mocker.spy(routers.uploads, "record_upload_intent")
+    session_intent = mocker.spy(outbox, "record_upload_intent")
+    start = client.post("/v1/uploads", json={"file_name": "direct-intent.txt", "size": 6}).json()
+    moto_s3.put_object(Bucket=s3_service.S3_BUCKET_NAME, Key=start["file_name"], Body=b"direct")
+    response = client.post(f"/v1/uploads/{start['file_id']}/complete", json={"file_name": "direct-intent.txt"})
+    assert response.status_code == 201, response.text
+
+    session = client.post("/v1/uploads/sessions", json={"file_name": "session-intent.txt", "size": 7}).json()
+    put = client.put(
+        f"/v1/uploads/sessions/{session['session_id']}", content=b"session", headers={"Content-Range": "bytes 0-6/7"},
+    )
+    assert put.status_code == 200, put.text
+    assert client.post(f"/v1/uploads/sessions/{session['session_id']}/complete").status_code == 201
+
+    direct_intent.assert_called_once_with(start["file_name"])
+    session_intent.assert_called_once_with(session["file_name"])
+    assert asyncio.run(_pending(start["file_name"])) == []
+    assert asyncio.run(_pending(session["file_name"])) == []
+
+
+def test_failed_session_completion_keeps_object_for_a_retry(moto_s3, mocker, drain_outbox):
+    session = client.post("/v1/uploads/sessions", json={"file_name": "retried.txt", "size": 7}).json()
+    client.put(
+        f"/v1/uploads/sessions/{session['session_id']}", content=b"retried", headers={"Content-Range": "bytes 0-6/7"},
+    )
+    mocker.patch("outbox.clear_upload_intent", side_effect=SQLAlchemyError("database is down"))
+    assert client.post(f"/v1/uploads/sessions/{session['session_id']}/complete").status_code == 503
+    [intent] = asyncio.run(_pending(session["file_name"]))
+    assert intent.reason == "upload_intent"
+    drain_outbox()
+    assert _object_exists(moto_s3, session["file_name"])  # not due inside the grace period
+
+    mocker.stopall()
+    assert client.post(f"/v1/uploads/sessions/{session['session_id']}/complete").status_code == 201
+    asyncio.run(_make_due(session["file_name"]))
+    drain_outbox()
+    assert _object_exists(moto_s3, session["file_name"])
+    assert asyncio.run(_pending(session["file_name"])) == []
+
+
+def test_reconciler_never_deletes_referenced_objects(moto_s3, drain_outbox):
+    uploaded = _upload("live.txt")
+    asyncio.run(_enqueue(uploaded["file_name"]))
+    drain_outbox()
+    assert _object_exists(moto_s3, uploaded["file_name"])
+    assert asyncio.run(_pending(uploaded["file_name"])) == []
+
+
+def test_orphan_sweep_schedules_unreferenced_objects(moto_s3, mocker, drain_outbox):
+    live = _upload("swept-live.txt")
+    orphan_key = "swept-orphan.txt"
+    moto_s3.put_object(Bucket=s3_service.S3_BUCKET_NAME, Key=orphan_key, Body=b"x")
+    # Treat every object as older than the grace period
+    mocker.patch.object(outbox, "OUTBOX_UPLOAD_GRACE", -60)
+
+    assert asyncio.run(outbox.sweep_orphaned_objects()) >= 1
+    assert [op.reason for op in asyncio.run(_pending(orphan_key))] == ["orphan"]
+    drain_outbox()
+    assert not _object_exists(moto_s3, orphan_key)
+    assert _object_exists(moto_s3, live["file_name"])
+
+
+def test_orphan_sweep_runs_in_one_process_per_interval(moto_s3, mocker):
+    sweep = mocker.patch("outbox.sweep_orphaned_objects")
+    reconcile = mocker.patch("outbox.reconcile_blob_ref_counts")
+    assert asyncio.run(outbox.run_orphan_sweep(3600)) is True
+    # Another worker waking up in the same interval
+    assert asyncio.run(outbox.run_orphan_sweep(3600)) is False
+    assert sweep.call_count == reconcile.call_count == 1
+
+    # Once the lease has expired the next process takes it over
+    assert asyncio.run(outbox.acquire_lease("expiring", -1)) is True
+    assert asyncio.run(outbox.acquire_lease("expiring", 60)) is True
+    assert asyncio.run(outbox.acquire_lease("expiring", 60)) is False
+
+
+def test_retry_delay_backs_off_to_a_cap():
+    assert outbox._retry_delay(1) == outbox.OUTBOX_RETRY_BASE
+    assert outbox._retry_delay(2) == outbox.OUTBOX_RETRY_BASE * 2
+    assert outbox._retry_delay(50) == outbox.OUTBOX_RETRY_MAX
@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import uuid
+import httpx
+from sqlalchemy import update
+from fastapi.testclient import TestClient
+import presign
+import s3_service
+import upload_sessions
+from database import AsyncSessionLocal
+from models import DirectUpload
+from main import app
+
+client = TestClient(app)
+
+
+def _start(file_name, size, **extra):
+    response = client.post("/v1/uploads", json={"file_name": file_name, "size": size, **extra})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def _complete(upload):
+    return client.post(f"/v1/uploads/{upload['file_id']}/complete")
+
+
+def test_single_request_direct_upload(moto_s3):
+    content = b"direct upload " * 100
+    upload = _start("direct.txt", len(content), content_type="text/plain")
+    assert upload["method"] == "POST"
+
+    response = httpx.post(upload["url"], data=upload["fields"], files={"file": ("direct.txt", content)})
+    assert response.status_code == 204, response.text
+
+    response = _complete(upload)
+    assert response.status_code == 201, response.text
+    body = response.json()
+    assert body["file_id"] == upload["file_id"]
+    assert body["size"] == len(content)
+    stored = moto_s3.get_object(Bucket=s3_service.S3_BUCKET_NAME, Key=upload["file_name"])["Body"].read()
+    assert stored == content
+
+    metadata = client.get(f"/v1/file/{upload['file_id']}")
+    assert metadata.status_code == 200
+    assert metadata.json()["file_name"] == upload["file_name"]
+    assert metadata.json()["upload_date"] == body["upload_date"]
+    assert body["upload_date"].endswith("+00:00")
+
+
+def test_multipart_direct_upload(moto_s3):
+    content = b"m" * (s3_service.S3_PART_SIZE + 1024)
+    upload = _start("big.bin", len(content))
+    assert upload["method"] == "PUT"
+    assert [p["part_number"] for p in upload["parts"]] == [1, 2]
+
+    part_size = upload["part_size"]
+    for part in upload["parts"]:
+        offset = (part["part_number"] - 1) * part_size
+        response = httpx.put(part["url"], content=content[offset:offset + part_size])
+        assert response.status_code == 200, response.text
+
+    response = _complete(upload)
+    assert response.status_code == 201, response.text
+    assert response.json()["size"] == len(content)
+    assert not moto_s3.list_multipart_uploads(Bucket=s3_service.S3_BUCKET_NAME).get("Uploads")
+
+
+def test_completing_twice_conflicts(moto_s3):
+    upload = _start("twice.txt", 5)
+    httpx.post(upload["url"], data=upload["fields"], files={"file": ("twice.txt", b"hello")})
+    assert _complete(upload).status_code == 201
+    assert _complete(upload).status_code == 409
+
+
+def test_complete_without_upload_is_rejected(moto_s3):
+    assert client.post(f"/v1/uploads/{uuid.uuid4()}/complete").status_code == 404
+    assert client.post("/v1/uploads/not-a-uuid/complete").status_code == 404
+
+
+def test_complete_uses_the_name_recorded_at_start(moto_s3):
+    upload = _start("issued.txt", 5)
+    httpx.post(upload["url"], data=upload["fields"], files={"file": ("issued.txt", b"hello")})
+    # A name sent on completion must not redirect the files row to another key
+    response = client.post(f"/v1/uploads/{upload['file_id']}/complete", json={"file_name": "other.txt"})
+    assert response.status_code == 201, response.text
+    assert response.json()["file_name"] == upload["file_name"]
+    assert client.get(f"/v1/file/{upload['file_id']}").json()["file_name"] == upload["file_name"]
+
+
+def test_abort_multipart_direct_upload(moto_s3):
+    upload = _start("abandoned.bin", s3_service.S3_PART_SIZE * 2)
+    response = client.post(f"/v1/uploads/{upload['file_id']}/abort")
+    assert response.status_code == 204
+    assert not moto_s3.list_multipart_uploads(Bucket=s3_service.S3_BUCKET_NAME).get("Uploads")
+    assert client.post(f"/v1/uploads/{upload['file_id']}/abort").status_code == 404
+    assert _complete(upload).status_code == 404
+
+
+def test_expired_direct_uploads_are_reaped(moto_s3):
+    upload = _start("forgotten.bin", s3_service.S3_PART_SIZE * 2)
+
+    async def expire_and_reap():
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(DirectUpload)
+                .where(DirectUpload.id == upload["file_id"])
+                .values(expires_at=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+            )
+            await db.commit()
+        return await upload_sessions.reap_expired_direct_uploads()
+
+    assert asyncio.run(expire_and_reap()) == 1
+    assert not moto_s3.list_multipart_uploads(Bucket=s3_service.S3_BUCKET_NAME).get("Uploads")
+    assert _complete(upload).status_code == 404
+
+
+def test_oversized_direct_upload_is_rejected(moto_s3, mocker):
+    mocker.patch("routers.uploads.MAX_UPLOAD_SIZE", 10)
+    response = client.post("/v1/uploads", json={"file_name": "huge.bin", "size": 11})
+    assert response.status_code == 413
+
+
+def test_oversized_completed_upload_is_deleted_through_the_outbox(moto_s3, mocker, drain_outbox):
+    content = b"larger than announced"
+    upload = _start("sneaky.bin", 1)
+    response = httpx.post(upload["url"], data=upload["fields"], files={"file": ("sneaky.bin", content)})
+    # Moto does not enforce the presigned content-length-range condition
+    assert response.status_code == 204, response.text
+    mocker.patch("routers.uploads.MAX_UPLOAD_SIZE", len(content) - 1)
+
+    assert _complete(upload).status_code == 413
+    key = upload["file_name"]
+    assert moto_s3.head_object(Bucket=s3_service.S3_BUCKET_NAME, Key=key)
+    drain_outbox()
+    assert not moto_s3.list_objects_v2(Bucket=s3_service.S3_BUCKET_NAME, Prefix=key).get("Contents")
+
+
+def test_invalid_direct_upload_request():
+    assert client.post("/v1/uploads", json={"file_name": "x.bin", "size": 0}).status_code == 400
+    assert client.post("/v1/uploads", content=b"not json").status_code == 400
+    assert client.get("/v1/uploads").status_code == 405
+
+
+def test_presigned_download_url_is_cached(moto_s3):
+    content = b"download me"
+    response = client.post("/v1/file", files={"file": ("download.txt", content)})
+    assert response.status_code == 201
+    file_id = response.json()["file_id"]
+
+    assert "download_url" not in client.get(f"/v1/file/{file_id}").json()
+    first = client.get(f"/v1/file/{file_id}?presign=true").json()["download_url"]
+    second = client.get(f"/v1/file/{file_id}?presign=true").json()["download_url"]
+    assert first == second
+    assert httpx.get(first).content == content
+
+
+def test_download_url_is_not_cached_inside_refresh_margin(moto_s3, mocker):
+    mocker.patch.object(presign, "PRESIGN_REFRESH_MARGIN", presign.PRESIGN_DOWNLOAD_EXPIRY)
+    set_spy = mocker.spy(presign.download_url_cache, "set")
+    response = client.post("/v1/file", files={"file": ("fresh.txt", b"fresh")})
+    client.get(f"/v1/file/{response.json()['file_id']}?presign=true")
+    set_spy.assert_not_called()
@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+import models
+import readiness
+from database import AsyncSessionLocal
+from readiness import ReadinessProbe, prune_health_checks
+from main import app
+
+client = TestClient(app)
+
+
+def test_livez_success():
+    response = client.get("/livez")
+    assert response.status_code == 200
+    assert response.text == ""
+    assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
+    assert response.headers["Pragma"] == "no-cache"
+
+
+def test_livez_does_not_touch_database(mocker):
+    check = mocker.patch("readiness.check_database")
+    assert client.get("/livez").status_code == 200
+    check.assert_not_called()
+
+
+def test_livez_with_query_params():
+    assert client.get("/livez?param=test").status_code == 400
+
+
+@pytest.mark.parametrize("method", ["POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+def test_livez_method_not_allowed(method):
+    response = client.request(method, "/livez")
+    assert response.status_code == 405
+    assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
+
+
+def test_readiness_probe_single_flight_and_cached():
+    calls = 0
+
+    async def slow_check():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+
+    now = [0.0]
+    probe = ReadinessProbe(slow_check, interval=5, clock=lambda: now[0])
+
+    async def run():
+        results = await asyncio.gather(*(probe.is_ready() for _ in range(20)))
+        assert all(results)
+        assert calls == 1
+        assert await probe.is_ready()
+        assert calls == 1
+        now[0] = 6
+        assert await probe.is_ready()
+        assert calls == 2
+
+    asyncio.run(run())
+
+
+def test_readiness_probe_reports_failures():
+    async def failing_check():
+        raise RuntimeError("db down")
+
+    probe = ReadinessProbe(failing_check, interval=0)
+    assert asyncio.run(probe.is_ready()) is False
+
+
+def test_readiness_checks_s3_when_enabled(moto_s3, monkeypatch, mocker):
+    monkeypatch.setattr(readiness, "HEALTHZ_CHECK_S3", True)
+    head_bucket = mocker.spy(moto_s3, "head_bucket")
+    asyncio.run(readiness.run_checks())
+    assert head_bucket.call_count == 1
+
+
+def test_prune_health_checks_removes_only_expired_rows():
+    async def run():
+        old = datetime.datetime.utcnow() - datetime.timedelta(hours=48)
+        async with AsyncSessionLocal() as db:
+            db.add_all([models.HealthCheck(datetime=old) for _ in range(3)])
+            db.add(models.HealthCheck())
+            await db.commit()
+        deleted = await prune_health_checks(retention_hours=24)
+        async with AsyncSessionLocal() as db:
+            remaining_old = await db.scalar(
+                select(func.count()).select_from(models.HealthCheck).where(models.HealthCheck.datetime < old + datetime.timedelta(hours=1))
+            )
+        return deleted, remaining_old
+
+    deleted, remaining_old = asyncio.run(run())
+    assert deleted >= 3
+    assert remaining_old == 0
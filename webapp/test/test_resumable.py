@@ -0,0 +1,235 @@
+import asyncio
+import datetime
+import uuid
+from fastapi.testclient import TestClient
+from sqlalchemy import select, update
+import idempotency
+import s3_service
+import upload_sessions
+import upload_stream
+from database import AsyncSessionLocal
+from models import IdempotencyKey, UploadSession, UploadSessionPart
+from main import app
+
+client = TestClient(app)
+
+PART = s3_service.S3_PART_SIZE
+
+
+def _create_session(size, file_name="resume.bin"):
+    response = client.post("/v1/uploads/sessions", json={"file_name": file_name, "size": size})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def _put(session, content, start, end=None, total=None):
+    end = start + len(content) if end is None else end
+    total = session["size"] if total is None else total
+    return client.put(
+        f"/v1/uploads/sessions/{session['session_id']}",
+        content=content,
+        headers={"Content-Range": f"bytes {start}-{end - 1}/{total}"},
+    )
+
+
+def _offset(session):
+    return client.get(f"/v1/uploads/sessions/{session['session_id']}").json()["offset"]
+
+
+def _stored(s3, key):
+    return s3.get_object(Bucket=s3_service.S3_BUCKET_NAME, Key=key)["Body"].read()
+
+
+async def _parts(session_id):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(UploadSessionPart).where(UploadSessionPart.session_id == session_id))
+        return result.scalars().all()
+
+
+def test_resumable_upload_in_chunks(moto_s3):
+    content = bytes(range(256)) * ((2 * PART + 1000) // 256 + 1)
+    session = _create_session(len(content))
+    assert session["offset"] == 0
+    assert session["part_size"] == PART
+
+    response = _put(session, content[:PART], 0)
+    assert response.status_code == 200, response.text
+    assert response.json()["offset"] == PART
+    assert _offset(session) == PART
+
+    response = _put(session, content[PART:], PART)
+    assert response.json()["offset"] == len(content)
+
+    response = client.post(f"/v1/uploads/sessions/{session['session_id']}/complete")
+    assert response.status_code == 201, response.text
+    body = response.json()
+    assert body["file_id"] == session["session_id"]
+    assert body["upload_date"].endswith("+00:00")
+    assert body["size"] == len(content)
+    assert _stored(moto_s3, session["file_name"]) == content
+    assert client.get(f"/v1/file/{body['file_id']}").status_code == 200
+
+    # A retried complete returns the same file and the session is gone
+    retry = client.post(f"/v1/uploads/sessions/{session['session_id']}/complete")
+    assert retry.status_code == 200
+    assert retry.json()["file_id"] == body["file_id"]
+    assert client.get(f"/v1/uploads/sessions/{session['session_id']}").status_code == 404
+    assert asyncio.run(_parts(session["session_id"])) == []
+
+
+def test_cut_off_chunk_keeps_its_complete_parts(moto_s3):
+    content = b"r" * (2 * PART + 10)
+    session = _create_session(len(content))
+
+    # The client meant to send two parts but the body stopped early
+    response = _put(session, content[:PART + 100], 0, end=2 * PART)
+    assert response.status_code == 200
+    assert response.json()["offset"] == PART
+
+    # Resending from the wrong place is refused with the offset to resume from
+    response = _put(session, content[:PART], 0)
+    assert response.status_code == 409
+    assert response.json() == {"offset": PART}
+
+    assert _put(session, content[PART:], PART).json()["offset"] == len(content)
+    assert client.post(f"/v1/uploads/sessions/{session['session_id']}/complete").status_code == 201
+    assert _stored(moto_s3, session["file_name"]) == content
+
+
+def test_complete_before_all_bytes_conflicts(moto_s3):
+    session = _create_session(PART + 10)
+    _put(session, b"x" * PART, 0)
+    response = client.post(f"/v1/uploads/sessions/{session['session_id']}/complete")
+    assert response.status_code == 409
+    assert response.json() == {"offset": PART}
+    assert client.delete(f"/v1/uploads/sessions/{session['session_id']}").status_code == 204
+
+
+def test_invalid_chunks_are_rejected(moto_s3):
+    session = _create_session(PART + 10)
+    # Not a whole part and not the tail
+    assert _put(session, b"x" * 100, 0).status_code == 400
+    # Total does not match the session
+    assert _put(session, b"x" * PART, 0, total=PART * 3).status_code == 400
+    # Missing Content-Range
+    response = client.put(f"/v1/uploads/sessions/{session['session_id']}", content=b"x")
+    assert response.status_code == 400
+    assert client.put(f"/v1/uploads/sessions/{uuid.uuid4()}", content=b"x",
+                      headers={"Content-Range": "bytes 0-0/1"}).status_code == 404
+    assert client.delete(f"/v1/uploads/sessions/{session['session_id']}").status_code == 204
+
+
+def test_abort_upload_session(moto_s3):
+    session = _create_session(PART * 2)
+    _put(session, b"a" * PART, 0)
+    assert client.delete(f"/v1/uploads/sessions/{session['session_id']}").status_code == 204
+    assert client.get(f"/v1/uploads/sessions/{session['session_id']}").status_code == 404
+    uploads = moto_s3.list_multipart_uploads(Bucket=s3_service.S3_BUCKET_NAME).get("Uploads", [])
+    assert session["file_name"] not in {u["Key"] for u in uploads}
+
+
+async def _expire(session_id):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(UploadSession)
+            .where(UploadSession.id == session_id)
+            .values(expires_at=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        )
+        await db.commit()
+
+
+def test_reaper_aborts_expired_sessions(moto_s3):
+    session = _create_session(PART * 2)
+    _put(session, b"a" * PART, 0)
+    asyncio.run(_expire(session["session_id"]))
+    assert client.get(f"/v1/uploads/sessions/{session['session_id']}").status_code == 404
+
+    assert asyncio.run(upload_sessions.reap_expired_sessions()) >= 1
+    assert asyncio.run(_parts(session["session_id"])) == []
+    uploads = moto_s3.list_multipart_uploads(Bucket=s3_service.S3_BUCKET_NAME).get("Uploads", [])
+    assert session["file_name"] not in {u["Key"] for u in uploads}
+
+
+def test_oversized_session_is_rejected(mocker):
+    mocker.patch("routers.uploads.MAX_UPLOAD_SIZE", 10)
+    response = client.post("/v1/uploads/sessions", json={"file_name": "huge.bin", "size": 11})
+    assert response.status_code == 413
+
+
+def _upload_with_key(key, content=b"idempotent upload"):
+    return client.post("/v1/file", files={"file": ("idem.txt", content)}, headers={"Idempotency-Key": key})
+
+
+def test_idempotency_key_replays_the_first_upload(moto_s3):
+    key = str(uuid.uuid4())
+    first = _upload_with_key(key)
+    assert first.status_code == 201
+    second = _upload_with_key(key)
+    assert second.status_code == 201
+    assert second.json() == first.json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+
+    prefix = first.json()["file_id"]
+    listed = moto_s3.list_objects_v2(Bucket=s3_service.S3_BUCKET_NAME, Prefix=prefix)
+    assert listed["KeyCount"] == 1
+
+
+def test_replayed_response_from_before_offsets_gains_utc(moto_s3):
+    key = str(uuid.uuid4())
+    first = _upload_with_key(key).json()
+    assert first["upload_date"].endswith("+00:00")
+    row = asyncio.run(_age_key(key, 0))
+    row.response = row.response.replace("+00:00", "")
+    assert idempotency.stored_response(row)["upload_date"] == first["upload_date"]
+
+
+def test_idempotency_key_in_progress_conflicts(moto_s3):
+    key = str(uuid.uuid4())
+    assert asyncio.run(idempotency.reserve_key(key, str(uuid.uuid4()))) is None
+    assert _upload_with_key(key).status_code == 409
+
+
+def test_idempotency_key_reused_for_another_request_is_rejected(moto_s3):
+    key = str(uuid.uuid4())
+    assert _upload_with_key(key).status_code == 201
+    assert _upload_with_key(key, content=b"a different file").status_code == 422
+    assert _upload_with_key(key).status_code == 201
+
+    # A reservation in progress is checked the same way
+    other = str(uuid.uuid4())
+    asyncio.run(idempotency.reserve_key(other, str(uuid.uuid4()), "another request"))
+    assert _upload_with_key(other).status_code == 422
+
+
+def test_failed_upload_releases_its_key(moto_s3, mocker):
+    key = str(uuid.uuid4())
+    mocker.patch.object(upload_stream, "MAX_UPLOAD_SIZE", 1)
+    assert _upload_with_key(key).status_code == 413
+    mocker.stopall()
+    assert _upload_with_key(key).status_code == 201
+
+
+async def _age_key(key, hours):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key)
+            .values(created_at=datetime.datetime.utcnow() - datetime.timedelta(hours=hours))
+        )
+        await db.commit()
+        return await db.get(IdempotencyKey, key)
+
+
+def test_abandoned_reservation_is_taken_over(moto_s3):
+    key = str(uuid.uuid4())
+    asyncio.run(idempotency.reserve_key(key, str(uuid.uuid4())))
+    asyncio.run(_age_key(key, 2))
+    assert _upload_with_key(key).status_code == 201
+
+
+def test_expired_keys_are_pruned(moto_s3):
+    key = str(uuid.uuid4())
+    _upload_with_key(key)
+    asyncio.run(_age_key(key, idempotency.IDEMPOTENCY_KEY_TTL_HOURS + 1))
+    assert asyncio.run(idempotency.prune_idempotency_keys()) >= 1
+    assert asyncio.run(_age_key(key, 0)) is None
@@ -0,0 +1,39 @@
+from fastapi.testclient import TestClient
+import database
+import run
+import s3_service
+from main import app
+
+
+def test_production_options_use_workers_without_reload(mocker):
+    mocker.patch.object(run, "WEB_CONCURRENCY", 4)
+    mocker.patch.object(run, "SHARED_METADATA_CACHE", True)
+    options = run.server_options("production")
+    assert options["workers"] == 4
+    assert "reload" not in options
+    assert options["loop"] == "auto" and options["http"] == "auto"
+    assert options["timeout_graceful_shutdown"] == run.GRACEFUL_SHUTDOWN_TIMEOUT
+
+
+def test_multiple_workers_with_in_process_cache_warn(mocker):
+    mocker.patch.object(run, "WEB_CONCURRENCY", 4)
+    mocker.patch.object(run, "SHARED_METADATA_CACHE", False)
+    warning = mocker.patch("logger_util.logging.Logger.warning")
+    assert run.server_options("production")["workers"] == 4
+    assert "in-process metadata cache" in warning.call_args.args[0]
+
+
+def test_development_options_keep_reload():
+    options = run.server_options("development")
+    assert options["reload"] is True
+    assert "workers" not in options
+
+
+def test_lifespan_opens_and_disposes_per_worker_resources(moto_s3):
+    with TestClient(app) as client:
+        assert database.async_engine is not None
+        assert s3_service.s3_client is moto_s3
+        assert client.get("/healthz").status_code == 200
+    assert database.async_engine is None
+    # Sessions still work after shutdown; a fresh engine is created on demand
+    assert TestClient(app).get("/v1/file/missing").status_code == 404
@@ -0,0 +1,147 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+import s3_service
+import upload_stream
+from main import app
+
+client = TestClient(app)
+
+PART_SIZE = s3_service.S3_MIN_PART_SIZE
+
+
+@pytest.fixture
+def streaming(moto_s3, monkeypatch):
+    monkeypatch.setattr(upload_stream, "UPLOAD_STREAMING", True)
+    monkeypatch.setattr(s3_service, "S3_PART_SIZE", PART_SIZE)
+    return moto_s3
+
+
+def _pending_multipart_uploads(s3):
+    response = s3.list_multipart_uploads(Bucket=s3_service.S3_BUCKET_NAME)
+    return response.get("Uploads", [])
+
+
+def test_streaming_upload_small_file(streaming):
+    response = client.post("/v1/file", files={"file": ("small.txt", b"hello world", "text/plain")})
+    assert response.status_code == 201
+    body = response.json()
+    assert body["size"] == 11
+    stored = streaming.get_object(Bucket=s3_service.S3_BUCKET_NAME, Key=body["file_name"])
+    assert stored["Body"].read() == b"hello world"
+
+
+def test_streaming_upload_multipart(streaming):
+    payload = b"a" * PART_SIZE + b"b" * PART_SIZE + b"tail"
+    response = client.post("/v1/file", files={"file": ("big.bin", payload)}, data={"note": "ignored"})
+    assert response.status_code == 201
+    body = response.json()
+    assert body["size"] == len(payload)
+    stored = streaming.get_object(Bucket=s3_service.S3_BUCKET_NAME, Key=body["file_name"])
+    assert stored["Body"].read() == payload
+    assert _pending_multipart_uploads(streaming) == []
+
+
+def test_streaming_upload_without_file(streaming):
+    response = client.post("/v1/file", data={"note": "no file here"})
+    assert response.status_code == 400
+    assert response.headers["Cache-Control"] == "no-cache, no-store, must-revalidate"
+
+
+def test_streaming_upload_over_limit_aborts(streaming, monkeypatch):
+    monkeypatch.setattr(upload_stream, "MAX_UPLOAD_SIZE", PART_SIZE + 10)
+    response = client.post("/v1/file", files={"file": ("huge.bin", b"z" * (PART_SIZE * 2))})
+    assert response.status_code == 413
+    assert _pending_multipart_uploads(streaming) == []
+
+
+def test_streaming_upload_client_disconnect_aborts(streaming):
+    boundary = "testboundary"
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="cut.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    chunks = [head + b"x" * PART_SIZE, b"y" * PART_SIZE]
+
+    async def receive_gen():
+        for chunk in chunks:
+            yield {"type": "http.request", "body": chunk, "more_body": True}
+        yield {"type": "http.disconnect"}
+
+    messages = receive_gen()
+    sent = []
+
+    async def receive():
+        return await messages.__anext__()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "POST", "path": "/v1/file",
+        "raw_path": b"/v1/file", "query_string": b"", "root_path": "", "scheme": "http",
+        "server": ("test", 80), "client": ("127.0.0.1", 1234),
+        "headers": [(b"content-type", f"multipart/form-data; boundary={boundary}".encode())],
+    }
+    asyncio.run(app(scope, receive, send))
+
+    assert sent[0]["status"] == 400
+    assert _pending_multipart_uploads(streaming) == []
+
+
+
+def test_abort_after_complete_leaves_the_object(streaming, mocker):
+    async def upload():
+        writer = s3_service.S3MultipartWriter("done.bin")
+        await writer.write(b"d" * (PART_SIZE + 1))
+        metadata = await writer.complete()
+        await writer.abort()
+        return metadata
+
+    error = mocker.patch.object(s3_service.logger, "error")
+    metadata = asyncio.run(upload())
+    error.assert_not_called()
+    stored = streaming.get_object(Bucket=s3_service.S3_BUCKET_NAME, Key=metadata["s3_key"])
+    assert stored["ContentLength"] == PART_SIZE + 1
+
+def test_buffered_upload_refuses_declared_oversize_before_spooling(moto_s3, mocker):
+    mocker.patch.object(upload_stream, "MAX_UPLOAD_SIZE", 10)
+    form = mocker.spy(upload_stream.Request, "form")
+    content = b"z" * (upload_stream.MAX_FORM_OVERHEAD + 100)
+    response = client.post("/v1/file", files={"file": ("declared.bin", content)})
+    assert response.status_code == 413
+    form.assert_not_called()
+
+
+def test_buffered_upload_stops_reading_an_unbounded_body(moto_s3):
+    boundary = "testboundary"
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="endless.bin"\r\n\r\n'
+    ).encode()
+    read = []
+
+    async def receive():
+        read.append(1)
+        return {"type": "http.request", "body": (head if len(read) == 1 else b"") + b"x" * 1024, "more_body": True}
+
+    scope = {
+        "type": "http", "method": "POST", "path": "/v1/file", "query_string": b"",
+        "headers": [(b"content-type", f"multipart/form-data; boundary={boundary}".encode())],
+    }
+    request = upload_stream.Request(scope, receive)
+    with pytest.raises(upload_stream.UploadTooLargeError):
+        asyncio.run(upload_stream.upload_form_file_to_s3(request, "endless", max_size=4096))
+    assert len(read) <= (4096 + upload_stream.MAX_FORM_OVERHEAD) // 1024 + 1
+
+
+@pytest.mark.parametrize("streaming_mode", [False, True], ids=["buffered", "streaming"])
+def test_upload_size_limit_boundary(moto_s3, monkeypatch, streaming_mode):
+    monkeypatch.setattr(upload_stream, "UPLOAD_STREAMING", streaming_mode)
+    monkeypatch.setattr(upload_stream, "MAX_UPLOAD_SIZE", 1000)
+    at_limit = client.post("/v1/file", files={"file": ("limit.bin", b"x" * 1000)})
+    assert at_limit.status_code == 201, at_limit.text
+    assert at_limit.json()["size"] == 1000
+    over = client.post("/v1/file", files={"file": ("over.bin", b"x" * 1001)})
+    assert over.status_code == 413
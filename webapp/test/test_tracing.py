@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+import uuid
+import pytest
+from fastapi.testclient import TestClient
+import profiler
+import tracing
+from main import app
+
+client = TestClient(app)
+
+
+class _Collector:
+    """Stands in for the background exporter and keeps finished spans"""
+
+    def __init__(self):
+        self.spans = []
+
+    def submit(self, span):
+        self.spans.append(span)
+
+    def named(self, prefix):
+        return [span for span in self.spans if span.name.startswith(prefix)]
+
+
+@pytest.fixture
+def spans(mocker):
+    collector = _Collector()
+    mocker.patch.object(tracing, "TRACING_ENABLED", True)
+    mocker.patch.object(tracing, "TRACE_SAMPLE_RATE", 1.0)
+    mocker.patch.object(tracing, "exporter", collector)
+    return collector
+
+
+def _upload(name="traced.txt"):
+    response = client.post("/v1/file", files={"file": (name, b"traced")})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def test_get_file_records_request_db_and_serialize_spans(moto_s3, spans):
+    uploaded = _upload()
+    spans.spans.clear()
+    assert client.get(f"/v1/file/{uploaded['file_id']}").status_code == 200
+
+    [root] = spans.named("GET ")
+    assert root.name == "GET /v1/file/{id}"
+    assert root.kind == tracing.SPAN_KIND_SERVER
+    assert root.parent_id is None
+    assert root.attributes["http.status_code"] == 200
+    queries = spans.named("db SELECT")
+    assert queries and all(q.parent_id == root.span_id and q.trace_id == root.trace_id for q in queries)
+    assert "FROM files" in queries[0].attributes["db.statement"]
+    [serialize] = spans.named("response.serialize")
+    assert serialize.parent_id == root.span_id
+    assert all(span.end_unix_ns >= span.start_unix_ns for span in spans.spans)
+
+
+def test_upload_records_s3_client_spans(moto_s3, spans):
+    _upload()
+    s3_spans = spans.named("s3 ")
+    assert "s3 put_object" in {span.name for span in s3_spans}
+    assert all(span.kind == tracing.SPAN_KIND_CLIENT for span in s3_spans)
+
+
+def test_incoming_traceparent_is_continued(spans):
+    trace_id, parent_id = uuid.uuid4().hex, uuid.uuid4().hex[:16]
+    client.get("/livez", headers={"traceparent": f"00-{trace_id}-{parent_id}-01"})
+    [root] = spans.spans
+    assert (root.trace_id, root.parent_id) == (trace_id, parent_id)
+
+    spans.spans.clear()
+    client.get("/livez", headers={"traceparent": f"00-{trace_id}-{parent_id}-00"})
+    assert spans.spans == []
+
+
+def test_request_id_becomes_the_trace_id(spans):
+    request_id = uuid.uuid4().hex
+    client.get("/livez", headers={"X-Request-ID": request_id})
+    [root] = spans.spans
+    assert root.trace_id == request_id
+    assert root.attributes["request_id"] == request_id
+
+
+def test_unsampled_and_disabled_requests_create_no_spans(spans, mocker):
+    mocker.patch.object(tracing, "TRACE_SAMPLE_RATE", 0.0)
+    client.get("/livez")
+    mocker.patch.object(tracing, "TRACE_SAMPLE_RATE", 1.0)
+    mocker.patch.object(tracing, "TRACING_ENABLED", False)
+    client.get("/livez")
+    assert spans.spans == []
+
+
+def test_file_exporter_writes_otlp_json(tmp_path, mocker):
+    trace_file = tmp_path / "traces.jsonl"
+    mocker.patch.object(tracing, "TRACE_FILE", str(trace_file))
+    mocker.patch.object(tracing, "TRACE_EXPORTER", "file")
+    exporter = tracing.SpanExporter()
+    mocker.patch.object(tracing, "exporter", exporter)
+
+    root = tracing.Span("GET /livez", tracing.SPAN_KIND_SERVER, uuid.uuid4().hex, attributes={"http.status_code": 200})
+    child = tracing.Span("db SELECT", tracing.SPAN_KIND_CLIENT, root.trace_id, root.span_id, {"db.system": "sqlite"})
+    child.record_error(ValueError("boom"))
+    child.end()
+    root.end()
+    exporter.stop()
+
+    [line] = trace_file.read_text().splitlines()
+    resource_spans = json.loads(line)["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"][0] == {
+        "key": "service.name", "value": {"stringValue": tracing.TRACE_SERVICE_NAME},
+    }
+    exported = {span["name"]: span for span in resource_spans["scopeSpans"][0]["spans"]}
+    assert exported["db SELECT"]["parentSpanId"] == root.span_id
+    assert exported["db SELECT"]["status"] == {"code": 2, "message": "ValueError: boom"}
+    assert exported["GET /livez"]["attributes"] == [{"key": "http.status_code", "value": {"intValue": "200"}}]
+    assert int(exported["GET /livez"]["endTimeUnixNano"]) >= int(exported["GET /livez"]["startTimeUnixNano"])
+
+
+def _busy_wait_for_profile(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profiler_collects_collapsed_stacks():
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy_wait_for_profile, args=(stop,), name="busy-worker")
+    worker.start()
+    try:
+        stacks = profiler.sample_stacks(0.1, interval=0.001)
+    finally:
+        stop.set()
+        worker.join()
+
+    busy = [stack for stack in stacks if stack.startswith("busy-worker;")]
+    assert busy and all("_busy_wait_for_profile (test_tracing.py:" in stack for stack in busy)
+    line = profiler.collapsed_text(stacks).splitlines()[0]
+    stack, count = line.rsplit(" ", 1)
+    assert int(count) == max(stacks.values())
+
+
+def test_profile_endpoint(mocker):
+    assert client.get("/debug/profile").status_code == 404
+
+    mocker.patch("routers.monitoring.PROFILER_ENABLED", True)
+    assert client.get("/debug/profile?seconds=0").status_code == 400
+    assert client.get("/debug/profile?seconds=abc").status_code == 400
+    assert client.get("/debug/profile?seconds=1000").status_code == 400
+    assert client.post("/debug/profile").status_code == 405
+
+    response = client.get("/debug/profile?seconds=0.05")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert response.text.endswith("\n")
+
+    with profiler._profile_lock:
+        assert client.get("/debug/profile?seconds=0.05").status_code == 409
+
+
+def test_delete_of_missing_file_is_recorded_as_delete(mocker):
+    record = mocker.patch("routers.files.record_api_metric")
+    start = time.perf_counter()
+    assert client.delete(f"/v1/file/{uuid.uuid4()}").status_code == 404
+    name, duration = record.call_args.args
+    assert name == "delete_file"
+    assert 0 <= duration <= (time.perf_counter() - start) * 1000
@@ -0,0 +1,62 @@
+import asyncio
+import time
+import httpx
+import s3_service
+from main import app
+
+UPLOAD_DELAY = 1.0  # seconds each simulated S3 transfer takes
+CONCURRENT_UPLOADS = 4
+SAMPLE_WINDOW = 0.5  # seconds of GET traffic sampled while uploads run
+
+
+def _p99(samples):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+async def _sample_get_latencies(client, window):
+    latencies = []
+    deadline = time.perf_counter() + window
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.get("/v1/file/does-not-exist")
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 404
+    return latencies
+
+
+async def _run_load():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        baseline = await _sample_get_latencies(client, 0.2)
+        # Keep GET traffic running for the whole upload window so any stall
+        # of the event loop shows up in the measured latencies
+        sampler = asyncio.create_task(_sample_get_latencies(client, SAMPLE_WINDOW))
+        await asyncio.sleep(0.01)
+        uploads = [
+            asyncio.create_task(client.post("/v1/file", files={"file": (f"load-{i}.bin", b"x" * 1024)}))
+            for i in range(CONCURRENT_UPLOADS)
+        ]
+        under_load = await sampler
+        upload_responses = await asyncio.gather(*uploads)
+    return baseline, under_load, upload_responses
+
+
+def test_get_latency_flat_while_uploads_in_flight(moto_s3, mocker):
+    real_upload = moto_s3.put_object
+
+    def slow_upload(*args, **kwargs):
+        time.sleep(UPLOAD_DELAY)
+        return real_upload(*args, **kwargs)
+
+    mocker.patch.object(moto_s3, "put_object", side_effect=slow_upload)
+
+    baseline, under_load, upload_responses = asyncio.run(_run_load())
+
+    assert all(r.status_code == 201 for r in upload_responses)
+    # If S3 I/O ran on the event loop every GET would wait out a full upload
+    assert len(under_load) > 10
+    assert _p99(under_load) < UPLOAD_DELAY / 4, (
+        f"GET p99 {_p99(under_load) * 1000:.1f} ms under upload load "
+        f"(baseline p99 {_p99(baseline) * 1000:.1f} ms)"
+    )
@@ -0,0 +1,91 @@
+import datetime
+import hashlib
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect, text
+import s3_service
+import upload_stream
+from content_info import sniff_content_type
+import migrations
+from migrations import apply_migrations
+from main import app
+
+client = TestClient(app)
+
+PNG_BYTES = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_upload_records_checksum_without_head_object(moto_s3, mocker, monkeypatch, streaming):
+    monkeypatch.setattr(upload_stream, "UPLOAD_STREAMING", streaming)
+    head_object = mocker.spy(moto_s3, "head_object")
+
+    response = client.post("/v1/file", files={"file": ("logo", PNG_BYTES, "application/octet-stream")})
+
+    assert response.status_code == 201
+    body = response.json()
+    assert head_object.call_count == 0
+    assert body["size"] == len(PNG_BYTES)
+    assert body["checksum"] == f"sha256:{hashlib.sha256(PNG_BYTES).hexdigest()}"
+    assert datetime.datetime.fromisoformat(body["upload_date"]).utcoffset() == datetime.timedelta(0)
+
+    stored = moto_s3.head_object(Bucket=s3_service.S3_BUCKET_NAME, Key=body["file_name"])
+    assert stored["ContentType"] == "image/png"
+
+    fetched = client.get(f"/v1/file/{body['file_id']}").json()
+    assert fetched["checksum"] == body["checksum"]
+    assert fetched["upload_date"] == body["upload_date"]
+    batch = client.post("/v1/files/batch", json={"ids": [body["file_id"]]}).json()
+    assert batch["files"][0]["upload_date"] == body["upload_date"]
+
+
+@pytest.mark.parametrize("algorithm", ["md5", "crc32"])
+def test_upload_with_alternate_checksum(moto_s3, monkeypatch, algorithm):
+    monkeypatch.setattr(s3_service, "UPLOAD_CHECKSUM_ALGORITHM", algorithm)
+    response = client.post("/v1/file", files={"file": ("notes.txt", b"some text")})
+    assert response.status_code == 201
+    assert response.json()["checksum"].startswith(f"{algorithm}:")
+
+
+def test_sniff_content_type_prefers_declared_then_magic_then_extension():
+    assert sniff_content_type(b"%PDF-1.7", "x.bin", "text/plain") == "text/plain"
+    assert sniff_content_type(b"%PDF-1.7", "x.bin", "application/octet-stream") == "application/pdf"
+    assert sniff_content_type(b"plain", "report.csv") == "text/csv"
+    assert sniff_content_type(b"plain", "noext") == "application/octet-stream"
+
+
+def test_apply_migrations_adds_new_nullable_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE files (id VARCHAR PRIMARY KEY, file_name VARCHAR NOT NULL, "
+            "url VARCHAR NOT NULL, size INTEGER NOT NULL, upload_date DATETIME NOT NULL)"
+        ))
+
+    apply_migrations(engine)
+    apply_migrations(engine)  # idempotent
+
+    columns = {column["name"] for column in inspect(engine).get_columns("files")}
+    assert "checksum" in columns
+
+
+def test_migrations_find_32_bit_size_columns(tmp_path, mocker):
+    engine = create_engine(f"sqlite:///{tmp_path / 'narrow.db'}")
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE files (id VARCHAR PRIMARY KEY, file_name VARCHAR NOT NULL, "
+            "url VARCHAR NOT NULL, size INTEGER NOT NULL, upload_date DATETIME NOT NULL)"
+        ))
+    apply_migrations(engine)
+
+    inspector = inspect(engine)
+    assert ("files", "size") in migrations._integer_columns_to_widen(inspector)
+    # Freshly created tables already use BIGINT
+    assert ("content_blobs", "size") not in migrations._integer_columns_to_widen(inspector)
+
+    connection = mocker.MagicMock()
+    connection.dialect.name = "postgresql"
+    mocker.patch("migrations.inspect", return_value=inspector)
+    migrations._widen_integer_columns(connection)
+    statements = [str(call.args[0]) for call in connection.execute.call_args_list]
+    assert "ALTER TABLE files ALTER COLUMN size TYPE BIGINT" in statements
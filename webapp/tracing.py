@@ -0,0 +1,298 @@
+# tracing.py
+#
+# Request tracing without an SDK dependency. Spans are timed with
+# perf_counter_ns and linked through a ContextVar: the request middleware
+# opens the root span, DB queries (SQLAlchemy cursor events), S3 calls
+# (run_in_s3_executor) and JSON response rendering open children. Finished
+# spans go onto a bounded in-memory queue and a background thread exports
+# them in the OpenTelemetry OTLP/JSON encoding, either appended to a local
+# file (one ExportTraceServiceRequest per line) or POSTed to an OTLP/HTTP
+# collector. When tracing is off, or a request is not sampled, no span
+# objects are created at all.
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.request
+from sqlalchemy import event
+from starlette.responses import JSONResponse
+from logger_util import get_logger
+
+logger = get_logger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+# Fraction of requests traced; an incoming traceparent header's sampled flag wins
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file").lower()  # file | otlp
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "webapp")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "2"))
+TRACE_EXPORT_BATCH = 512
+# Longest db.statement attribute recorded
+MAX_STATEMENT_LENGTH = 500
+
+# OTLP SpanKind / StatusCode values
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+_STATUS_ERROR = 2
+
+_TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+_TRACE_ID = re.compile(r"[0-9a-f]{32}")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """One timed operation; ended spans are handed to the exporter"""
+
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "attributes", "error",
+                 "start_unix_ns", "end_unix_ns", "_start_perf_ns")
+
+    def __init__(self, name, kind, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or ())
+        self.error = None
+        # Wall clock only anchors the span; its duration comes from the monotonic counter
+        self.start_unix_ns = time.time_ns()
+        self._start_perf_ns = time.perf_counter_ns()
+        self.end_unix_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, exc):
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def end(self):
+        self.end_unix_ns = self.start_unix_ns + (time.perf_counter_ns() - self._start_perf_ns)
+        exporter.submit(self)
+
+    @property
+    def duration_ms(self):
+        return (self.end_unix_ns - self.start_unix_ns) / 1e6 if self.end_unix_ns else None
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_unix_ns),
+            "endTimeUnixNano": str(self.end_unix_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            "status": {"code": _STATUS_ERROR, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}  # OTLP/JSON encodes 64-bit ints as strings
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def otlp_payload(spans):
+    """ExportTraceServiceRequest body for `spans`"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", TRACE_SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "webapp.tracing"}, "spans": [span.to_otlp() for span in spans]}],
+        }],
+    }
+
+
+def parse_traceparent(header):
+    """(trace id, parent span id, sampled) from a W3C traceparent header, or None"""
+    match = _TRACEPARENT.fullmatch(header or "")
+    if not match:
+        return None
+    trace_id, parent_id, flags = match.groups()
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_request_span(name, request_id=None, traceparent=None, attributes=None):
+    """Opens the root span for a request and makes it current.
+
+    The trace continues an incoming traceparent; otherwise the request id
+    is used as the trace id when it has the right shape, so logs and traces
+    can be joined on it. Returns (span, token), or (None, None) when the
+    request is not traced.
+    """
+    if not TRACING_ENABLED:
+        return None, None
+    parent = parse_traceparent(traceparent)
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+        if not sampled:
+            return None, None
+    elif random.random() < TRACE_SAMPLE_RATE:
+        trace_id = request_id if request_id and _TRACE_ID.fullmatch(request_id) else secrets.token_hex(16)
+        parent_id = None
+    else:
+        return None, None
+    span = Span(name, SPAN_KIND_SERVER, trace_id, parent_id, attributes)
+    return span, _current_span.set(span)
+
+
+def end_request_span(span, token):
+    _current_span.reset(token)
+    span.end()
+
+
+@contextlib.contextmanager
+def span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """Times the block as a child of the current span; does nothing outside a traced request"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, kind, parent.trace_id, parent.span_id, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def instrument_engine(sync_engine):
+    """Adds a client span per statement executed on `sync_engine` (for async engines, pass .sync_engine)"""
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # SQLAlchemy's asyncio greenlets carry the caller's context, so this sees the request's span
+        parent = _current_span.get()
+        if parent is None or context is None:
+            return
+        operation = statement.split(None, 1)[0].upper() if statement else "QUERY"
+        context._trace_span = Span(f"db {operation}", SPAN_KIND_CLIENT, parent.trace_id, parent.span_id, {
+            "db.system": conn.dialect.name,
+            "db.statement": statement[:MAX_STATEMENT_LENGTH],
+        })
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        query_span = getattr(context, "_trace_span", None)
+        if query_span is not None:
+            context._trace_span = None
+            query_span.end()
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(exception_context):
+        query_span = getattr(exception_context.execution_context, "_trace_span", None)
+        if query_span is not None:
+            exception_context.execution_context._trace_span = None
+            query_span.record_error(exception_context.original_exception)
+            query_span.end()
+
+
+class TracedJSONResponse(JSONResponse):
+    """Default response class: times JSON rendering as its own span"""
+
+    def render(self, content):
+        with span("response.serialize"):
+            return super().render(content)
+
+
+class SpanExporter:
+    """Batches finished spans on a background thread and writes them out as OTLP/JSON"""
+
+    _STOP = object()
+
+    def __init__(self, queue_size=TRACE_QUEUE_SIZE):
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def submit(self, finished_span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(finished_span)
+        except queue.Full:
+            # Never block a request on tracing
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + TRACE_EXPORT_INTERVAL
+            stop = False
+            while len(batch) < TRACE_EXPORT_BATCH:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self.export(batch)
+            if stop:
+                return
+
+    def export(self, spans):
+        body = json.dumps(otlp_payload(spans), separators=(",", ":"))
+        try:
+            if TRACE_EXPORTER == "otlp":
+                request = urllib.request.Request(
+                    TRACE_OTLP_ENDPOINT, data=body.encode(), headers={"Content-Type": "application/json"},
+                )
+                with urllib.request.urlopen(request, timeout=5):
+                    pass
+            else:
+                with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                    f.write(body + "\n")
+        except Exception as e:
+            logger.warning("Dropped %s spans; export failed: %s", len(spans), e)
+
+    def stop(self, timeout=5):
+        """Exports what is queued and stops the thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(self._STOP)
+            thread.join(timeout)
+
+
+exporter = SpanExporter()
+atexit.register(exporter.stop)
@@ -0,0 +1,319 @@
+# upload_sessions.py
+#
+# Resumable uploads. A session wraps an S3 multipart upload: the client PUTs
+# the file in ranged chunks, every part S3 acknowledges is recorded in
+# upload_session_parts, and after a dropped connection the client asks for
+# the current offset and resends only from there. Offsets always fall on
+# part boundaries, so at most one part is ever sent twice. Sessions left
+# idle past UPLOAD_SESSION_TTL_HOURS are aborted by the reaper job.
+import asyncio
+import datetime
+import os
+import re
+import time
+import uuid
+from botocore.exceptions import ClientError
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from database import AsyncSessionLocal
+from models import DirectUpload, FileMetadata, UploadSession, UploadSessionPart
+from presign import part_size_for
+from s3_service import S3_BUCKET_NAME, build_file_url, get_s3_client, run_in_s3_executor
+import idempotency
+import outbox
+from logger_util import get_logger
+from metrics import record_db_metric, record_s3_metric
+
+logger = get_logger(__name__)
+
+# Idle time after which an unfinished session is aborted
+UPLOAD_SESSION_TTL_HOURS = float(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+UPLOAD_SESSION_REAP_INTERVAL = float(os.getenv("UPLOAD_SESSION_REAP_INTERVAL", "300"))
+UPLOAD_SESSION_REAP_BATCH = 100
+
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class InvalidChunkError(Exception):
+    """Raised when a chunk's Content-Range does not fit the session"""
+
+
+class SessionOffsetError(Exception):
+    """Raised when a chunk does not start at the session's current offset"""
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+def _expiry():
+    return datetime.datetime.utcnow() + datetime.timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+
+
+def parse_content_range(header):
+    """(start, end exclusive, total) from a `bytes start-end/total` header"""
+    match = _CONTENT_RANGE.fullmatch(header or "")
+    if not match:
+        raise InvalidChunkError("Content-Range must be 'bytes <start>-<end>/<total>'")
+    start, last, total = (int(value) for value in match.groups())
+    if last < start or last >= total:
+        raise InvalidChunkError(f"Invalid Content-Range {header}")
+    return start, last + 1, total
+
+
+async def create_session(file_name, size, content_type=None):
+    """Opens the S3 multipart upload and records the session"""
+    session_id = str(uuid.uuid4())
+    s3_key = f"{session_id}_{file_name}"
+    params = {"ContentType": content_type} if content_type else {}
+    s3_start = time.perf_counter()
+    response = await run_in_s3_executor(
+        get_s3_client().create_multipart_upload, Bucket=S3_BUCKET_NAME, Key=s3_key, **params,
+    )
+    record_s3_metric("create_upload_session", (time.perf_counter() - s3_start) * 1000)
+    session = UploadSession(
+        id=session_id, s3_key=s3_key, upload_id=response["UploadId"], size=size,
+        part_size=part_size_for(size), content_type=content_type,
+        created_at=datetime.datetime.utcnow(), expires_at=_expiry(),
+    )
+    try:
+        async with AsyncSessionLocal() as db:
+            db.add(session)
+            await db.commit()
+    except SQLAlchemyError:
+        await _abort_multipart(s3_key, response["UploadId"])
+        raise
+    return session
+
+
+async def get_session(db, session_id):
+    """The live session with this id, or None if it is unknown or expired"""
+    session = await db.get(UploadSession, session_id)
+    if session is None or session.expires_at < datetime.datetime.utcnow():
+        return None
+    return session
+
+
+async def received_bytes(db, session_id):
+    """Bytes S3 has acknowledged so far, which is where the next chunk must start"""
+    result = await db.execute(
+        select(func.coalesce(func.sum(UploadSessionPart.size), 0)).where(UploadSessionPart.session_id == session_id)
+    )
+    return int(result.scalar_one())
+
+
+async def _record_part(session, part_number, etag, size):
+    db_start = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        db.add(UploadSessionPart(session_id=session.id, part_number=part_number, etag=etag, size=size))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # The part was sent again; S3 keeps the latest copy, so keep its ETag
+            await db.rollback()
+            await db.execute(
+                update(UploadSessionPart)
+                .where(UploadSessionPart.session_id == session.id, UploadSessionPart.part_number == part_number)
+                .values(etag=etag, size=size)
+                .execution_options(synchronize_session=False)
+            )
+        await db.execute(
+            update(UploadSession)
+            .where(UploadSession.id == session.id)
+            .values(expires_at=_expiry())
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+    record_db_metric("record_upload_part", (time.perf_counter() - db_start) * 1000)
+
+
+async def _upload_part(session, part_number, chunk):
+    s3_start = time.perf_counter()
+    response = await run_in_s3_executor(
+        get_s3_client().upload_part,
+        Bucket=S3_BUCKET_NAME, Key=session.s3_key, UploadId=session.upload_id, PartNumber=part_number, Body=chunk,
+    )
+    record_s3_metric("upload_session_part", (time.perf_counter() - s3_start) * 1000)
+    await _record_part(session, part_number, response["ETag"], len(chunk))
+
+
+async def write_chunk(session, offset, content_range, stream):
+    """Uploads one ranged chunk and returns the session's new offset.
+
+    Each part is recorded as soon as S3 acknowledges it, so a chunk cut off
+    by a dropped connection still advances the offset by every complete part
+    it delivered.
+    """
+    start, end, total = content_range
+    if total != session.size:
+        raise InvalidChunkError(f"Total size {total} does not match the session size {session.size}")
+    if start != offset:
+        raise SessionOffsetError(offset)
+    if end != total and (end - start) % session.part_size:
+        raise InvalidChunkError(f"Chunks other than the last must be a multiple of {session.part_size} bytes")
+
+    part_number = start // session.part_size + 1
+    buffer = bytearray()
+    received = 0
+    async for data in stream:
+        received += len(data)
+        if received > end - start:
+            raise InvalidChunkError("Body is longer than its Content-Range")
+        buffer += data
+        while len(buffer) >= session.part_size:
+            await _upload_part(session, part_number, bytes(buffer[:session.part_size]))
+            del buffer[:session.part_size]
+            part_number += 1
+            offset += session.part_size
+    if buffer and offset + len(buffer) == total:
+        await _upload_part(session, part_number, bytes(buffer))
+        offset = total
+    elif buffer:
+        logger.info("Upload session %s: chunk ended mid-part; resuming from %s", session.id, offset)
+    return offset
+
+
+async def _abort_multipart(s3_key, upload_id):
+    try:
+        await run_in_s3_executor(
+            get_s3_client().abort_multipart_upload, Bucket=S3_BUCKET_NAME, Key=s3_key, UploadId=upload_id,
+        )
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "NoSuchUpload":
+            raise
+
+
+async def complete_session(session):
+    """Finishes the multipart upload and swaps the session for a files row.
+
+    Returns the FileMetadata. Raises SessionOffsetError while bytes are
+    still missing.
+    """
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(UploadSessionPart)
+            .where(UploadSessionPart.session_id == session.id)
+            .order_by(UploadSessionPart.part_number)
+        )
+        parts = result.scalars().all()
+    received = sum(part.size for part in parts)
+    if received != session.size:
+        raise SessionOffsetError(received)
+
+    # The object appears in S3 on completion; the intent covers it until the
+    # files row is committed. A failed completion is left to be retried, so
+    # its intent is not released but comes due after OUTBOX_UPLOAD_GRACE.
+    intent_id = await outbox.record_upload_intent(session.s3_key)
+    s3_start = time.perf_counter()
+    try:
+        await run_in_s3_executor(
+            get_s3_client().complete_multipart_upload,
+            Bucket=S3_BUCKET_NAME, Key=session.s3_key, UploadId=session.upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": p.part_number, "ETag": p.etag} for p in parts]},
+        )
+    except ClientError as e:
+        # A previous complete call finished the upload but not the database write
+        if e.response.get("Error", {}).get("Code") != "NoSuchUpload":
+            raise
+    head = await run_in_s3_executor(get_s3_client().head_object, Bucket=S3_BUCKET_NAME, Key=session.s3_key)
+    record_s3_metric("complete_upload_session", (time.perf_counter() - s3_start) * 1000)
+
+    file_metadata = FileMetadata(
+        id=session.id,
+        file_name=session.s3_key,
+        url=build_file_url(session.s3_key),
+        size=head["ContentLength"],
+        upload_date=head["LastModified"].astimezone(datetime.timezone.utc).replace(tzinfo=None),
+        s3_key=session.s3_key,
+    )
+    db_start = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        db.add(file_metadata)
+        await _delete_session_rows(db, session.id)
+        await outbox.clear_upload_intent(db, intent_id)
+        try:
+            await db.commit()
+        except IntegrityError:
+            # A concurrent complete call recorded the file first
+            await db.rollback()
+            await outbox.clear_upload_intent(db, intent_id)
+            await db.commit()
+            file_metadata = await db.get(FileMetadata, session.id)
+    record_db_metric("complete_upload_session", (time.perf_counter() - db_start) * 1000)
+    return file_metadata
+
+
+async def _delete_session_rows(db, session_id):
+    await db.execute(delete(UploadSessionPart).where(UploadSessionPart.session_id == session_id))
+    await db.execute(delete(UploadSession).where(UploadSession.id == session_id))
+
+
+async def abort_session(session):
+    """Drops the uploaded parts and the session"""
+    await _abort_multipart(session.s3_key, session.upload_id)
+    async with AsyncSessionLocal() as db:
+        await _delete_session_rows(db, session.id)
+        await db.commit()
+
+
+async def reap_expired_sessions():
+    """Aborts sessions idle past their expiry, in batches"""
+    reaped = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(UploadSession)
+                .where(UploadSession.expires_at < datetime.datetime.utcnow())
+                .limit(UPLOAD_SESSION_REAP_BATCH)
+            )
+            expired = result.scalars().all()
+        for session in expired:
+            try:
+                await abort_session(session)
+                reaped += 1
+            except Exception as e:
+                logger.error("Failed to reap upload session %s: %s", session.id, e)
+        if len(expired) < UPLOAD_SESSION_REAP_BATCH or reaped == 0:
+            break
+    if reaped:
+        logger.info("Aborted %s expired upload sessions", reaped)
+    return reaped
+
+
+async def reap_expired_direct_uploads():
+    """Drops direct uploads (POST /v1/uploads) neither completed nor aborted before their expiry"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(DirectUpload)
+            .where(DirectUpload.expires_at < datetime.datetime.utcnow())
+            .limit(UPLOAD_SESSION_REAP_BATCH)
+        )
+        expired = result.scalars().all()
+    reaped = 0
+    # Any rest is picked up by the next run
+    for direct_upload in expired:
+        try:
+            if direct_upload.upload_id:
+                await _abort_multipart(direct_upload.s3_key, direct_upload.upload_id)
+            async with AsyncSessionLocal() as db:
+                await db.execute(delete(DirectUpload).where(DirectUpload.id == direct_upload.id))
+                await db.commit()
+            reaped += 1
+        except Exception as e:
+            logger.error("Failed to reap direct upload %s: %s", direct_upload.id, e)
+    if reaped:
+        logger.info("Dropped %s expired direct uploads", reaped)
+    return reaped
+
+
+async def upload_session_reaper_job(interval=None):
+    """Background task that aborts abandoned upload sessions and direct uploads and prunes idempotency keys"""
+    interval = interval or UPLOAD_SESSION_REAP_INTERVAL
+    while True:
+        try:
+            await reap_expired_sessions()
+            await reap_expired_direct_uploads()
+            await idempotency.prune_idempotency_keys()
+        except Exception as e:
+            logger.error("Upload session reaper run failed: %s", e)
+        await asyncio.sleep(interval)
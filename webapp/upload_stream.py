@@ -0,0 +1,225 @@
+import os
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+from starlette.datastructures import UploadFile
+from s3_service import S3MultipartWriter
+import dedup
+import outbox
+from logger_util import get_logger
+from metrics import record_dedup_metric
+
+logger = get_logger(__name__)
+
+# When enabled, POST /v1/file parses the multipart body as it arrives and
+# forwards the file part straight into an S3 multipart upload instead of
+# letting Starlette spool it into a temporary file first.
+UPLOAD_STREAMING = os.getenv("UPLOAD_STREAMING", "false").lower() == "true"
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE_MB", "5120")) * 1024 * 1024
+
+FILE_FIELD = "file"
+READ_CHUNK_SIZE = 1024 * 1024
+# Room for boundaries, part headers and small form fields on top of the file
+# itself when capping a body that has no Content-Length
+MAX_FORM_OVERHEAD = 64 * 1024
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload exceeds MAX_UPLOAD_SIZE"""
+
+
+class InvalidUploadError(Exception):
+    """Raised when the request body is not a usable multipart/form-data upload"""
+
+
+def _writer(file_name, content_type):
+    content_hash_algorithm = dedup.DEDUP_HASH_ALGORITHM if dedup.UPLOAD_DEDUP else None
+    return S3MultipartWriter(file_name, content_type=content_type, content_hash_algorithm=content_hash_algorithm)
+
+
+async def _complete(writer):
+    """Writes the object, with an outbox intent recorded first so it cannot be orphaned.
+
+    The intent id is returned in the metadata as `outbox_id`; the caller
+    clears it in the transaction that inserts the files row.
+    """
+    intent_id = await outbox.record_upload_intent(writer.file_name)
+    metadata = await writer.complete()
+    metadata["outbox_id"] = intent_id
+    return metadata
+
+
+async def _finish(writer):
+    """Completes the S3 write, or reuses the stored object when the content is a duplicate"""
+    if writer.content_hash is None:
+        return await _complete(writer)
+    content_hash = writer.content_hash.stored_value()
+    existing_key = await dedup.claim_blob(content_hash)
+    if existing_key is not None:
+        # Nothing was sent for uploads under one part; larger ones drop their parts
+        await writer.abort()
+        record_dedup_metric("hit")
+        logger.info("Upload %s duplicates %s; reusing the stored object", writer.file_name, existing_key)
+        return writer.existing_object_metadata(existing_key)
+
+    metadata = await _complete(writer)
+    try:
+        s3_key = await dedup.register_blob(content_hash, writer.file_name, writer.size)
+    except Exception:
+        # No files row will claim the object; let the outbox drop it
+        await outbox.release_upload_intent(metadata["outbox_id"])
+        raise
+    if s3_key == writer.file_name:
+        record_dedup_metric("miss")
+        return metadata
+    # An identical upload finished first: keep its object and let the outbox drop ours
+    record_dedup_metric("race")
+    await outbox.release_upload_intent(metadata["outbox_id"])
+    return writer.existing_object_metadata(s3_key)
+
+
+def _check_declared_length(request, max_size):
+    declared_length = request.headers.get("content-length")
+    if declared_length and declared_length.isdigit() and int(declared_length) > max_size:
+        raise UploadTooLargeError(f"Upload exceeds {max_size} bytes")
+
+
+def _limited_receive(receive, limit):
+    """Wraps an ASGI receive callable so a body longer than `limit` raises UploadTooLargeError"""
+    received = 0
+
+    async def limited():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise UploadTooLargeError(f"Upload body exceeds {limit} bytes")
+        return message
+    return limited
+
+
+async def stream_upload_to_s3(request: Request, file_id: str, max_size: int = None):
+    """Streams the `file` field of a multipart request into S3.
+
+    Returns a (file_name, metadata) tuple, or None if the request carried no
+    file. Any failure, including the client disconnecting, aborts the S3
+    multipart upload before the exception propagates.
+    """
+    max_size = max_size or MAX_UPLOAD_SIZE
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise InvalidUploadError("Expected a multipart/form-data body")
+
+    # The declared length includes the multipart framing; the file part itself
+    # is held to max_size exactly while it streams
+    _check_declared_length(request, max_size + MAX_FORM_OVERHEAD)
+
+    # The parser callbacks are synchronous, so they only record events; the
+    # async work (S3 part uploads) happens after each chunk is fed in.
+    events = []
+    header_field = bytearray()
+    header_value = bytearray()
+    part_headers = {}
+
+    def on_part_begin():
+        part_headers.clear()
+
+    def on_header_field(data, start, end):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data, start, end):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        part_headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        events.append(("headers", dict(part_headers)))
+
+    def on_part_data(data, start, end):
+        events.append(("data", data[start:end]))
+
+    def on_part_end():
+        events.append(("end", None))
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    writer = None
+    in_file_part = False
+    done = False
+    try:
+        async for chunk in request.stream():
+            if done:
+                # Drain the rest of the body; only the first file part is stored
+                continue
+            parser.write(chunk)
+            for kind, payload in events:
+                if kind == "headers":
+                    _, disposition = parse_options_header(payload.get(b"content-disposition"))
+                    name = disposition.get(b"name", b"").decode("latin-1")
+                    filename = disposition.get(b"filename")
+                    in_file_part = writer is None and name == FILE_FIELD and filename is not None
+                    if in_file_part:
+                        writer = _writer(
+                            f"{file_id}_{filename.decode('utf-8', 'replace')}",
+                            payload.get(b"content-type", b"").decode("latin-1") or None,
+                        )
+                elif kind == "data" and in_file_part:
+                    if writer.size + len(payload) > max_size:
+                        raise UploadTooLargeError(f"Upload exceeds {max_size} bytes")
+                    await writer.write(payload)
+                elif kind == "end" and in_file_part:
+                    in_file_part = False
+                    done = True
+            events.clear()
+        parser.finalize()
+
+        if in_file_part:
+            raise InvalidUploadError("Request body ended before the file part was complete")
+        if writer is None:
+            return None
+        metadata = await _finish(writer)
+        return writer.file_name, metadata
+    except BaseException:
+        if writer is not None:
+            logger.warning("Aborting streamed upload of %s after %s bytes", writer.file_name, writer.size)
+            await writer.abort()
+        raise
+
+
+async def upload_form_file_to_s3(request: Request, file_id: str, max_size: int = None):
+    """Buffered ingest: lets Starlette spool the form, then streams the spooled file to S3.
+
+    An oversized declared body is refused before anything is spooled, and a
+    body without Content-Length stops being read once it cannot fit.
+    """
+    max_size = max_size or MAX_UPLOAD_SIZE
+    _check_declared_length(request, max_size + MAX_FORM_OVERHEAD)
+    limited = Request(request.scope, receive=_limited_receive(request.receive, max_size + MAX_FORM_OVERHEAD))
+    async with limited.form() as form:
+        file = form.get(FILE_FIELD)
+        if not isinstance(file, UploadFile):
+            return None
+        if file.size is not None and file.size > max_size:
+            raise UploadTooLargeError(f"Upload exceeds {max_size} bytes")
+        # Append UUID for uniqueness
+        writer = _writer(f"{file_id}_{file.filename}", file.content_type)
+        try:
+            while chunk := await file.read(READ_CHUNK_SIZE):
+                await writer.write(chunk)
+            metadata = await _finish(writer)
+        except BaseException:
+            await writer.abort()
+            raise
+        return writer.file_name, metadata